@@ -13,6 +13,7 @@ from sqlmodel import Session, select
 
 from ragtube.core.database import get_session
 from ragtube.core.models import Channel
+from ragtube.core.utils import get_watch_url
 from ragtube.services.rag import get_rag_chain
 
 
@@ -50,6 +51,20 @@ class Document(BaseModel):
             examples=["2024-04-29T18:10:20"],
         ),
     ]
+    start: Annotated[
+        float | None,
+        Field(
+            title="Chunk start in the YouTube video, in seconds",
+            examples=[125.32],
+        ),
+    ] = None
+    url: Annotated[
+        str,
+        Field(
+            title="YouTube video URL starting at the chunk",
+            examples=["https://www.youtube.com/watch?v=UBXXw2JSloo&t=125s"],
+        ),
+    ]
     content: Annotated[
         str,
         Field(
@@ -147,10 +162,11 @@ async def rag(
     channel_id: str | None = None,
     rag_chain=Depends(get_rag_chain),
 ):
-    response = rag_chain.stream({"input": input})
+    # retrieval, reranking and generation all run on the event loop
+    response = rag_chain.astream({"input": input})
 
-    def stream(response):
-        for message in response:
+    async def stream(response):
+        async for message in response:
             if "context" in message:
                 context = [
                     Document(
@@ -158,6 +174,10 @@ async def rag(
                         video_id=doc.metadata["video_id"],
                         title=doc.metadata["title"],
                         publish_time=doc.metadata["publish_time"],
+                        start=doc.metadata.get("start"),
+                        url=get_watch_url(
+                            doc.metadata["video_id"], doc.metadata.get("start")
+                        ),
                         content=doc.page_content,
                         relevance_score=float(
                             doc.metadata.get("relevance_score", 0.0)
@@ -1,18 +1,54 @@
+import logging
+from datetime import timedelta
 from typing import Annotated
 
 import typer
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
 
-from ragtube.core.database import setting_engine
-from ragtube.core.params import get_params
+from ragtube.core.database import create_indexes, setting_engine
+from ragtube.core.models import Channel
+from ragtube.core.params import Params, get_params
+from ragtube.core.partition import (
+    create_partitions,
+    get_partition_name,
+    get_partition_table,
+    is_partitioned,
+    partition_chunks,
+)
 from ragtube.core.settings import get_settings
+from ragtube.data.cache import TranscriptCache, warm_transcript_cache
+from ragtube.data.caption import migrate_captions as _migrate_captions
 from ragtube.data.chunk import ChunkTask
 from ragtube.data.transcript import VideoTranscriptTask
-from ragtube.services.embedding import EmbeddingTask
+from ragtube.services.cache import collect_embedding_cache
+from ragtube.services.embedding import (
+    SHADOW_EMBEDDING,
+    EmbeddingTask,
+    get_embedding_cache,
+    get_embedding_fingerprint,
+    get_shadow_table,
+)
+from ragtube.services.projection import ProjectionTask
 from ragtube.services.retriever import create_index
 
 app = typer.Typer()
 
 
+def get_transcript_cache(params: Params) -> TranscriptCache | None:
+    if params.transcript_cache_dir is None:
+        return None
+    return TranscriptCache(
+        params.transcript_cache_dir,
+        params.transcript_cache_max_size * 1024**2,
+    )
+
+
+def get_channel_ids(engine: Engine) -> list[str]:
+    with Session(engine) as session:
+        return list(session.exec(select(Channel.id)).all())
+
+
 @app.command()
 def update_index(
     channel_id: Annotated[
@@ -21,10 +57,17 @@ def update_index(
             help="Channel id, if not set channel_id from params.yaml will be used"
         ),
     ] = None,
+    full_sync: Annotated[
+        bool,
+        typer.Option(
+            help="List every video of the channels instead of stopping at the last synced one"
+        ),
+    ] = False,
 ):
     """
     Add videos from a YouTube channel to the vector store
     """
+    logging.basicConfig(level=logging.INFO)
     settings = get_settings()
     params = get_params()
     engine = setting_engine()
@@ -33,29 +76,203 @@ def update_index(
         if settings.https_proxy
         else None
     )
+    channel_ids = channel_id or params.channel_id
+    if isinstance(channel_ids, str):
+        channel_ids = [channel_ids]
     transcript_task = VideoTranscriptTask(
         engine,
-        channel_id or params.channel_id,
+        channel_ids,
         settings.youtube_api_key.get_secret_value(),
         params.language,
         params.request_timeout,
         proxies,
+        params.transcript_workers,
+        params.channel_workers,
+        full_sync,
+        params.ingest_commit_size,
+        params.ingest_retry_backoff,
+        params.ingest_max_attempts,
+        params.caption_storage,
+        get_transcript_cache(params),
+        params.youtube_api_rate,
+        params.transcript_rate,
+        params.throttle_cooldown,
+    )
+    chunk_task = ChunkTask(
+        engine,
+        params.chunk_size,
+        params.chunk_overlap,
+        params.chunk_workers,
+        params.chunk_batch_size,
+        params.stream_batch_size,
     )
-    chunk_task = ChunkTask(engine, params.chunk_size, params.chunk_overlap)
     embedding_task = EmbeddingTask(
-        engine, params.embedding_model_name, params.embedding_num_ctx
+        engine,
+        params.embedding_model_name,
+        params.embedding_num_ctx,
+        params.stream_batch_size,
+        chunk_task.fingerprint,
+        params.embedding_batch_size,
+        params.embedding_concurrency,
+        params.embedding_max_retries,
+        get_embedding_cache(
+            engine,
+            params.embedding_model_name,
+            params.embedding_num_ctx,
+            params.embedding_backend,
+            params.embedding_quantize,
+        )
+        if params.embedding_cache
+        else None,
+        params.embedding_backend,
+        params.embedding_threads,
+        params.embedding_quantize,
+        params.embedding_size,
     )
 
-    transcript_task.launch()
+    try:
+        transcript_task.launch()
+    finally:
+        typer.echo(str(transcript_task.ledger))
+    # partitions of other channels do not change, unless just created
+    changed_channel_ids = set(channel_ids)
+    if params.chunk_partitioning:
+        changed_channel_ids.update(partition_chunks(engine))
+        create_indexes(engine)
+    partitioned = is_partitioned(engine)
+    if partitioned:
+        create_partitions(engine, channel_ids)
     chunk_task.launch()
     embedding_task.launch()
+    typer.echo(str(embedding_task))
+    if embedding_task.cache is not None:
+        typer.echo(str(embedding_task.cache))
+    if embedding_task.is_migrated():
+        # the embeddings of the new model are indexed before they are
+        # swapped in, searches use the old ones until then
+        shadow_tables = (
+            [
+                get_shadow_table(
+                    get_partition_name(channel_id), params.embedding_size
+                )
+                for channel_id in get_channel_ids(engine)
+            ]
+            if partitioned
+            else [get_shadow_table(dim=params.embedding_size)]
+        )
+        # reduced ones are built once the projection is fitted again
+        if params.index_storage != "reduced":
+            for table in shadow_tables:
+                create_index(
+                    engine,
+                    params.index_hnsm_m,
+                    params.index_hnsm_ef_construction,
+                    params.index_vector_ops,
+                    params.index_storage,
+                    None,
+                    table,
+                    SHADOW_EMBEDDING,
+                )
+        embedding_task.swap_embeddings()
+        changed_channel_ids.update(get_channel_ids(engine))
+    if params.embedding_projection_dim:
+        projection_task = ProjectionTask(
+            engine,
+            params.embedding_projection_dim,
+            params.embedding_projection_method,
+            params.embedding_projection_sample_size,
+            params.stream_batch_size,
+            # fitted to the embeddings searched, until the new ones are in
+            embedding_fingerprint=embedding_task.live.fingerprint
+            if embedding_task.live
+            else embedding_task.fingerprint,
+        )
+        projection_task.launch()
+        typer.echo(str(projection_task))
 
-    create_index(
-        engine,
-        params.index_hnsm_m,
-        params.index_hnsm_ef_construction,
-        params.index_hnsm_ef_searh,
+    tables = (
+        [
+            get_partition_table(channel_id)
+            for channel_id in sorted(changed_channel_ids)
+        ]
+        if partitioned
+        else [None]
+    )
+    for table in tables:
+        create_index(
+            engine,
+            params.index_hnsm_m,
+            params.index_hnsm_ef_construction,
+            params.index_vector_ops,
+            params.index_storage,
+            params.embedding_projection_dim,
+            table,
+            # the live embeddings are of the old model while migrating
+            dim=embedding_task.live.dim if embedding_task.live else None,
+        )
+
+
+@app.command()
+def migrate_captions():
+    """
+    Pack the caption rows of every video into one columnar caption track
+    """
+    engine = setting_engine()
+    migrated = _migrate_captions(engine)
+    typer.echo(f"Migrated the captions of {migrated} videos.")
+
+
+@app.command()
+def warm_cache():
+    """
+    Copy the transcripts stored in the database into the transcript cache
+    """
+    params = get_params()
+    cache = get_transcript_cache(params)
+    if cache is None:
+        raise typer.BadParameter("transcript_cache_dir is not set")
+    added = warm_transcript_cache(setting_engine(), cache, params.language)
+    typer.echo(f"Added {added} transcripts to the cache.")
+    typer.echo(str(cache))
+
+
+@app.command()
+def export_cache(
+    path: Annotated[str, typer.Argument(help="Path of the tar archive")],
+):
+    """
+    Archive the transcript cache into a tar file
+    """
+    cache = get_transcript_cache(get_params())
+    if cache is None:
+        raise typer.BadParameter("transcript_cache_dir is not set")
+    exported = cache.export(path)
+    typer.echo(f"Exported {exported} transcripts to {path}.")
+
+
+@app.command()
+def gc_embedding_cache(
+    max_age: Annotated[
+        int | None,
+        typer.Option(help="Also delete embeddings unused for this many days"),
+    ] = None,
+):
+    """
+    Delete the cached embeddings of models other than the configured one
+    """
+    params = get_params()
+    model_key = get_embedding_fingerprint(
+        params.embedding_model_name,
+        params.embedding_num_ctx,
+        params.embedding_backend,
+        params.embedding_quantize,
+    )
+    deleted = collect_embedding_cache(
+        setting_engine(),
+        [model_key],
+        timedelta(days=max_age) if max_age is not None else None,
     )
+    typer.echo(f"Deleted {deleted} cached embeddings.")
 
 
 if __name__ == "__main__":
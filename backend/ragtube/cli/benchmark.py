@@ -0,0 +1,616 @@
+import statistics
+import time
+from datetime import datetime
+from functools import partial
+
+import typer
+from langchain_core.embeddings import Embeddings
+from sqlalchemy import event, func
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+from sqlmodel import Session, col, select, text
+
+from ragtube.core.bulk import batched
+from ragtube.core.database import setting_engine
+from ragtube.core.models import Caption, Channel, Chunk, Video
+from ragtube.core.params import get_params
+from ragtube.data.caption import write_captions
+from ragtube.data.chunk import write_chunks
+from ragtube.services.embedding import get_embedding_model
+from ragtube.services.projection import get_projection
+from ragtube.services.retriever import (
+    INDEX_STORAGES,
+    Hit,
+    Retriever,
+    create_index,
+    drop_index,
+    get_index_name,
+)
+
+app = typer.Typer()
+
+
+@app.callback()
+def main():
+    """
+    Benchmarks of the ingestion and retrieval paths, run against the
+    configured database
+    """
+
+
+def get_benchmark_video() -> Video:
+    return Video(
+        id="benchmark",
+        title="benchmark",
+        publish_time=datetime(2024, 1, 1),
+        channel=Channel(id="benchmark", title="benchmark"),
+    )
+
+
+def get_benchmark_captions(rows: int) -> list[Caption]:
+    return [
+        Caption(
+            text=f"benchmark caption number {i}",
+            start=float(i),
+            duration=1.0,
+            video_id="benchmark",
+        )
+        for i in range(rows)
+    ]
+
+
+def get_benchmark_chunk_rows(
+    rows: int,
+) -> list[tuple[str, float, float, str, str]]:
+    return [
+        (
+            f"benchmark chunk number {i}",
+            float(i),
+            1.0,
+            "benchmark",
+            "benchmark",
+        )
+        for i in range(rows)
+    ]
+
+
+def measure_load(engine: Engine, write) -> float:
+    """Seconds write takes, given a session, then rolled back."""
+    with Session(engine) as session:
+        session.add(get_benchmark_video())
+        session.flush()
+        start_time = time.perf_counter()
+        write(session)
+        elapsed = time.perf_counter() - start_time
+        session.rollback()
+    return elapsed
+
+
+def write_orm(session: Session, objects: list):
+    session.add_all(objects)
+    session.flush()
+
+
+@app.command()
+def bulk_load(
+    rows: int = typer.Option(100_000, help="Number of caption and chunk rows"),
+):
+    """
+    Compare rows per second writing captions and chunks through the ORM and
+    COPY. Every write is rolled back.
+    """
+    engine = setting_engine()
+    chunk_rows = get_benchmark_chunk_rows(rows)
+    cases = [
+        (
+            "captions",
+            partial(write_orm, objects=get_benchmark_captions(rows)),
+            partial(write_captions, captions=get_benchmark_captions(rows)),
+        ),
+        (
+            "chunks",
+            partial(
+                write_orm,
+                objects=[
+                    Chunk(
+                        content=row[0],
+                        start=row[1],
+                        duration=row[2],
+                        video_id=row[3],
+                        channel_id=row[4],
+                    )
+                    for row in chunk_rows
+                ],
+            ),
+            partial(write_chunks, rows=chunk_rows),
+        ),
+    ]
+    for name, orm_write, copy_write in cases:
+        orm_elapsed = measure_load(engine, orm_write)
+        copy_elapsed = measure_load(engine, copy_write)
+        typer.echo(f"{name}:")
+        typer.echo(
+            f"  ORM:  {rows / orm_elapsed:,.0f} rows/s ({orm_elapsed:.2f}s)"
+        )
+        typer.echo(
+            f"  COPY: {rows / copy_elapsed:,.0f} rows/s ({copy_elapsed:.2f}s)"
+        )
+
+
+def get_benchmark_texts(engine: Engine, n: int) -> list[str]:
+    with Session(engine) as session:
+        texts = list(session.exec(select(Chunk.content).limit(n)).all())
+    # without chunks, long enough texts to fill the context of the model
+    return texts or [
+        " ".join(f"benchmark chunk {i} word {j}" for j in range(100))
+        for i in range(n)
+    ]
+
+
+def get_latency_quantiles(latencies: list[float]) -> tuple[float, float]:
+    """p50 and p99 of latencies, in milliseconds, nan without any."""
+    if len(latencies) < 2:
+        # quantiles needs two of them, a single one is every quantile
+        latency = latencies[0] * 1000 if latencies else float("nan")
+        return latency, latency
+    quantiles = statistics.quantiles(latencies, n=100)
+    return quantiles[49] * 1000, quantiles[98] * 1000
+
+
+def measure_embeddings(
+    model: Embeddings, texts: list[str], queries: list[str], batch_size: int
+) -> tuple[float, float, float]:
+    """Chunks per second embedding texts in batches, query p50 and p99."""
+    model.embed_query("warm up")
+    start_time = time.perf_counter()
+    for batch in batched(texts, batch_size):
+        model.embed_documents(batch)
+    rate = len(texts) / (time.perf_counter() - start_time)
+    latencies = []
+    for query in queries:
+        start_time = time.perf_counter()
+        model.embed_query(query)
+        latencies.append(time.perf_counter() - start_time)
+    return rate, *get_latency_quantiles(latencies)
+
+
+@app.command()
+def embedding(
+    ollama_model: str = typer.Option("bge-large", help="Ollama model"),
+    hf_model: str = typer.Option(
+        "BAAI/bge-large-en-v1.5", help="Same model on Hugging Face"
+    ),
+    texts: int = typer.Option(512, help="Number of chunks to embed"),
+    queries: int = typer.Option(100, help="Number of queries to embed"),
+):
+    """
+    Compare ingest throughput and query latency of the embedding backends
+    on the same model, over chunks of the database.
+    """
+    params = get_params()
+    chunk_texts = get_benchmark_texts(setting_engine(), texts)
+    # queries are short, the first words of the chunks
+    query_texts = [
+        " ".join(text.split()[:12]) for text in chunk_texts[:queries]
+    ]
+    backends = [
+        ("ollama", ollama_model, "ollama", False),
+        ("sentence-transformers", hf_model, "sentence-transformers", False),
+        (
+            "sentence-transformers int8",
+            hf_model,
+            "sentence-transformers",
+            True,
+        ),
+    ]
+    for name, model_name, backend, quantize in backends:
+        model = get_embedding_model(
+            model_name,
+            params.embedding_num_ctx,
+            backend,
+            params.embedding_threads,
+            quantize,
+        )
+        rate, p50, p99 = measure_embeddings(
+            model, chunk_texts, query_texts, params.embedding_batch_size
+        )
+        typer.echo(
+            f"{name:<28}{rate:>8.1f} chunks/s  "
+            f"query p50 {p50:.1f} ms  p99 {p99:.1f} ms"
+        )
+
+
+def get_benchmark_embeddings(engine: Engine, n: int) -> list[list[float]]:
+    """Embeddings of n random chunks, used as queries."""
+    with Session(engine) as session:
+        statement = (
+            select(Chunk.embedding)
+            .where(col(Chunk.embedding).is_not(None))
+            .order_by(func.random())
+            .limit(n)
+        )
+        return [list(embedding) for embedding in session.exec(statement)]
+
+
+def index_exists(engine: Engine, name: str) -> bool:
+    with Session(engine) as session:
+        statement = text("SELECT to_regclass(:name) IS NOT NULL")
+        return session.connection().execute(statement, {"name": name}).one()[0]
+
+
+def get_index_size(engine: Engine, name: str) -> int:
+    with Session(engine) as session:
+        statement = text("SELECT pg_relation_size(to_regclass(:name))")
+        return session.connection().execute(statement, {"name": name}).one()[0]
+
+
+def get_exact_ids(
+    retriever: Retriever, query_embeddings: list[list[float]]
+) -> list[set[int]]:
+    """Ids of the results of each query with an exact scan of the chunks."""
+    retriever = retriever.model_copy(
+        update={
+            "index_storage": "vector",
+            "iterative_scan": "off",
+            "max_ef_search": retriever.ef_search,
+        }
+    )
+    with Session(retriever.engine) as session:
+        session.connection().execute(text("SET LOCAL enable_indexscan = off"))
+        return [
+            {hit.id for hit in retriever.search(session, embedding)}
+            for embedding in query_embeddings
+        ]
+
+
+def measure_search(
+    retriever: Retriever,
+    query_embeddings: list[list[float]],
+    exact_ids: list[set[int]],
+) -> tuple[float, float, float, float]:
+    """Query p50 and p99, recall against exact_ids and mean results."""
+    latencies = []
+    recalls = []
+    results = []
+    with Session(retriever.engine) as session:
+        for embedding, ids in zip(query_embeddings, exact_ids):
+            start_time = time.perf_counter()
+            hits = retriever.search(session, embedding)
+            latencies.append(time.perf_counter() - start_time)
+            if ids:
+                recalls.append(len(ids & {hit.id for hit in hits}) / len(ids))
+            results.append(len(hits))
+    p50, p99 = get_latency_quantiles(latencies)
+    recall = statistics.mean(recalls) if recalls else 1.0
+    return p50, p99, recall, statistics.mean(results)
+
+
+@app.command()
+def index_storage(
+    queries: int = typer.Option(100, help="Number of queries"),
+    k: int = typer.Option(10, help="Results per query"),
+):
+    """
+    Compare size, query latency and recall@k of the HNSW index over
+    float32, half precision, binary and projected embeddings, the last one
+    when a projection was fitted. Queries are embeddings
+    of chunks, recall is against an exact scan. Indexes built only for the
+    benchmark are dropped afterwards.
+    """
+    params = get_params()
+    engine = setting_engine()
+    query_embeddings = get_benchmark_embeddings(engine, queries)
+    if not query_embeddings:
+        raise typer.BadParameter("there are no embedded chunks")
+    embedding_model = get_embedding_model(
+        params.embedding_model_name,
+        params.embedding_num_ctx,
+        params.embedding_backend,
+    )
+
+    projection = get_projection(engine)
+    reduced_dim = projection.dim if projection is not None else None
+
+    def get_retriever(storage: str) -> Retriever:
+        return Retriever(
+            engine=engine,
+            embedding_model=embedding_model,
+            vector_ops=params.index_vector_ops,
+            results_to_retrieve=k,
+            index_storage=storage,
+            rescore_factor=params.index_rescore_factor,
+            rescore=params.index_rescore,
+            projection=projection,
+            ef_search=params.index_hnsm_ef_searh,
+        )
+
+    exact_ids = get_exact_ids(get_retriever("vector"), query_embeddings)
+
+    for storage in INDEX_STORAGES:
+        if storage == "reduced" and projection is None:
+            continue
+        name = get_index_name(storage, reduced_dim)
+        existed = index_exists(engine, name)
+        create_index(
+            engine,
+            params.index_hnsm_m,
+            params.index_hnsm_ef_construction,
+            params.index_vector_ops,
+            storage,
+            reduced_dim,
+        )
+        p50, p99, recall, _ = measure_search(
+            get_retriever(storage), query_embeddings, exact_ids
+        )
+        size = get_index_size(engine, name)
+        if not existed and storage != params.index_storage:
+            drop_index(engine, name)
+        typer.echo(
+            f"{storage:<8}{size / 1024**2:>10.1f} MB  "
+            f"p50 {p50:.1f} ms  p99 {p99:.1f} ms  "
+            f"recall@{k} {recall:.3f}"
+        )
+
+
+def get_smallest_channel(engine: Engine) -> str | None:
+    """Channel with the fewest embedded chunks."""
+    with Session(engine) as session:
+        statement = (
+            select(Video.channel_id)
+            .join(Chunk)
+            .where(col(Chunk.embedding).is_not(None))
+            .group_by(col(Video.channel_id))
+            .order_by(func.count())
+            .limit(1)
+        )
+        return session.exec(statement).first()
+
+
+@app.command()
+def filtered_search(
+    channel_id: str | None = typer.Option(
+        None, help="Channel to filter by, the smallest one if not set"
+    ),
+    queries: int = typer.Option(100, help="Number of queries"),
+    k: int = typer.Option(5, help="Results per query"),
+):
+    """
+    Compare query latency, recall@k and results returned of unfiltered
+    queries and channel filtered ones: with a fixed ef_search, widening it
+    while results are short, and with pgvector iterative scans. Queries
+    are embeddings of chunks of any channel, recall is against an exact
+    scan with the same filter.
+    """
+    params = get_params()
+    engine = setting_engine()
+    query_embeddings = get_benchmark_embeddings(engine, queries)
+    if not query_embeddings:
+        raise typer.BadParameter("there are no embedded chunks")
+    channel_id = channel_id or get_smallest_channel(engine)
+    projection = get_projection(engine)
+    retriever = Retriever(
+        engine=engine,
+        embedding_model=get_embedding_model(
+            params.embedding_model_name,
+            params.embedding_num_ctx,
+            params.embedding_backend,
+        ),
+        vector_ops=params.index_vector_ops,
+        results_to_retrieve=k,
+        index_storage=params.index_storage,
+        rescore_factor=params.index_rescore_factor,
+        rescore=params.index_rescore,
+        projection=projection if params.index_storage == "reduced" else None,
+        ef_search=params.index_hnsm_ef_searh,
+        max_ef_search=params.index_max_ef_search,
+    )
+    filtered = retriever.model_copy(update={"channel_id": channel_id})
+    cases = [
+        ("unfiltered", retriever),
+        (
+            "fixed",
+            filtered.model_copy(
+                update={"max_ef_search": params.index_hnsm_ef_searh}
+            ),
+        ),
+        ("widening", filtered),
+        (
+            "relaxed_order",
+            filtered.model_copy(update={"iterative_scan": "relaxed_order"}),
+        ),
+        (
+            "strict_order",
+            filtered.model_copy(update={"iterative_scan": "strict_order"}),
+        ),
+    ]
+    typer.echo(f"channel {channel_id}")
+    for name, case in cases:
+        exact_ids = get_exact_ids(case, query_embeddings)
+        try:
+            p50, p99, recall, results = measure_search(
+                case, query_embeddings, exact_ids
+            )
+        except DBAPIError:
+            typer.echo(f"{name:<14}not supported by this pgvector version")
+            continue
+        typer.echo(
+            f"{name:<14}p50 {p50:.1f} ms  p99 {p99:.1f} ms  "
+            f"recall@{k} {recall:.3f}  {results:.1f} results"
+        )
+
+
+def get_known_item_queries(
+    engine: Engine, n: int, terms: int
+) -> list[tuple[int, str]]:
+    """
+    Random embedded chunks and a query of their longest words, which stand
+    for the names and acronyms users search for.
+    """
+    with Session(engine) as session:
+        statement = (
+            select(Chunk.id, Chunk.content)
+            .where(col(Chunk.embedding).is_not(None))
+            .order_by(func.random())
+            .limit(n)
+        )
+        return [
+            (
+                chunk_id,
+                " ".join(sorted(set(content.split()), key=len)[-terms:]),
+            )
+            for chunk_id, content in session.exec(statement)
+        ]
+
+
+@app.command()
+def hybrid(
+    queries: int = typer.Option(100, help="Number of queries"),
+    k: int = typer.Option(5, help="Results per query"),
+    terms: int = typer.Option(3, help="Words per query"),
+):
+    """
+    Compare query latency and recall@k of vector and hybrid retrieval.
+    Queries are a few words of a chunk, recall is the fraction of queries
+    retrieving that chunk. Latency includes embedding the query, which
+    hybrid overlaps with its full-text search.
+    """
+    params = get_params()
+    engine = setting_engine()
+    known_items = get_known_item_queries(engine, queries, terms)
+    if not known_items:
+        raise typer.BadParameter("there are no embedded chunks")
+    retriever = Retriever(
+        engine=engine,
+        embedding_model=get_embedding_model(
+            params.embedding_model_name,
+            params.embedding_num_ctx,
+            params.embedding_backend,
+        ),
+        vector_ops=params.index_vector_ops,
+        results_to_retrieve=k,
+        index_storage=params.index_storage,
+        rescore_factor=params.index_rescore_factor,
+        rescore=params.index_rescore,
+        projection=get_projection(engine)
+        if params.index_storage == "reduced"
+        else None,
+        ef_search=params.index_hnsm_ef_searh,
+        rrf_k=params.rrf_k,
+        text_search_config=params.text_search_config,
+    )
+
+    def search_vector(session: Session, query: str) -> list[Hit]:
+        embedding = retriever.embedding_model.embed_query(query)
+        return retriever.search(session, embedding)
+
+    for name, search in [
+        ("vector", search_vector),
+        ("hybrid", retriever.search_hybrid),
+    ]:
+        latencies = []
+        found = 0
+        for chunk_id, query in known_items:
+            with Session(engine) as session:
+                start_time = time.perf_counter()
+                hits = search(session, query)
+                latencies.append(time.perf_counter() - start_time)
+            found += chunk_id in {hit.id for hit in hits}
+        p50, p99 = get_latency_quantiles(latencies)
+        typer.echo(
+            f"{name:<8}p50 {p50:.1f} ms  p99 {p99:.1f} ms  "
+            f"recall@{k} {found / len(known_items):.3f}"
+        )
+
+
+def search_orm(
+    retriever: Retriever, session: Session, embedding: list[float]
+) -> list[Chunk]:
+    """
+    Retrieval as it was done before the column query: whole chunks, their
+    embeddings included, and a lazy load of the video of each.
+    """
+    distance = getattr(Chunk.embedding, f"{retriever.vector_ops}_distance")(
+        embedding
+    )
+    statement = (
+        select(Chunk)
+        .where(col(Chunk.embedding).is_not(None))
+        .order_by(distance)
+        .limit(retriever.results_to_retrieve)
+    )
+    chunks = list(session.exec(statement).all())
+    for chunk in chunks:
+        chunk.video.title
+    return chunks
+
+
+def get_result_size(cursor) -> int:
+    """Bytes of the values a query returned, as sent by the server."""
+    result = cursor.pgresult
+    if result is None:
+        return 0
+    return sum(
+        len(result.get_value(row, field) or b"")
+        for row in range(result.ntuples)
+        for field in range(result.nfields)
+    )
+
+
+@app.command()
+def retrieval(
+    queries: int = typer.Option(100, help="Number of queries"),
+    k: int = typer.Option(5, help="Results per query"),
+):
+    """
+    Compare database time, round trips and bytes received per query of
+    the ORM retrieval, loading whole chunks and their videos, and the
+    column query of the retriever. Queries are embeddings of chunks.
+    """
+    params = get_params()
+    engine = setting_engine()
+    query_embeddings = get_benchmark_embeddings(engine, queries)
+    if not query_embeddings:
+        raise typer.BadParameter("there are no embedded chunks")
+    retriever = Retriever(
+        engine=engine,
+        embedding_model=get_embedding_model(
+            params.embedding_model_name,
+            params.embedding_num_ctx,
+            params.embedding_backend,
+        ),
+        vector_ops=params.index_vector_ops,
+        results_to_retrieve=k,
+    )
+    stats = {"queries": 0, "bytes": 0}
+
+    def count_query(conn, cursor, statement, parameters, context, many):
+        stats["queries"] += 1
+        stats["bytes"] += get_result_size(cursor)
+
+    event.listen(engine, "after_cursor_execute", count_query)
+    try:
+        for name, search in [
+            ("ORM", partial(search_orm, retriever)),
+            ("columns", retriever.search),
+        ]:
+            stats.update(queries=0, bytes=0)
+            latencies = []
+            for embedding in query_embeddings:
+                # a session per query, like the retriever
+                with Session(engine) as session:
+                    start_time = time.perf_counter()
+                    search(session, embedding)
+                    latencies.append(time.perf_counter() - start_time)
+            p50, p99 = get_latency_quantiles(latencies)
+            n = len(query_embeddings)
+            typer.echo(
+                f"{name:<8}p50 {p50:.1f} ms  p99 {p99:.1f} ms  "
+                f"{stats['queries'] / n:.1f} queries  "
+                f"{stats['bytes'] / n / 1024:.1f} KB per search"
+            )
+    finally:
+        event.remove(engine, "after_cursor_execute", count_query)
+
+
+if __name__ == "__main__":
+    app()
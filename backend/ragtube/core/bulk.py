@@ -0,0 +1,109 @@
+from collections.abc import Iterable, Iterator, Sequence
+from itertools import islice
+
+from psycopg import sql
+from sqlalchemy import Table
+from sqlmodel import Session
+
+
+def batched(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def copy_rows(
+    session: Session,
+    table: Table,
+    columns: Sequence[str],
+    rows: Iterable[Sequence],
+    batch_size: int = 10_000,
+) -> int:
+    """
+    Write rows into table with COPY FROM STDIN, on the connection and inside
+    the transaction of the session. Rows are sent in batches of batch_size,
+    one COPY each. Returns the number of rows written.
+    """
+    statement = sql.SQL("COPY {} ({}) FROM STDIN").format(
+        sql.Identifier(table.name),
+        sql.SQL(", ").join(sql.Identifier(column) for column in columns),
+    )
+    connection = session.connection().connection.driver_connection
+    written = 0
+    with connection.cursor() as cursor:
+        for batch in batched(rows, batch_size):
+            with cursor.copy(statement) as copy:
+                for row in batch:
+                    copy.write_row(row)
+            written += len(batch)
+    return written
+
+
+def update_rows(
+    session: Session,
+    table: Table,
+    columns: Sequence[str],
+    rows: Iterable[Sequence],
+    key: str = "id",
+    batch_size: int = 10_000,
+) -> int:
+    """
+    Set columns of the rows of table whose key is the first value of each
+    row. Rows are copied into a temporary staging table and applied with a
+    single UPDATE ... FROM, instead of one UPDATE per row. Runs inside the
+    transaction of the session and returns the number of rows updated.
+    """
+    staging_table = sql.Identifier("pg_temp", f"{table.name}_staging")
+    staging_columns = sql.SQL(", ").join(
+        sql.Identifier(column) for column in [key, *columns]
+    )
+    # values are sent in their text form, e.g. vectors as '[1.0,2.0]'
+    dialect = session.connection().dialect
+    processors = [
+        table.c[column].type.bind_processor(dialect)
+        for column in [key, *columns]
+    ]
+    connection = session.connection().connection.driver_connection
+    with connection.cursor() as cursor:
+        cursor.execute(
+            sql.SQL("DROP TABLE IF EXISTS {}").format(staging_table)
+        )
+        cursor.execute(
+            sql.SQL(
+                "CREATE TEMPORARY TABLE {} ON COMMIT DROP AS "
+                "SELECT {} FROM {} WITH NO DATA"
+            ).format(
+                staging_table, staging_columns, sql.Identifier(table.name)
+            )
+        )
+        statement = sql.SQL("COPY {} ({}) FROM STDIN").format(
+            staging_table, staging_columns
+        )
+        for batch in batched(rows, batch_size):
+            with cursor.copy(statement) as copy:
+                for row in batch:
+                    copy.write_row(
+                        [
+                            processor(value) if processor else value
+                            for processor, value in zip(processors, row)
+                        ]
+                    )
+        cursor.execute(
+            sql.SQL(
+                "UPDATE {table} SET {assignments} FROM {staging} "
+                "WHERE {table}.{key} = {staging}.{key}"
+            ).format(
+                table=sql.Identifier(table.name),
+                assignments=sql.SQL(", ").join(
+                    sql.SQL("{} = {}.{}").format(
+                        sql.Identifier(column),
+                        staging_table,
+                        sql.Identifier(column),
+                    )
+                    for column in columns
+                ),
+                staging=staging_table,
+                key=sql.Identifier(key),
+            )
+        )
+        return cursor.rowcount
@@ -1,6 +1,18 @@
+from collections.abc import Sequence
 from functools import lru_cache
 
+from sqlalchemy import (
+    ARRAY,
+    ColumnElement,
+    String,
+    bindparam,
+    exists,
+    func,
+    inspect,
+)
 from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.schema import CreateColumn
 from sqlmodel import (
     Session,
     SQLModel,
@@ -8,6 +20,7 @@ from sqlmodel import (
     text,
 )
 
+from ragtube.core.params import get_params
 from ragtube.core.settings import get_settings
 
 
@@ -19,22 +32,99 @@ def create_vector_extension(engine: Engine):
         session.commit()
 
 
-@lru_cache
-def setting_engine() -> Engine:
+def create_columns(engine: Engine):
+    # create_all does not add the columns of models to existing tables, the
+    # ones added since are nullable or generated so they can be appended as
+    # they are
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in SQLModel.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            columns = {
+                column["name"] for column in inspector.get_columns(table.name)
+            }
+            for column in table.columns:
+                if column.name in columns:
+                    continue
+                # name, type and generation expression, if any
+                column_definition = CreateColumn(column).compile(
+                    dialect=engine.dialect
+                )
+                connection.execute(
+                    text(
+                        f'ALTER TABLE "{table.name}" '
+                        f"ADD COLUMN IF NOT EXISTS {column_definition}"
+                    )
+                )
+
+
+def create_indexes(engine: Engine):
+    # create_all only creates the indexes of the tables it creates
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
+def stage_ids(ids: Sequence[str], name: str = "staged_ids"):
+    """
+    Ids as a one-column derived table, sent as a single array parameter so
+    the statement stays the same size whatever the number of ids.
+    """
+    return (
+        func.unnest(bindparam(name, list(ids), type_=ARRAY(String)))
+        .table_valued("id")
+        .render_derived(name=name)
+    )
+
+
+def anti_join(column, other_column, *criteria) -> ColumnElement[bool]:
+    """NOT EXISTS predicate, true when no row of the table of column matches."""
+    return ~exists().where(column == other_column, *criteria)
+
+
+def get_connection_url() -> str:
     settings = get_settings()
-    connection = "postgresql+psycopg://{}:{}@{}:{}/{}".format(
+    return "postgresql+psycopg://{}:{}@{}:{}/{}".format(
         settings.db_user.get_secret_value(),
         settings.db_password.get_secret_value(),
         settings.db_host.get_secret_value(),
         settings.db_port.get_secret_value(),
         settings.db_name.get_secret_value(),
     )
-    engine = create_engine(connection)
+
+
+def get_pool_options() -> dict:
+    params = get_params()
+    return {
+        "pool_size": params.db_pool_size,
+        "max_overflow": params.db_max_overflow,
+        "pool_timeout": params.db_pool_timeout,
+        "pool_recycle": params.db_pool_recycle,
+        # connections dropped while idle in the pool are replaced
+        "pool_pre_ping": True,
+    }
+
+
+@lru_cache
+def setting_engine() -> Engine:
+    engine = create_engine(get_connection_url(), **get_pool_options())
     create_vector_extension(engine)
     SQLModel.metadata.create_all(engine)
+    create_columns(engine)
+    create_indexes(engine)
     return engine
 
 
+@lru_cache
+def setting_async_engine() -> AsyncEngine:
+    """
+    Engine on the async driver of psycopg, for serving queries from the
+    event loop. The schema is set up by setting_engine.
+    """
+    return create_async_engine(get_connection_url(), **get_pool_options())
+
+
 def get_session():
     engine = setting_engine()
     with Session(engine) as session:
@@ -1,10 +1,15 @@
+import re
 from datetime import datetime
+from enum import Enum
 from typing import Any
 
 from pgvector.sqlalchemy import Vector
+from sqlalchemy import ARRAY, Computed, Float, Index, Text, text
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlmodel import Column, Field, Relationship, SQLModel
 
 from ragtube.core.params import get_params
+from ragtube.core.utils import utc_now
 
 
 class Channel(SQLModel, table=True):
@@ -16,6 +21,14 @@ class Channel(SQLModel, table=True):
     )
 
 
+class ChannelSync(SQLModel, table=True):
+    channel_id: str = Field(
+        primary_key=True, foreign_key="channel.id", ondelete="CASCADE"
+    )
+    video_id: str
+    publish_time: datetime
+
+
 class Video(SQLModel, table=True):
     id: str = Field(primary_key=True)
     title: str
@@ -27,27 +40,166 @@ class Video(SQLModel, table=True):
     captions: list["Caption"] = Relationship(
         back_populates="video", cascade_delete=True
     )
+    caption_track: "CaptionTrack" = Relationship(
+        back_populates="video", cascade_delete=True
+    )
     chunks: list["Chunk"] = Relationship(
         back_populates="video", cascade_delete=True
     )
 
 
+class IngestionState(str, Enum):
+    pending = "pending"
+    fetched = "fetched"
+    failed = "failed"
+    unavailable = "unavailable"
+
+
+class IngestionJournal(SQLModel, table=True):
+    video_id: str = Field(primary_key=True)
+    title: str
+    publish_time: datetime
+    state: IngestionState = Field(default=IngestionState.pending, index=True)
+    reason: str | None = Field(default=None)
+    attempts: int = Field(default=0)
+    next_attempt_time: datetime | None = Field(default=None)
+    update_time: datetime = Field(default_factory=utc_now)
+
+    channel_id: str = Field(foreign_key="channel.id", ondelete="CASCADE")
+
+
 class Caption(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
     text: str
     start: float
     duration: float
 
-    video_id: str = Field(foreign_key="video.id", ondelete="CASCADE")
+    video_id: str = Field(
+        foreign_key="video.id", ondelete="CASCADE", index=True
+    )
     video: Video = Relationship(back_populates="captions")
 
 
+class CaptionTrack(SQLModel, table=True):
+    """All the captions of a video packed as parallel arrays."""
+
+    video_id: str = Field(
+        primary_key=True, foreign_key="video.id", ondelete="CASCADE"
+    )
+    starts: list[float] = Field(sa_column=Column(ARRAY(Float), nullable=False))
+    durations: list[float] = Field(
+        sa_column=Column(ARRAY(Float), nullable=False)
+    )
+    texts: list[str] = Field(sa_column=Column(ARRAY(Text), nullable=False))
+
+    video: Video = Relationship(back_populates="caption_track")
+
+
 class Chunk(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
     content: str
+    # span of the captions the chunk was cut from, in seconds
+    start: float | None = Field(default=None)
+    duration: float | None = Field(default=None)
     embedding: Any = Field(
         default=None, sa_column=Column(Vector(get_params().embedding_size))
     )
+    # embedding projected to fewer dimensions, see EmbeddingProjection
+    reduced_embedding: Any = Field(default=None, sa_column=Column(Vector()))
+    # chunks with the same normalized text share their embedding
+    content_hash: str | None = Field(default=None, index=True)
+    # configuration of the splitter and of the model that produced it
+    chunk_fingerprint: str | None = Field(default=None)
+    embedding_fingerprint: str | None = Field(default=None)
 
-    video_id: str = Field(foreign_key="video.id", ondelete="CASCADE")
+    video_id: str = Field(
+        foreign_key="video.id", ondelete="CASCADE", index=True
+    )
     video: Video = Relationship(back_populates="chunks")
+    # the channel of the video, the partition key of a partitioned table
+    channel_id: str | None = Field(default=None, index=True)
+
+    __table_args__ = (
+        # keeps the lookup of chunks left to embed proportional to them
+        Index(
+            "chunk_missing_embedding_index",
+            "id",
+            postgresql_where=text("embedding IS NULL"),
+        ),
+    )
+
+
+# name of a text search configuration, optionally schema qualified
+TEXT_SEARCH_CONFIG_PATTERN = re.compile(
+    r"^([a-z_][a-z0-9_]*\.)?[a-z_][a-z0-9_]*$"
+)
+
+
+def check_text_search_config(config: str) -> str:
+    # it is written into the DDL of the generated column, not bound
+    if not TEXT_SEARCH_CONFIG_PATTERN.match(config):
+        raise ValueError(f"Invalid text_search_config: {config}")
+    return config
+
+
+# lexemes of the content for full-text search, computed by Postgres on every
+# write of the chunks and left out of the model so they are never loaded
+Chunk.__table__.append_column(  # type: ignore
+    Column(
+        "content_tsv",
+        TSVECTOR,
+        Computed(
+            "to_tsvector("
+            f"'{check_text_search_config(get_params().text_search_config)}', "
+            "content)",
+            persisted=True,
+        ),
+    )
+)
+Index(
+    "chunk_content_tsv_index",
+    Chunk.__table__.c.content_tsv,  # type: ignore
+    postgresql_using="gin",
+)
+
+
+class EmbeddingProjection(SQLModel, table=True):
+    """
+    Linear projection of the embeddings to dim dimensions, fitted on the
+    corpus: (embedding - mean) @ components.T
+    """
+
+    id: int | None = Field(default=None, primary_key=True)
+    method: str
+    dim: int
+    embedding_fingerprint: str | None = Field(default=None)
+    mean: list[float] = Field(sa_column=Column(ARRAY(Float), nullable=False))
+    components: list[list[float]] = Field(
+        sa_column=Column(ARRAY(Float, dimensions=2), nullable=False)
+    )
+    fit_time: datetime = Field(default_factory=utc_now)
+
+
+class EmbeddingConfig(SQLModel, table=True):
+    """
+    Embedding model of the chunks: the live one, whose embeddings are
+    searched and queries are embedded with, or the one being migrated to,
+    whose embeddings are written to shadow columns until they are complete.
+    """
+
+    fingerprint: str = Field(primary_key=True)
+    model_name: str
+    num_ctx: int
+    backend: str = "ollama"
+    quantize: bool = False
+    dim: int
+    live: bool = False
+    create_time: datetime = Field(default_factory=utc_now)
+
+
+class CachedEmbedding(SQLModel, table=True):
+    # fingerprint of the model and its settings that computed the embedding
+    model_key: str = Field(primary_key=True)
+    text_hash: str = Field(primary_key=True)
+    embedding: Any = Field(sa_column=Column(Vector(), nullable=False))
+    last_used_time: datetime = Field(default_factory=utc_now, index=True)
@@ -12,21 +12,59 @@ class Params(BaseModel):
     channel_id: str | list[str]
     language: str = "en"
     request_timeout: int = 60
+    transcript_workers: int = 4
+    channel_workers: int = 4
+    ingest_commit_size: int = 20
+    ingest_retry_backoff: int = 3600
+    ingest_max_attempts: int = 5
+    caption_storage: str = "rows"
+    transcript_cache_dir: str | None = None
+    transcript_cache_max_size: int = 1024
+    youtube_api_rate: float = 10.0
+    transcript_rate: float = 2.0
+    throttle_cooldown: float = 30.0
     chunk_size: int = 500
     chunk_overlap: int = 50
+    chunk_workers: int = 4
+    chunk_batch_size: int = 5000
+    chunk_partitioning: bool = False
+    stream_batch_size: int = 1000
     embedding_size: int = 384
     embedding_model_name: str = "bge-large"
     embedding_num_ctx: int = 512
+    embedding_backend: str = "ollama"
+    embedding_threads: int | None = None
+    embedding_quantize: bool = False
+    embedding_batch_size: int = 32
+    embedding_concurrency: int = 4
+    embedding_max_retries: int = 3
+    embedding_cache: bool = True
+    embedding_projection_dim: int | None = None
+    embedding_projection_method: str = "pca"
+    embedding_projection_sample_size: int = 10000
     index_hnsm_m: int = 16
     index_hnsm_ef_construction: int = 64
     index_hnsm_ef_searh: int = 40
+    index_max_ef_search: int = 1000
+    index_iterative_scan: str = "off"
     index_vector_ops: str = "l2"
+    index_storage: str = "vector"
+    index_rescore_factor: int = 4
+    index_rescore: bool = True
     results_to_retrieve: int = 5
+    retriever_mode: str = "vector"
+    rrf_k: int = 60
+    text_search_config: str = "english"
+    collapse_duplicates: bool = False
     rerank_model_name: str = "rank-T5-flan"
     rerank_score_threshold: float = 0.1
     chat_model_name: str = "llama3.1:8b"
     chat_temperature: float = 0.0
     chat_max_tokens: int = 500
+    db_pool_size: int = 10
+    db_max_overflow: int = 20
+    db_pool_timeout: int = 30
+    db_pool_recycle: int = 1800
 
 
 @lru_cache
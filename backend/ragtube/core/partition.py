@@ -0,0 +1,161 @@
+from collections.abc import Sequence
+
+from pgvector.sqlalchemy import Vector
+from psycopg import sql
+from sqlalchemy import Column, MetaData, Table
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, text
+
+from ragtube.core.models import Chunk
+from ragtube.core.utils import fingerprint
+
+
+def get_partition_name(channel_id: str) -> str:
+    # channel ids are case sensitive and have dashes, not valid identifiers
+    return f"chunk_{fingerprint(channel_id=channel_id)}"
+
+
+def get_partition_table(channel_id: str) -> Table:
+    """The embedding columns of the chunk partition of a channel."""
+    return Table(
+        get_partition_name(channel_id),
+        MetaData(),
+        Column("embedding", Chunk.embedding.type),  # type: ignore
+        Column("reduced_embedding", Vector()),
+    )
+
+
+def get_partition_statement(
+    channel_id: str, table: str = "chunk"
+) -> sql.Composed:
+    return sql.SQL(
+        "CREATE TABLE {} PARTITION OF {} FOR VALUES IN ({})"
+    ).format(
+        sql.Identifier(get_partition_name(channel_id)),
+        sql.Identifier(table),
+        sql.Literal(channel_id),
+    )
+
+
+def is_partitioned(engine: Engine) -> bool:
+    with Session(engine) as session:
+        statement = text(
+            "SELECT EXISTS (SELECT FROM pg_partitioned_table "
+            "WHERE partrelid = to_regclass('chunk'))"
+        )
+        return session.connection().execute(statement).scalar_one()
+
+
+def create_partitions(
+    engine: Engine, channel_ids: Sequence[str] = ()
+) -> list[str]:
+    """
+    Create the chunk partitions of every channel and of channel_ids that do
+    not exist yet. Returns the names of the partitions created.
+    """
+    created = []
+    with Session(engine) as session:
+        connection = session.connection()
+        channel_ids = sorted(
+            {
+                *channel_ids,
+                *connection.execute(text("SELECT id FROM channel")).scalars(),
+            }
+        )
+        cursor = connection.connection.driver_connection.cursor()
+        for channel_id in channel_ids:
+            name = get_partition_name(channel_id)
+            exists = connection.execute(
+                text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name}
+            ).scalar_one()
+            if exists:
+                continue
+            cursor.execute(get_partition_statement(channel_id))
+            created.append(name)
+        session.commit()
+    return created
+
+
+def partition_chunks(engine: Engine) -> list[str]:
+    """
+    Move the chunks into a table list partitioned by channel_id, with one
+    partition per channel. The primary key of a partitioned table must hold
+    the partition key, so it becomes (id, channel_id). Runs in a single
+    transaction and returns the channels partitioned, none when chunks are
+    partitioned already. The b-tree indexes are created again by
+    create_indexes, the HNSW ones per partition by create_index.
+    """
+    if is_partitioned(engine):
+        return []
+    with Session(engine) as session:
+        connection = session.connection()
+        connection.execute(text("LOCK TABLE chunk IN ACCESS EXCLUSIVE MODE"))
+        connection.execute(
+            text(
+                """
+                UPDATE chunk SET channel_id = video.channel_id
+                FROM video
+                WHERE chunk.video_id = video.id AND chunk.channel_id IS NULL
+                """
+            )
+        )
+        connection.execute(
+            text(
+                """
+                CREATE TABLE chunk_partitioned (
+                    LIKE chunk
+                    INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING GENERATED
+                ) PARTITION BY LIST (channel_id)
+                """
+            )
+        )
+        connection.execute(
+            text(
+                "ALTER TABLE chunk_partitioned "
+                "ALTER COLUMN channel_id SET NOT NULL"
+            )
+        )
+        connection.execute(
+            text(
+                "ALTER TABLE chunk_partitioned "
+                "ADD PRIMARY KEY (id, channel_id)"
+            )
+        )
+        connection.execute(
+            text(
+                "ALTER TABLE chunk_partitioned ADD FOREIGN KEY (video_id) "
+                "REFERENCES video (id) ON DELETE CASCADE"
+            )
+        )
+        cursor = connection.connection.driver_connection.cursor()
+        channel_ids = list(
+            connection.execute(text("SELECT id FROM channel")).scalars()
+        )
+        for channel_id in channel_ids:
+            cursor.execute(
+                get_partition_statement(channel_id, "chunk_partitioned")
+            )
+        # generated columns are computed again, they can not be written
+        columns = sql.SQL(", ").join(
+            sql.Identifier(column.name)
+            for column in Chunk.__table__.columns  # type: ignore
+            if column.computed is None
+        )
+        cursor.execute(
+            sql.SQL(
+                "INSERT INTO chunk_partitioned ({}) SELECT {} FROM chunk"
+            ).format(columns, columns)
+        )
+        # the id sequence would be dropped with the table otherwise
+        sequence = connection.execute(
+            text("SELECT pg_get_serial_sequence('chunk', 'id')")
+        ).scalar_one()
+        connection.execute(
+            text(f"ALTER SEQUENCE {sequence} OWNED BY chunk_partitioned.id")
+        )
+        connection.execute(text("DROP TABLE chunk"))
+        connection.execute(
+            text("ALTER TABLE chunk_partitioned RENAME TO chunk")
+        )
+        session.commit()
+    return channel_ids
@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import Counter
+
+# how a request ended, as told to the limiter when it is released
+RELEASE_OUTCOMES = ["success", "throttled", "failed"]
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket limiting the request rate, combined with an AIMD limit on
+    the requests in flight: every success raises the limit by 1/limit,
+    i.e. by one per round of requests, and every throttling signal halves
+    it and pauses new requests for cooldown seconds. Other failures, e.g.
+    timeouts, leave the limit as it is.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        max_concurrency: int,
+        cooldown: float = 30.0,
+    ):
+        self.rate = rate
+        self.capacity = max(1.0, float(max_concurrency))
+        self.tokens = self.capacity
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.refill_time = time.monotonic()
+        self.condition = threading.Condition()
+
+    def refill(self, now: float) -> None:
+        elapsed = now - self.refill_time
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.refill_time = now
+
+    def acquire(self) -> None:
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    self.condition.wait(self.paused_until - now)
+                    continue
+                if self.in_flight >= int(self.concurrency):
+                    self.condition.wait()
+                    continue
+                self.refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return None
+                self.condition.wait((1 - self.tokens) / self.rate)
+
+    def release(self, outcome: str = "success") -> None:
+        if outcome not in RELEASE_OUTCOMES:
+            raise ValueError(f"Invalid release outcome: {outcome}")
+        with self.condition:
+            self.in_flight -= 1
+            if outcome == "throttled":
+                self.concurrency = max(1.0, self.concurrency / 2)
+                self.paused_until = time.monotonic() + self.cooldown
+            elif outcome == "success":
+                self.concurrency = min(
+                    float(self.max_concurrency),
+                    self.concurrency + 1 / self.concurrency,
+                )
+            self.condition.notify_all()
+
+
+class QuotaLedger:
+    """Requests, quota units and throttling signals per API, for a run."""
+
+    def __init__(self):
+        self.requests: Counter[str] = Counter()
+        self.units: Counter[str] = Counter()
+        self.throttled: Counter[str] = Counter()
+        self.lock = threading.Lock()
+
+    def record(self, name: str, units: int = 0, throttled: bool = False):
+        with self.lock:
+            self.requests[name] += 1
+            self.units[name] += units
+            if throttled:
+                self.throttled[name] += 1
+
+    def __str__(self) -> str:
+        lines = ["Quota ledger:"]
+        for name in sorted(self.requests):
+            lines.append(
+                f"  {name}: {self.requests[name]} requests, "
+                f"{self.units[name]} quota units, "
+                f"{self.throttled[name]} throttled"
+            )
+        if len(lines) == 1:
+            lines.append("  no requests")
+        return "\n".join(lines)
@@ -1,25 +1,65 @@
-import signal
+import hashlib
+import json
+import threading
+from datetime import UTC, datetime
 from functools import wraps
 
+WATCH_URL = "https://www.youtube.com/watch?v={video_id}"
+
+
+def utc_now() -> datetime:
+    # timestamps are stored as naive UTC, like YouTube publish times
+    return datetime.now(UTC).replace(tzinfo=None)
+
+
+def fingerprint(**config) -> str:
+    """Short stable hash of a configuration, tags the rows it produced."""
+    payload = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def get_watch_url(video_id: str, start: float | None = None) -> str:
+    url = WATCH_URL.format(video_id=video_id)
+    if start:
+        url += f"&t={int(start)}s"
+    return url
+
+
+def get_content_hash(content: str) -> str:
+    """Hash of a text ignoring case and whitespace, keys duplicate chunks."""
+    normalized = " ".join(content.lower().split())
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+def get_text_hash(text: str) -> str:
+    """Hash of the exact text, keys what a model is given to embed."""
+    return hashlib.sha256(text.encode()).hexdigest()
+
 
 def timeout_handler(seconds):
     def decorator(func):
-        def _handle_timeout(signum, frame):
-            raise TimeoutError(
-                f"Function '{func.__name__}' timed out after {seconds} seconds"
-            )
-
         @wraps(func)
         def wrapper(*args, **kwargs):
-            # Set the signal handler and a timeout alarm
-            signal.signal(signal.SIGALRM, _handle_timeout)
-            signal.alarm(seconds)
-            try:
-                result = func(*args, **kwargs)
-            finally:
-                # Disable the alarm
-                signal.alarm(0)
-            return result
+            # Run the function in a daemon thread and wait for it, unlike
+            # SIGALRM this works from any thread, not only the main one
+            outcome = {}
+
+            def target():
+                try:
+                    outcome["result"] = func(*args, **kwargs)
+                except BaseException as e:
+                    outcome["error"] = e
+
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            thread.join(seconds)
+            if thread.is_alive():
+                raise TimeoutError(
+                    f"Function '{func.__name__}' timed out after {seconds} seconds"
+                )
+            if "error" in outcome:
+                raise outcome["error"]
+            return outcome.get("result")
 
         return wrapper
 
@@ -0,0 +1,145 @@
+import contextlib
+import gzip
+import hashlib
+import json
+import os
+import pathlib
+import tarfile
+import tempfile
+import threading
+
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, col, select
+from tqdm import tqdm
+
+from ragtube.core.models import Caption, Video
+from ragtube.data.caption import read_captions
+
+
+class TranscriptCache:
+    """
+    On-disk transcript cache. Each transcript is a gzipped JSON file whose
+    name is the SHA-256 of its video id and language. Once the files add up
+    to more than max_size bytes, the least recently used ones are evicted.
+    """
+
+    def __init__(self, directory: str, max_size: int = 1024**3):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.size = sum(path.stat().st_size for path in self.get_paths())
+
+    def get_paths(self) -> list[pathlib.Path]:
+        return list(self.directory.glob("*/*.json.gz"))
+
+    def get_path(self, video_id: str, language: str) -> pathlib.Path:
+        key = hashlib.sha256(f"{video_id}:{language}".encode()).hexdigest()
+        return self.directory / key[:2] / f"{key}.json.gz"
+
+    def contains(self, video_id: str, language: str) -> bool:
+        return self.get_path(video_id, language).exists()
+
+    def get(self, video_id: str, language: str) -> list[Caption] | None:
+        path = self.get_path(video_id, language)
+        try:
+            data = json.loads(gzip.decompress(path.read_bytes()))
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        # bump the modification time, eviction goes by least recent use
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(path)
+        return [
+            Caption(
+                text=text, start=start, duration=duration, video_id=video_id
+            )
+            for text, start, duration in data["captions"]
+        ]
+
+    def put(
+        self, video_id: str, language: str, captions: list[Caption]
+    ) -> None:
+        path = self.get_path(video_id, language)
+        path.parent.mkdir(exist_ok=True)
+        data = gzip.compress(
+            json.dumps(
+                {
+                    "video_id": video_id,
+                    "language": language,
+                    "captions": [
+                        [caption.text, caption.start, caption.duration]
+                        for caption in captions
+                    ],
+                }
+            ).encode()
+        )
+        # write to a temporary file first so readers never see partial files
+        with tempfile.NamedTemporaryFile(
+            dir=path.parent, suffix=".tmp", delete=False
+        ) as file:
+            file.write(data)
+        previous_size = path.stat().st_size if path.exists() else 0
+        os.replace(file.name, path)
+        with self.lock:
+            self.size += len(data) - previous_size
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self) -> None:
+        # leave some headroom so that every put does not trigger a scan
+        target_size = int(self.max_size * 0.9)
+        paths = sorted(self.get_paths(), key=lambda path: path.stat().st_mtime)
+        for path in paths:
+            if self.size <= target_size:
+                break
+            size = path.stat().st_size
+            path.unlink(missing_ok=True)
+            self.size -= size
+            self.evictions += 1
+
+    def export(self, path: str) -> int:
+        """Archive the cached transcripts into a tar file at path."""
+        paths = self.get_paths()
+        with tarfile.open(path, "w") as archive:
+            for cache_path in paths:
+                archive.add(
+                    cache_path, arcname=cache_path.relative_to(self.directory)
+                )
+        return len(paths)
+
+    def __str__(self) -> str:
+        requests = self.hits + self.misses
+        hit_rate = self.hits / requests if requests else 0.0
+        return (
+            f"Transcript cache: {self.hits} hits, {self.misses} misses "
+            f"({hit_rate:.1%} hit rate), {self.evictions} evictions, "
+            f"{self.size / 1024**2:.1f}/{self.max_size / 1024**2:.0f} MB."
+        )
+
+
+def warm_transcript_cache(
+    engine: Engine, cache: TranscriptCache, language: str = "en"
+) -> int:
+    """
+    Copy into the cache the transcripts stored in the database that it does
+    not hold yet. Returns the number of transcripts added.
+    """
+    added = 0
+    with Session(engine) as session:
+        statement = select(Video.id).where(col(Video.content).is_not(None))
+        video_ids = session.exec(statement).all()
+        for video_id in tqdm(video_ids, desc="Cache", unit="video"):
+            if cache.contains(video_id, language):
+                continue
+            captions = read_captions(session, video_id)
+            if captions:
+                cache.put(video_id, language, captions)
+                added += 1
+    return added
@@ -0,0 +1,138 @@
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, col, select, text
+
+from ragtube.core.bulk import copy_rows
+from ragtube.core.models import Caption, CaptionTrack
+
+CAPTION_STORAGES = ["rows", "columnar"]
+
+
+def to_caption_track(video_id: str, captions: list[Caption]) -> CaptionTrack:
+    sorted_captions = sorted(captions, key=lambda x: x.start)
+    return CaptionTrack(
+        video_id=video_id,
+        starts=[caption.start for caption in sorted_captions],
+        durations=[caption.duration for caption in sorted_captions],
+        texts=[caption.text for caption in sorted_captions],
+    )
+
+
+def from_caption_track(caption_track: CaptionTrack) -> list[Caption]:
+    return [
+        Caption(
+            text=caption_text,
+            start=start,
+            duration=duration,
+            video_id=caption_track.video_id,
+        )
+        for caption_text, start, duration in zip(
+            caption_track.texts,
+            caption_track.starts,
+            caption_track.durations,
+        )
+    ]
+
+
+def write_captions(
+    session: Session, captions: list[Caption], storage: str = "rows"
+) -> None:
+    """
+    Write captions with COPY, either one caption row each or one caption
+    track per video. Their videos must already be flushed.
+    """
+    if storage not in CAPTION_STORAGES:
+        raise ValueError(f"Invalid caption storage: {storage}")
+    if storage == "rows":
+        copy_rows(
+            session,
+            Caption.__table__,  # type: ignore
+            ["text", "start", "duration", "video_id"],
+            (
+                (
+                    caption.text,
+                    caption.start,
+                    caption.duration,
+                    caption.video_id,
+                )
+                for caption in captions
+            ),
+        )
+        return None
+
+    video_captions: dict[str, list[Caption]] = {}
+    for caption in captions:
+        video_captions.setdefault(caption.video_id, []).append(caption)
+    caption_tracks = (
+        to_caption_track(video_id, captions)
+        for video_id, captions in video_captions.items()
+    )
+    copy_rows(
+        session,
+        CaptionTrack.__table__,  # type: ignore
+        ["video_id", "starts", "durations", "texts"],
+        (
+            (
+                caption_track.video_id,
+                caption_track.starts,
+                caption_track.durations,
+                caption_track.texts,
+            )
+            for caption_track in caption_tracks
+        ),
+    )
+
+
+def read_captions(session: Session, video_id: str) -> list[Caption]:
+    """Captions of a video sorted by start, whatever storage holds them."""
+    caption_track = session.get(CaptionTrack, video_id)
+    if caption_track is not None:
+        return from_caption_track(caption_track)
+    statement = (
+        select(Caption)
+        .where(col(Caption.video_id) == video_id)
+        .order_by(col(Caption.start))
+    )
+    return list(session.exec(statement).all())
+
+
+def migrate_captions(engine: Engine, batch_size: int = 100) -> int:
+    """
+    Pack the caption rows of every video into a caption track, batch_size
+    videos per transaction, deleting the rows once packed. Returns the
+    number of videos migrated.
+    """
+    migrated = 0
+    while True:
+        with Session(engine) as session:
+            connection = session.connection()
+            video_ids = list(
+                connection.execute(
+                    text("SELECT DISTINCT video_id FROM caption LIMIT :limit"),
+                    {"limit": batch_size},
+                ).scalars()
+            )
+            if not video_ids:
+                return migrated
+            connection.execute(
+                text(
+                    """
+                    INSERT INTO captiontrack (video_id, starts, durations, texts)
+                    SELECT
+                        video_id,
+                        array_agg(start ORDER BY start, id),
+                        array_agg(duration ORDER BY start, id),
+                        array_agg(text ORDER BY start, id)
+                    FROM caption
+                    WHERE video_id = ANY(:video_ids)
+                    GROUP BY video_id
+                    ON CONFLICT (video_id) DO NOTHING
+                    """
+                ),
+                {"video_ids": video_ids},
+            )
+            connection.execute(
+                text("DELETE FROM caption WHERE video_id = ANY(:video_ids)"),
+                {"video_ids": video_ids},
+            )
+            session.commit()
+        migrated += len(video_ids)
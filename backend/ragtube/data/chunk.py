@@ -1,66 +1,280 @@
+from bisect import bisect_right
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+
 from llama_index.core.node_parser import (
     TokenTextSplitter,
 )
+from sqlalchemy import update
 from sqlalchemy.engine import Engine
 from sqlmodel import Session, col, select
 from tqdm import tqdm
 
-from ragtube.core.models import Chunk, Video
+from ragtube.core.bulk import copy_rows
+from ragtube.core.database import anti_join
+from ragtube.core.models import Caption, Chunk, Video
+from ragtube.core.utils import fingerprint, get_content_hash
+from ragtube.data.caption import read_captions
+
+
+def get_caption_offsets(captions: list[Caption]) -> list[int]:
+    """
+    Offset of each caption in the video content, which joins the caption
+    texts sorted by start with a space.
+    """
+    offsets = []
+    offset = 0
+    for caption in captions:
+        offsets.append(offset)
+        offset += len(caption.text) + 1
+    return offsets
 
 
 def get_video_content_chunks(
-    splitter: TokenTextSplitter, video: Video
+    splitter: TokenTextSplitter,
+    video: Video,
+    captions: list[Caption] | None = None,
 ) -> list[Chunk]:
     if video.content is None:
         raise ValueError("Video content is empty.")
 
-    video_content_chunks = []
     content_chunks = splitter.split_text(video.content)
+    if captions:
+        captions = sorted(captions, key=lambda x: x.start)
+        offsets = get_caption_offsets(captions)
+        # the captions do not make up this content, timestamps are unknown
+        if offsets[-1] + len(captions[-1].text) != len(video.content):
+            captions = None
+
+    video_content_chunks = []
+    position = 0
     for chunk in content_chunks:
-        video_content_chunks.append(Chunk(content=chunk, video_id=video.id))
+        video_content_chunk = Chunk(content=chunk, video_id=video.id)
+        chunk_start = video.content.find(chunk, position) if captions else -1
+        if captions and chunk_start != -1:
+            # chunks come in order, so the search resumes right after the
+            # start of the previous one, which may overlap this one
+            position = chunk_start + 1
+            first = bisect_right(offsets, chunk_start) - 1
+            last = bisect_right(offsets, chunk_start + len(chunk) - 1) - 1
+            video_content_chunk.start = captions[first].start
+            video_content_chunk.duration = round(
+                captions[last].start
+                + captions[last].duration
+                - captions[first].start,
+                3,
+            )
+        video_content_chunks.append(video_content_chunk)
     return video_content_chunks
 
 
+# splitter of a chunking worker process, set up once by init_splitter
+splitter: TokenTextSplitter | None = None
+
+
+def init_splitter(chunk_size: int, chunk_overlap: int) -> None:
+    global splitter
+    splitter = TokenTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap
+    )
+
+
+def split_video_content(
+    video_id: str,
+    content: str,
+    captions: list[tuple[str, float, float]],
+) -> list[tuple[str, float | None, float | None, str]]:
+    """
+    Chunk a video in a worker process. Plain tuples go in and out, they are
+    cheaper to pickle than models.
+    """
+    assert splitter is not None, "init_splitter was not called"
+    video = Video(id=video_id, content=content)
+    video_content_chunks = get_video_content_chunks(
+        splitter,
+        video,
+        [
+            Caption(text=text, start=start, duration=duration)
+            for text, start, duration in captions
+        ],
+    )
+    return [
+        (chunk.content, chunk.start, chunk.duration, chunk.video_id)
+        for chunk in video_content_chunks
+    ]
+
+
+def get_chunk_fingerprint(chunk_size: int, chunk_overlap: int) -> str:
+    return fingerprint(
+        splitter="token", chunk_size=chunk_size, chunk_overlap=chunk_overlap
+    )
+
+
+def write_chunks(
+    session: Session,
+    rows: list[tuple[str, float | None, float | None, str, str]],
+    chunk_fingerprint: str | None = None,
+) -> int:
+    """
+    Write chunk rows of content, start, duration, video_id and channel_id
+    with COPY, inside the transaction of the session.
+    """
+    return copy_rows(
+        session,
+        Chunk.__table__,  # type: ignore
+        [
+            "content",
+            "start",
+            "duration",
+            "video_id",
+            "channel_id",
+            "content_hash",
+            "chunk_fingerprint",
+        ],
+        [(*row, get_content_hash(row[0]), chunk_fingerprint) for row in rows],
+    )
+
+
 class ChunkTask:
     def __init__(
-        self, engine: Engine, chunk_size: int = 500, chunk_overlap: int = 50
+        self,
+        engine: Engine,
+        chunk_size: int = 500,
+        chunk_overlap: int = 50,
+        workers: int = 1,
+        batch_size: int = 5000,
+        stream_batch_size: int = 1000,
     ):
         self.engine = engine
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
-        self.splitter = TokenTextSplitter(
-            chunk_size=self.chunk_size,
-            chunk_overlap=self.chunk_overlap,
-        )
+        self.workers = workers
+        self.batch_size = batch_size
+        self.stream_batch_size = stream_batch_size
+        self.fingerprint = get_chunk_fingerprint(chunk_size, chunk_overlap)
+
+    def stamp_chunks(self) -> None:
+        # chunks from before fingerprints are taken as cut with the current
+        # config, otherwise upgrading would re-chunk the whole corpus
+        with Session(self.engine) as session:
+            session.execute(
+                update(Chunk)
+                .where(col(Chunk.chunk_fingerprint).is_(None))
+                .values(chunk_fingerprint=self.fingerprint)
+                .execution_options(synchronize_session=False)
+            )
+            # and get the channel of their video, which retrieval filters on
+            session.execute(
+                update(Chunk)
+                .where(
+                    col(Chunk.channel_id).is_(None),
+                    col(Chunk.video_id) == Video.id,
+                )
+                .values(channel_id=Video.channel_id)
+                .execution_options(synchronize_session=False)
+            )
+            session.commit()
 
-    def get_missing_videos_content(self) -> list[Video] | None:
+    def iter_missing_videos_content(self) -> Iterator[list[Video]]:
+        """
+        Videos with content and no chunks cut with the current config,
+        read through a server-side cursor stream_batch_size videos at a time.
+        Their stale chunks are kept until the new ones are embedded.
+        """
         with Session(self.engine) as session:
             statement = (
                 select(Video)
-                .where(col(Video.content).is_not(None))
-                .join(Chunk, isouter=True)
-                .where(col(Chunk.id).is_(None))
+                .where(
+                    col(Video.content).is_not(None),
+                    anti_join(
+                        col(Chunk.video_id),
+                        col(Video.id),
+                        col(Chunk.chunk_fingerprint) == self.fingerprint,
+                    ),
+                )
+                .execution_options(yield_per=self.stream_batch_size)
             )
-            videos_content = session.exec(statement).all()
-        if not videos_content:
-            return None
-        return list(videos_content)
-
-    def get_videos_content_chunks(self, videos: list[Video]) -> list[Chunk]:
-        videos_content_chunks = []
-        for video_content in tqdm(videos, desc="Chunking"):
-            videos_content_chunks.extend(
-                get_video_content_chunks(self.splitter, video_content)
+            for videos_content in session.exec(statement).partitions():
+                # detach them so they can be released once processed
+                session.expunge_all()
+                yield list(videos_content)
+
+    def iter_videos_content_chunks(
+        self, videos: Iterable[Video]
+    ) -> Iterator[list[tuple[str, float | None, float | None, str, str]]]:
+        """
+        Chunk rows of each video, in order, with the channel of the video.
+        With more than one worker the videos are split in a process pool,
+        keeping at most two videos per worker in flight so that memory does
+        not grow with the corpus.
+        """
+        with Session(self.engine) as session:
+            jobs = (
+                (
+                    video.channel_id,
+                    (
+                        video.id,
+                        video.content,
+                        [
+                            (caption.text, caption.start, caption.duration)
+                            for caption in read_captions(session, video.id)
+                        ],
+                    ),
+                )
+                for video in tqdm(videos, desc="Chunking", unit="video")
             )
-        return videos_content_chunks
+            if self.workers <= 1:
+                init_splitter(self.chunk_size, self.chunk_overlap)
+                for channel_id, job in jobs:
+                    yield [
+                        (*row, channel_id) for row in split_video_content(*job)
+                    ]
+                return None
+
+            with ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=init_splitter,
+                initargs=(self.chunk_size, self.chunk_overlap),
+            ) as executor:
+                futures: deque[tuple[str, Future]] = deque()
+                for channel_id, job in jobs:
+                    futures.append(
+                        (
+                            channel_id,
+                            executor.submit(split_video_content, *job),
+                        )
+                    )
+                    if len(futures) >= 2 * self.workers:
+                        channel_id, future = futures.popleft()
+                        yield [(*row, channel_id) for row in future.result()]
+                while futures:
+                    channel_id, future = futures.popleft()
+                    yield [(*row, channel_id) for row in future.result()]
+
+    def write_chunks(
+        self,
+        session: Session,
+        rows: list[tuple[str, float | None, float | None, str, str]],
+    ):
+        write_chunks(session, rows, self.fingerprint)
+        session.commit()
 
     def launch(self):
-        missing_videos_content = self.get_missing_videos_content()
-        if not missing_videos_content:
-            return None
-        videos_content_chunks = self.get_videos_content_chunks(
-            missing_videos_content
+        self.stamp_chunks()
+        missing_videos_content = (
+            video_content
+            for videos_content in self.iter_missing_videos_content()
+            for video_content in videos_content
         )
+        # batches hold whole videos, a video is chunked once it has chunks
         with Session(self.engine) as session:
-            session.add_all(videos_content_chunks)
-            session.commit()
+            rows = []
+            for video_rows in self.iter_videos_content_chunks(
+                missing_videos_content
+            ):
+                rows.extend(video_rows)
+                if len(rows) >= self.batch_size:
+                    self.write_chunks(session, rows)
+                    rows = []
+            self.write_chunks(session, rows)
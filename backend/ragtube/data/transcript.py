@@ -1,34 +1,160 @@
 import logging
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from functools import lru_cache
 from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.models import HTTPError
+from sqlalchemy import and_, or_
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.engine import Engine
 from sqlmodel import Session, col, select
 from tqdm import tqdm
 from youtube_transcript_api import YouTubeTranscriptApi
-from youtube_transcript_api._errors import CouldNotRetrieveTranscript
+from youtube_transcript_api._errors import (
+    CouldNotRetrieveTranscript,
+    InvalidVideoId,
+    NoTranscriptFound,
+    RequestBlocked,
+    TranscriptsDisabled,
+    VideoUnavailable,
+    VideoUnplayable,
+    YouTubeRequestFailed,
+)
 from youtube_transcript_api.proxies import (
     GenericProxyConfig,
     WebshareProxyConfig,
 )
 
-from ragtube.core.models import Caption, Channel, Video
-from ragtube.core.utils import timeout_handler
+from ragtube.core.bulk import batched
+from ragtube.core.database import anti_join, stage_ids
+from ragtube.core.models import (
+    Caption,
+    Channel,
+    ChannelSync,
+    IngestionJournal,
+    IngestionState,
+    Video,
+)
+from ragtube.core.ratelimit import AdaptiveRateLimiter, QuotaLedger
+from ragtube.core.utils import WATCH_URL, timeout_handler, utc_now
+from ragtube.data.cache import TranscriptCache
+from ragtube.data.caption import CAPTION_STORAGES, write_captions
 
 YOUTUBE_API_URL = "https://www.googleapis.com/youtube/v3"
-WATCH_URL = "https://www.youtube.com/watch?v={video_id}"
+
+# quota units charged by the YouTube Data API per request
+YOUTUBE_API_QUOTA_COSTS = {"channels": 1, "playlistItems": 1}
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+# rows per INSERT of pending videos into the journal
+JOURNAL_BATCH_SIZE = 1000
+
+
+class EmptyTranscriptError(Exception):
+    pass
+
+
+# errors that will not go away by retrying later
+PERMANENT_TRANSCRIPT_ERRORS = (
+    EmptyTranscriptError,
+    InvalidVideoId,
+    NoTranscriptFound,
+    TranscriptsDisabled,
+    VideoUnavailable,
+    VideoUnplayable,
+)
+
+
+def is_throttled_response(response: requests.Response) -> bool:
+    if response.status_code == 429:
+        return True
+    if response.status_code != 403:
+        return False
+    try:
+        errors = response.json()["error"].get("errors", [])
+    except (ValueError, KeyError):
+        return False
+    return any(error.get("reason") in RATE_LIMIT_REASONS for error in errors)
+
+
+def is_throttled_error(error: Exception) -> bool:
+    if isinstance(error, RequestBlocked):
+        return True
+    return isinstance(error, YouTubeRequestFailed) and "429" in error.reason
+
+
+class YouTubeClient:
+    """YouTube Data API client sharing a pool of keep-alive connections."""
+
+    def __init__(
+        self,
+        api_key: str,
+        timeout: int = 5,
+        pool_size: int = 10,
+        limiter: AdaptiveRateLimiter | None = None,
+        ledger: QuotaLedger | None = None,
+        max_retries: int = 3,
+    ):
+        self.api_key = api_key
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        self.session.mount("https://", adapter)
+        self.limiter = limiter
+        self.ledger = ledger
+        self.max_retries = max_retries
+
+    def get(self, resource: str, params: dict) -> requests.Response:
+        url = f"{YOUTUBE_API_URL}/{resource}"
+        # throttled requests are retried once the limiter lets them through
+        for _ in range(self.max_retries):
+            if self.limiter is not None:
+                self.limiter.acquire()
+            outcome = "failed"
+            throttled = False
+            try:
+                response = self.session.get(
+                    url,
+                    params={**params, "key": self.api_key},
+                    timeout=self.timeout,
+                )
+                throttled = is_throttled_response(response)
+                outcome = "throttled" if throttled else "success"
+            finally:
+                if self.limiter is not None:
+                    self.limiter.release(outcome)
+            if self.ledger is not None:
+                self.ledger.record(
+                    f"youtube.{resource}",
+                    YOUTUBE_API_QUOTA_COSTS.get(resource, 1),
+                    throttled,
+                )
+            if not throttled:
+                break
+        return response
+
+
+@lru_cache
+def get_youtube_client(
+    api_key: str, timeout: int = 5, pool_size: int = 10
+) -> YouTubeClient:
+    return YouTubeClient(api_key, timeout, pool_size)
 
 
 def get_channel_metadata(
     channel_id: str,
     api_key: str,
     timeout: int = 5,
+    client: YouTubeClient | None = None,
 ) -> Channel:
-    params = {"part": "snippet", "id": channel_id, "key": api_key}
-    url = f"{YOUTUBE_API_URL}/channels"
-    response = requests.get(url, params=params, timeout=timeout)
+    client = client or get_youtube_client(api_key, timeout)
+    params = {"part": "snippet", "id": channel_id}
+    response = client.get("channels", params)
     response.raise_for_status()
     data = response.json()
     if "items" not in data:
@@ -41,24 +167,31 @@ def get_channel_videos(
     channel_id: str,
     api_key: str,
     timeout: int = 5,
+    client: YouTubeClient | None = None,
+    watermark: ChannelSync | None = None,
 ) -> list[Video]:
+    """
+    List the videos of the channel uploads playlist, newest first. When a
+    watermark is given, pagination stops at the page holding the first
+    already known video and only newer videos are returned.
+    """
+    client = client or get_youtube_client(api_key, timeout)
     # if it has a "Videos" playlist on the main page
     playlist_id = "UULF" + channel_id[2:]
     params = {
         "part": "snippet",
         "playlistId": playlist_id,
         "maxResults": 50,
-        "key": api_key,
     }
-    url = f"{YOUTUBE_API_URL}/playlistItems"
-    response = requests.get(url, params=params, timeout=timeout).json()
-    if "error" in response and response["error"]["status_code"] == 404:
+    response = client.get("playlistItems", params).json()
+    if "error" in response and response["error"].get("code") == 404:
         # if it has not a "Videos" playlist on the main page
         params["playlistId"] = "UU" + channel_id[2:]
+        response = client.get("playlistItems", params).json()
 
     videos = []
+    reached_watermark = False
     while True:
-        response = requests.get(url, params=params, timeout=timeout).json()
         if "error" in response:
             raise HTTPError("Unable to get video.", response["error"])
 
@@ -69,6 +202,12 @@ def get_channel_videos(
                 publish_time = datetime.fromisoformat(
                     item["snippet"]["publishedAt"]
                 ).replace(tzinfo=None)
+                if watermark is not None and (
+                    video_id == watermark.video_id
+                    or publish_time <= watermark.publish_time
+                ):
+                    reached_watermark = True
+                    continue
                 videos.append(
                     Video(
                         id=video_id,
@@ -79,11 +218,12 @@ def get_channel_videos(
                 )
 
         nextPageToken = response.get("nextPageToken")
-        if not nextPageToken:
+        if not nextPageToken or reached_watermark:
             break
         params["pageToken"] = nextPageToken
+        response = client.get("playlistItems", params).json()
 
-    if not videos:
+    if not videos and watermark is None:
         raise HTTPError("No videos found")
 
     return videos
@@ -106,47 +246,111 @@ def create_proxy_config(
     return GenericProxyConfig(**proxies)
 
 
-def get_video_captions(
+class TimeoutSession(requests.Session):
+    """Session giving every request a socket timeout unless one is passed."""
+
+    def __init__(self, timeout: float):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, *args, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(*args, **kwargs)
+
+
+def download_video_captions(
     video_id: str,
     language: str = "en",
     timeout: int = 5,
     proxies: dict | None = None,
-) -> list[Caption] | None:
-    @timeout_handler(timeout)
-    def _get_video_captions():
-        video_url = WATCH_URL.format(video_id=video_id)
-        error_message = (
-            f"\nCould not retrieve a transcript for the video {video_url}!"
-        )
+) -> list[Caption]:
+    # the socket timeout ends each of the few requests of a fetch, the
+    # thread timeout is only a backstop for the fetch as a whole
+    @timeout_handler(2 * timeout)
+    def _download_video_captions():
         proxy_config = None
         if proxies is not None:
             proxy_config = create_proxy_config(proxies)
 
-        client = YouTubeTranscriptApi(proxy_config=proxy_config)
-        try:
-            fetched_transcript = client.fetch(video_id, languages=[language])
-            captions = [
-                Caption(
-                    text=caption.text,
-                    start=caption.start,
-                    duration=caption.duration,
-                    video_id=video_id,
-                )
-                for caption in fetched_transcript.snippets
-            ]
-            return captions
-        except CouldNotRetrieveTranscript as e:
-            logging.error(f"{type(e).__name__}: {e.cause}.\n{error_message}")
-            return None
-        except Exception as e:
-            logging.error(f"{type(e).__name__}: {e.args[0]}.\n{error_message}")
-            return None
+        client = YouTubeTranscriptApi(
+            proxy_config=proxy_config, http_client=TimeoutSession(timeout)
+        )
+        fetched_transcript = client.fetch(video_id, languages=[language])
+        captions = [
+            Caption(
+                text=caption.text,
+                start=caption.start,
+                duration=caption.duration,
+                video_id=video_id,
+            )
+            for caption in fetched_transcript.snippets
+        ]
+        if not captions:
+            raise EmptyTranscriptError("The transcript has no captions")
+        return captions
+
+    return _download_video_captions()
+
+
+def fetch_video_captions(
+    video_id: str,
+    language: str = "en",
+    timeout: int = 5,
+    proxies: dict | None = None,
+    cache: TranscriptCache | None = None,
+    limiter: AdaptiveRateLimiter | None = None,
+    ledger: QuotaLedger | None = None,
+) -> list[Caption]:
+    if cache is not None:
+        cached_captions = cache.get(video_id, language)
+        if cached_captions is not None:
+            return cached_captions
+
+    if limiter is not None:
+        limiter.acquire()
+    outcome = "success"
+    throttled = False
+    try:
+        captions = download_video_captions(
+            video_id, language, timeout, proxies
+        )
+    except PERMANENT_TRANSCRIPT_ERRORS:
+        # the endpoint answered, the video just has no transcript
+        raise
+    except Exception as e:
+        throttled = is_throttled_error(e)
+        # timeouts and connection errors must not grow the concurrency
+        outcome = "throttled" if throttled else "failed"
+        raise
+    finally:
+        if limiter is not None:
+            limiter.release(outcome)
+        if ledger is not None:
+            ledger.record("transcripts", throttled=throttled)
 
-    return _get_video_captions()
+    if cache is not None:
+        cache.put(video_id, language, captions)
+    return captions
 
 
-def update_video_content(video: Video) -> None:
-    sorted_captions = sorted(video.captions, key=lambda x: x.start)
+def get_error_reason(error: Exception) -> str:
+    if isinstance(error, CouldNotRetrieveTranscript):
+        return f"{type(error).__name__}: {error.cause}"
+    if error.args:
+        return f"{type(error).__name__}: {error.args[0]}"
+    return type(error).__name__
+
+
+def log_transcript_error(video_id: str, error: Exception) -> None:
+    video_url = WATCH_URL.format(video_id=video_id)
+    logging.error(
+        f"{get_error_reason(error)}.\n"
+        f"\nCould not retrieve a transcript for the video {video_url}!"
+    )
+
+
+def update_video_content(video: Video, captions: list[Caption]) -> None:
+    sorted_captions = sorted(captions, key=lambda x: x.start)
     content = " ".join([caption.text for caption in sorted_captions])
     video.content = content
 
@@ -160,77 +364,308 @@ class VideoTranscriptTask:
         language: str = "en",
         timeout: int = 60,
         proxies: dict | None = None,
+        workers: int = 4,
+        channel_workers: int = 4,
+        full_sync: bool = False,
+        commit_size: int = 20,
+        retry_backoff: int = 3600,
+        max_attempts: int = 5,
+        caption_storage: str = "rows",
+        cache: TranscriptCache | None = None,
+        youtube_api_rate: float = 10.0,
+        transcript_rate: float = 2.0,
+        throttle_cooldown: float = 30.0,
     ):
+        if caption_storage not in CAPTION_STORAGES:
+            raise ValueError(f"Invalid caption storage: {caption_storage}")
         self.engine = engine
         self.channel_id = channel_id
         self.language = language
         self.timeout = timeout
         self.proxies = proxies
         self.api_key = api_key
+        self.workers = workers
+        self.channel_workers = channel_workers
+        self.full_sync = full_sync
+        self.commit_size = commit_size
+        self.retry_backoff = retry_backoff
+        self.max_attempts = max_attempts
+        self.caption_storage = caption_storage
+        self.cache = cache
+        self.ledger = QuotaLedger()
+        self.client = YouTubeClient(
+            api_key,
+            timeout,
+            pool_size=channel_workers,
+            limiter=AdaptiveRateLimiter(
+                youtube_api_rate, channel_workers, throttle_cooldown
+            ),
+            ledger=self.ledger,
+        )
+        self.transcript_limiter = AdaptiveRateLimiter(
+            transcript_rate, workers, throttle_cooldown
+        )
+
+    def get_channel(self, channel_id: str) -> Channel:
+        return get_channel_metadata(
+            channel_id, self.api_key, self.timeout, self.client
+        )
+
+    def get_watermark(self, channel_id: str) -> ChannelSync | None:
+        if self.full_sync:
+            return None
+        with Session(self.engine) as session:
+            return session.get(ChannelSync, channel_id)
+
+    def update_watermark(self, channel_id: str, videos: list[Video]):
+        if not videos:
+            return None
+        newest_video = max(videos, key=lambda video: video.publish_time)
+        with Session(self.engine) as session:
+            watermark = session.get(ChannelSync, channel_id)
+            if watermark is None:
+                watermark = ChannelSync(
+                    channel_id=channel_id,
+                    video_id=newest_video.id,
+                    publish_time=newest_video.publish_time,
+                )
+            elif newest_video.publish_time > watermark.publish_time:
+                watermark.video_id = newest_video.id
+                watermark.publish_time = newest_video.publish_time
+            session.add(watermark)
+            session.commit()
+
+    def get_settled_videos(self, videos: list[Video]) -> list[Video]:
+        """
+        The listed videos older than every one whose captions are still due.
+        The watermark must not move past those, the videos it passes are not
+        listed again.
+        """
+        staged_ids = stage_ids([video.id for video in videos])
+        with Session(self.engine) as session:
+            statement = select(IngestionJournal.video_id).where(
+                col(IngestionJournal.video_id).in_(select(staged_ids.c.id)),
+                col(IngestionJournal.state).in_(
+                    [IngestionState.pending, IngestionState.failed]
+                ),
+            )
+            unsettled_ids = set(session.exec(statement).all())
+        if not unsettled_ids:
+            return videos
+        oldest_unsettled_time = min(
+            video.publish_time for video in videos if video.id in unsettled_ids
+        )
+        return [
+            video
+            for video in videos
+            if video.publish_time < oldest_unsettled_time
+        ]
 
     def get_videos(self, channel_id: str) -> list[Video]:
         videos = get_channel_videos(
             channel_id,
             self.api_key,
             self.timeout,
+            self.client,
+            self.get_watermark(channel_id),
         )
         return videos
 
+    def get_channel_and_videos(
+        self, channel_id: str
+    ) -> tuple[Channel, list[Video]]:
+        return self.get_channel(channel_id), self.get_videos(channel_id)
+
     def get_missing_videos(
         self, channel_id: str, videos: list[Video]
     ) -> list[Video] | None:
-        video_ids = [video.id for video in videos]
+        staged_ids = stage_ids([video.id for video in videos])
         with Session(self.engine) as session:
-            statement = select(Video.id).where(
-                col(Video.channel_id) == channel_id,
-                col(Video.id).in_(video_ids),
+            statement = select(staged_ids.c.id).where(
+                anti_join(
+                    col(Video.id),
+                    staged_ids.c.id,
+                    col(Video.channel_id) == channel_id,
+                )
             )
-            video_ids_found = session.exec(statement).all()
-        if not video_ids_found:
-            return videos
-        if len(video_ids) == len(video_ids_found):
+            missing_video_ids = set(session.exec(statement).all())
+        if not missing_video_ids:
             return None
-        missing_videos: list[Video] = []
-        for video in videos:
-            if video.id not in video_ids_found:
-                missing_videos.append(video)
-        return missing_videos
-
-    def add_channel(self, channel_id: str):
-        channel = get_channel_metadata(channel_id, self.api_key, self.timeout)
+        return [video for video in videos if video.id in missing_video_ids]
+
+    def add_channel(self, channel: Channel):
         with Session(self.engine) as session:
             channel_from_db = session.get(Channel, channel.id)
             if not channel_from_db:
                 session.add(channel)
                 session.commit()
 
-    def add_videos_and_captions(self, videos: list[Video]):
+    def add_pending_videos(self, videos: list[Video]):
+        with Session(self.engine) as session:
+            # a statement takes at most 65535 parameters, 7 per video
+            for batch in batched(videos, JOURNAL_BATCH_SIZE):
+                statement = (
+                    insert(IngestionJournal)
+                    .values(
+                        [
+                            {
+                                "video_id": video.id,
+                                "channel_id": video.channel_id,
+                                "title": video.title,
+                                "publish_time": video.publish_time,
+                                "state": IngestionState.pending,
+                                "attempts": 0,
+                                "update_time": utc_now(),
+                            }
+                            for video in batch
+                        ]
+                    )
+                    .on_conflict_do_nothing()
+                )
+                session.connection().execute(statement)
+            session.commit()
+
+    def get_due_videos(self, channel_id: str) -> list[Video]:
         with Session(self.engine) as session:
-            for video in tqdm(videos, desc="Captions"):
-                captions = get_video_captions(
+            statement = select(IngestionJournal).where(
+                col(IngestionJournal.channel_id) == channel_id,
+                or_(
+                    col(IngestionJournal.state) == IngestionState.pending,
+                    and_(
+                        col(IngestionJournal.state) == IngestionState.failed,
+                        col(IngestionJournal.next_attempt_time) <= utc_now(),
+                    ),
+                ),
+            )
+            entries = session.exec(statement).all()
+        return [
+            Video(
+                id=entry.video_id,
+                title=entry.title,
+                publish_time=entry.publish_time,
+                channel_id=entry.channel_id,
+            )
+            for entry in entries
+        ]
+
+    def record_attempt(
+        self,
+        session: Session,
+        video: Video,
+        error: Exception | None = None,
+    ):
+        entry = session.get(IngestionJournal, video.id) or IngestionJournal(
+            video_id=video.id,
+            channel_id=video.channel_id,
+            title=video.title,
+            publish_time=video.publish_time,
+        )
+        entry.update_time = utc_now()
+        if error is None:
+            entry.state = IngestionState.fetched
+            entry.reason = None
+            entry.next_attempt_time = None
+        else:
+            entry.attempts += 1
+            entry.reason = get_error_reason(error)
+            if (
+                isinstance(error, PERMANENT_TRANSCRIPT_ERRORS)
+                or entry.attempts >= self.max_attempts
+            ):
+                entry.state = IngestionState.unavailable
+                entry.next_attempt_time = None
+            else:
+                entry.state = IngestionState.failed
+                entry.next_attempt_time = entry.update_time + timedelta(
+                    seconds=self.retry_backoff * 2 ** (entry.attempts - 1)
+                )
+        session.add(entry)
+
+    def write_captions(self, session: Session, captions: list[Caption]):
+        # videos must exist before their captions reference them
+        session.flush()
+        write_captions(session, captions, self.caption_storage)
+        session.commit()
+
+    def add_videos_and_captions(self, videos: list[Video]):
+        start_time = time.perf_counter()
+        pending_captions: list[Caption] = []
+        with (
+            Session(self.engine) as session,
+            ThreadPoolExecutor(max_workers=self.workers) as executor,
+        ):
+            futures = {
+                executor.submit(
+                    fetch_video_captions,
                     video.id,
                     self.language,
                     self.timeout,
                     self.proxies,
-                )
-                if captions:
-                    video.captions = captions
-                    session.add_all(captions)
-                    update_video_content(video)
+                    self.cache,
+                    self.transcript_limiter,
+                    self.ledger,
+                ): video
+                for video in videos
+            }
+            for i, future in enumerate(
+                tqdm(
+                    as_completed(futures),
+                    total=len(futures),
+                    desc="Captions",
+                    unit="video",
+                ),
+                start=1,
+            ):
+                video = futures[future]
+                try:
+                    captions = future.result()
+                except Exception as e:
+                    log_transcript_error(video.id, e)
+                    self.record_attempt(session, video, e)
+                else:
+                    update_video_content(video, captions)
                     session.add(video)
-            session.commit()
+                    pending_captions.extend(captions)
+                    self.record_attempt(session, video)
+                # checkpoint the journal and captions every few videos
+                if i % self.commit_size == 0:
+                    self.write_captions(session, pending_captions)
+                    pending_captions = []
+            self.write_captions(session, pending_captions)
+        elapsed = time.perf_counter() - start_time
+        logging.info(
+            f"Fetched captions of {len(videos)} videos in {elapsed:.1f}s "
+            f"({len(videos) / elapsed:.2f} videos/s)."
+        )
+        if self.cache is not None:
+            logging.info(str(self.cache))
 
-    def add_channel_videos_and_captions(self, channel_id: str):
-        self.add_channel(channel_id)
-        videos = self.get_videos(channel_id)
-        missing_videos = self.get_missing_videos(channel_id, videos)
-        if not missing_videos:
-            return None
-        self.add_videos_and_captions(missing_videos)
+    def add_channel_videos_and_captions(
+        self, channel: Channel, videos: list[Video]
+    ):
+        self.add_channel(channel)
+        missing_videos = self.get_missing_videos(channel.id, videos)
+        if missing_videos:
+            self.add_pending_videos(missing_videos)
+        due_videos = self.get_due_videos(channel.id)
+        if due_videos:
+            self.add_videos_and_captions(due_videos)
+        # up to the videos whose captions were fetched or are unavailable
+        self.update_watermark(channel.id, self.get_settled_videos(videos))
 
     def launch(self):
-        if isinstance(self.channel_id, str):
-            self.add_channel_videos_and_captions(self.channel_id)
-        elif isinstance(self.channel_id, list):
-            for channel_id in self.channel_id:
-                self.add_channel_videos_and_captions(channel_id)
+        channel_ids = (
+            [self.channel_id]
+            if isinstance(self.channel_id, str)
+            else self.channel_id
+        )
+        # list the channels concurrently, then ingest each one as soon as
+        # its playlist has been walked
+        with ThreadPoolExecutor(max_workers=self.channel_workers) as executor:
+            futures = [
+                executor.submit(self.get_channel_and_videos, channel_id)
+                for channel_id in channel_ids
+            ]
+            for future in as_completed(futures):
+                channel, videos = future.result()
+                self.add_channel_videos_and_captions(channel, videos)
@@ -0,0 +1,174 @@
+import asyncio
+import threading
+from collections.abc import Sequence
+from datetime import timedelta
+
+from langchain_core.embeddings import Embeddings
+from sqlalchemy import delete, or_, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, col, select
+
+from ragtube.core.database import stage_ids
+from ragtube.core.models import CachedEmbedding
+from ragtube.core.utils import get_text_hash, utc_now
+
+# precision of the last use of cached embeddings
+LAST_USED_RESOLUTION = timedelta(days=1)
+
+
+class EmbeddingCache:
+    """
+    Embeddings stored in Postgres, keyed by the fingerprint of the model
+    that computed them and the hash of the exact text the model was given.
+    """
+
+    def __init__(self, engine: Engine, model_key: str):
+        self.engine = engine
+        self.model_key = model_key
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, text_hashes: Sequence[str]) -> dict[str, list[float]]:
+        if not text_hashes:
+            return {}
+        staged_hashes = stage_ids(text_hashes, "staged_hashes")
+        with Session(self.engine) as session:
+            statement = select(
+                CachedEmbedding.text_hash,
+                CachedEmbedding.embedding,
+                CachedEmbedding.last_used_time,
+            ).where(
+                CachedEmbedding.model_key == self.model_key,
+                col(CachedEmbedding.text_hash).in_(select(staged_hashes.c.id)),
+            )
+            rows = session.exec(statement).all()
+            embeddings = {
+                text_hash: embedding for text_hash, embedding, _ in rows
+            }
+            # eviction goes by least recent use, in days, so a hit is only
+            # written back once a day and lookups are reads otherwise
+            touch_before = utc_now() - LAST_USED_RESOLUTION
+            touched_hashes = [
+                text_hash
+                for text_hash, _, last_used_time in rows
+                if last_used_time < touch_before
+            ]
+            if touched_hashes:
+                session.execute(
+                    update(CachedEmbedding)
+                    .where(
+                        CachedEmbedding.model_key == self.model_key,
+                        col(CachedEmbedding.text_hash).in_(touched_hashes),
+                    )
+                    .values(last_used_time=utc_now())
+                    .execution_options(synchronize_session=False)
+                )
+                session.commit()
+        with self.lock:
+            self.hits += len(embeddings)
+            self.misses += len(set(text_hashes)) - len(embeddings)
+        return embeddings
+
+    def put(self, embeddings: dict[str, list[float]]) -> None:
+        if not embeddings:
+            return None
+        with Session(self.engine) as session:
+            session.execute(
+                insert(CachedEmbedding)
+                .values(
+                    [
+                        {
+                            "model_key": self.model_key,
+                            "text_hash": text_hash,
+                            "embedding": embedding,
+                            "last_used_time": utc_now(),
+                        }
+                        for text_hash, embedding in embeddings.items()
+                    ]
+                )
+                .on_conflict_do_nothing()
+            )
+            session.commit()
+
+    def __str__(self) -> str:
+        requests = self.hits + self.misses
+        hit_rate = self.hits / requests if requests else 0.0
+        return (
+            f"Embedding cache: {self.hits} hits, {self.misses} misses "
+            f"({hit_rate:.1%} hit rate)."
+        )
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings model that looks texts up in the cache before computing,
+    keyed by the exact text, as the model would get it.
+    """
+
+    def __init__(self, model: Embeddings, cache: EmbeddingCache):
+        self.model = model
+        self.cache = cache
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        text_hashes = [get_text_hash(text) for text in texts]
+        embeddings = self.cache.get(text_hashes)
+        missing_texts = {
+            text_hash: text
+            for text_hash, text in zip(text_hashes, texts)
+            if text_hash not in embeddings
+        }
+        if missing_texts:
+            computed_embeddings = dict(
+                zip(
+                    missing_texts,
+                    self.model.embed_documents(list(missing_texts.values())),
+                )
+            )
+            self.cache.put(computed_embeddings)
+            embeddings.update(computed_embeddings)
+        return [embeddings[text_hash] for text_hash in text_hashes]
+
+    def embed_query(self, text: str) -> list[float]:
+        text_hash = get_text_hash(text)
+        embedding = self.cache.get([text_hash]).get(text_hash)
+        if embedding is None:
+            embedding = self.model.embed_query(text)
+            self.cache.put({text_hash: embedding})
+        return embedding
+
+    async def aembed_query(self, text: str) -> list[float]:
+        # the cache is read and written in a thread, the model is awaited
+        # on the event loop, it is the slow part
+        text_hash = get_text_hash(text)
+        embeddings = await asyncio.to_thread(self.cache.get, [text_hash])
+        embedding = embeddings.get(text_hash)
+        if embedding is None:
+            embedding = await self.model.aembed_query(text)
+            await asyncio.to_thread(self.cache.put, {text_hash: embedding})
+        return embedding
+
+
+def collect_embedding_cache(
+    engine: Engine,
+    model_keys: Sequence[str],
+    max_age: timedelta | None = None,
+) -> int:
+    """
+    Deletes the cached embeddings of models other than model_keys, and the
+    ones unused for longer than max_age. Returns the number deleted.
+    """
+    criteria = [col(CachedEmbedding.model_key).not_in(model_keys)]
+    if max_age is not None:
+        criteria.append(
+            col(CachedEmbedding.last_used_time) < utc_now() - max_age
+        )
+    with Session(engine) as session:
+        result = session.execute(
+            delete(CachedEmbedding)
+            .where(or_(*criteria))
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+    return result.rowcount  # type: ignore
@@ -1,45 +1,688 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.embeddings import Embeddings
 from langchain_ollama.embeddings import OllamaEmbeddings
-from sqlalchemy.engine import Engine
-from sqlmodel import Session, col, select
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import (
+    Column,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    column,
+    delete,
+    exists,
+    update,
+)
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import aliased
+from sqlmodel import Session, col, select, text
 from tqdm import tqdm
 
-from ragtube.core.models import Chunk
+from ragtube.core.bulk import batched, update_rows
+from ragtube.core.database import anti_join
+from ragtube.core.models import Chunk, EmbeddingConfig, EmbeddingProjection
+from ragtube.core.utils import fingerprint, get_content_hash
+from ragtube.services.cache import CachedEmbeddings, EmbeddingCache
+
+EMBEDDING_BACKENDS = ["ollama", "sentence-transformers"]
+# Hugging Face ids of the Ollama embedding models, for the
+# sentence-transformers backend
+SENTENCE_TRANSFORMERS_MODELS = {
+    "bge-large": "BAAI/bge-large-en-v1.5",
+    "bge-m3": "BAAI/bge-m3",
+    "nomic-embed-text": "nomic-ai/nomic-embed-text-v1.5",
+    "all-minilm": "sentence-transformers/all-MiniLM-L6-v2",
+    "mxbai-embed-large": "mixedbread-ai/mxbai-embed-large-v1",
+}
+# columns the embeddings of a new model are written to while the live ones
+# keep being searched, swapped in for them once complete
+SHADOW_EMBEDDING = "next_embedding"
+SHADOW_FINGERPRINT = "next_embedding_fingerprint"
+# of the HNSW indexes of the shadow embeddings, stripped when swapped in
+SHADOW_INDEX_SUFFIX = f"_{SHADOW_EMBEDDING}"
+
+
+class SentenceTransformerEmbeddings(Embeddings):
+    """
+    Embeddings computed in process on CPU, which saves the HTTP round trip
+    and the JSON encoding of every vector. With quantize the linear layers
+    run in int8, through PyTorch dynamic quantization.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        max_seq_length: int = 512,
+        threads: int | None = None,
+        quantize: bool = False,
+    ):
+        # imported here, torch takes seconds to load and only this uses it
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        if threads:
+            torch.set_num_threads(threads)
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.model.max_seq_length = max_seq_length
+        # the fast tokenizer can not be shared across threads, and the
+        # torch thread pool is sized for one call at a time
+        self.lock = threading.Lock()
+        if quantize:
+            self.model = torch.quantization.quantize_dynamic(
+                self.model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        # normalized like the vectors Ollama returns
+        with self.lock:
+            embeddings = self.model.encode(texts, normalize_embeddings=True)
+        return embeddings.tolist()
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+
+def get_sentence_transformers_model_name(model_name: str) -> str:
+    """Hugging Face id of model_name, which may be an Ollama one."""
+    if "/" in model_name:
+        return model_name
+    # Ollama names may come with a tag, e.g. bge-large:latest
+    name = model_name.split(":")[0]
+    if name not in SENTENCE_TRANSFORMERS_MODELS:
+        raise ValueError(
+            f"Unknown embedding model for the sentence-transformers backend: "
+            f"{model_name}, use a Hugging Face model id"
+        )
+    return SENTENCE_TRANSFORMERS_MODELS[name]
 
 
-def get_embedding_model(model_name: str = "bge-large", num_ctx: int = 512):
+def get_embedding_model(
+    model_name: str = "bge-large",
+    num_ctx: int = 512,
+    backend: str = "ollama",
+    threads: int | None = None,
+    quantize: bool = False,
+) -> Embeddings:
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Invalid embedding backend: {backend}")
+    if backend == "sentence-transformers":
+        return SentenceTransformerEmbeddings(
+            get_sentence_transformers_model_name(model_name),
+            num_ctx,
+            threads,
+            quantize,
+        )
     model = OllamaEmbeddings(model=model_name, num_ctx=num_ctx)
     return model
 
 
+def get_embedding_fingerprint(
+    model_name: str,
+    num_ctx: int,
+    backend: str = "ollama",
+    quantize: bool = False,
+) -> str:
+    if backend == "ollama":
+        # as before there were other backends, so no embedding goes stale
+        return fingerprint(model_name=model_name, num_ctx=num_ctx)
+    return fingerprint(
+        model_name=model_name,
+        num_ctx=num_ctx,
+        backend=backend,
+        quantize=quantize,
+    )
+
+
+def get_embedding_cache(
+    engine: Engine,
+    model_name: str = "bge-large",
+    num_ctx: int = 512,
+    backend: str = "ollama",
+    quantize: bool = False,
+) -> EmbeddingCache:
+    return EmbeddingCache(
+        engine,
+        get_embedding_fingerprint(model_name, num_ctx, backend, quantize),
+    )
+
+
+def get_embedding_config(
+    engine: Engine, embedding_fingerprint: str
+) -> EmbeddingConfig | None:
+    with Session(engine) as session:
+        return session.get(EmbeddingConfig, embedding_fingerprint)
+
+
+def get_live_embedding_config(engine: Engine) -> EmbeddingConfig | None:
+    """Embedding model of the searched embeddings, None before any run."""
+    with Session(engine) as session:
+        statement = select(EmbeddingConfig).where(
+            col(EmbeddingConfig.live).is_(True)
+        )
+        return session.exec(statement).first()
+
+
+def get_embedding_dim(connection: Connection) -> int | None:
+    """Dimension of the embedding column of the chunks, from its type."""
+    typmod = connection.execute(
+        text(
+            "SELECT atttypmod FROM pg_attribute "
+            "WHERE attrelid = to_regclass('chunk') AND attname = 'embedding'"
+        )
+    ).scalar_one_or_none()
+    if typmod is None or typmod < 0:
+        return None
+    return typmod
+
+
+def get_shadow_table(
+    table_name: str = "chunk", dim: int | None = None
+) -> Table:
+    """
+    The shadow columns of the chunks, or of a partition of them. They are
+    not part of the model, only there while a new model is migrated to.
+    """
+    return Table(
+        table_name,
+        MetaData(),
+        Column("id", Integer),
+        Column("content_hash", String),
+        Column(SHADOW_EMBEDDING, Vector(dim)),
+        Column(SHADOW_FINGERPRINT, String),
+    )
+
+
+def get_hnsw_index_names(connection: Connection) -> list[str]:
+    """HNSW indexes of the chunks and of their partitions."""
+    return list(
+        connection.execute(
+            text(
+                """
+                SELECT pg_class.relname
+                FROM pg_index
+                JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+                JOIN pg_am ON pg_am.oid = pg_class.relam
+                WHERE pg_am.amname = 'hnsw' AND pg_index.indrelid IN (
+                    SELECT relid FROM pg_partition_tree('chunk')
+                )
+                """
+            )
+        ).scalars()
+    )
+
+
 class EmbeddingTask:
     def __init__(
         self,
         engine: Engine,
         model_name: str = "bge-large",
         num_ctx: int = 512,
+        stream_batch_size: int = 1000,
+        chunk_fingerprint: str | None = None,
+        batch_size: int = 32,
+        concurrency: int = 4,
+        max_retries: int = 3,
+        cache: EmbeddingCache | None = None,
+        backend: str = "ollama",
+        threads: int | None = None,
+        quantize: bool = False,
+        dim: int | None = None,
     ):
         self.engine = engine
         self.model = get_embedding_model(
-            model_name=model_name, num_ctx=num_ctx
+            model_name=model_name,
+            num_ctx=num_ctx,
+            backend=backend,
+            threads=threads,
+            quantize=quantize,
+        )
+        if cache is not None:
+            self.model = CachedEmbeddings(self.model, cache)
+        self.cache = cache
+        self.stream_batch_size = stream_batch_size
+        self.fingerprint = get_embedding_fingerprint(
+            model_name, num_ctx, backend, quantize
         )
+        self.config = EmbeddingConfig(
+            fingerprint=self.fingerprint,
+            model_name=model_name,
+            num_ctx=num_ctx,
+            backend=backend,
+            quantize=quantize,
+            # the one of the embedding column of the model
+            dim=dim or Chunk.embedding.type.dim,  # type: ignore
+        )
+        # model of the searched embeddings, set when the task is prepared
+        self.live: EmbeddingConfig | None = None
+        # fingerprint of the current chunks, the others are being replaced
+        self.chunk_fingerprint = chunk_fingerprint
+        self.batch_size = batch_size
+        if backend == "sentence-transformers" and concurrency > 1:
+            # the model embeds one batch at a time on every thread already
+            logging.warning(
+                "embedding_concurrency is 1 with the sentence-transformers "
+                f"backend, ignoring {concurrency}"
+            )
+            concurrency = 1
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.embedded_chunks = 0
+        self.computed_embeddings = 0
+        self.elapsed_time = 0.0
+
+    def is_migrating(self) -> bool:
+        """Whether the embeddings go to the shadow columns."""
+        return (
+            self.live is not None and self.live.fingerprint != self.fingerprint
+        )
+
+    def prepare(self) -> None:
+        """
+        Registers the model of the embeddings in the chunks as the live one
+        on the first run. When the model is another one, adds the shadow
+        columns its embeddings are written to, dropping the ones of an
+        abandoned migration to a third model first.
+        """
+        with Session(self.engine) as session:
+            connection = session.connection()
+            configs = session.exec(select(EmbeddingConfig)).all()
+            live = next((config for config in configs if config.live), None)
+            if live is None:
+                # embeddings from before the registry are taken as computed
+                # with the current model, like their fingerprints
+                live = EmbeddingConfig.model_validate(
+                    self.config,
+                    update={
+                        "dim": get_embedding_dim(connection)
+                        or self.config.dim,
+                        "live": True,
+                    },
+                )
+                session.add(live)
+            migration = None
+            for config in configs:
+                if config.live:
+                    continue
+                if config.fingerprint == self.fingerprint:
+                    migration = config
+                    continue
+                connection.execute(
+                    text(
+                        f"ALTER TABLE chunk DROP COLUMN IF EXISTS "
+                        f"{SHADOW_EMBEDDING}, DROP COLUMN IF EXISTS "
+                        f"{SHADOW_FINGERPRINT}"
+                    )
+                )
+                session.delete(config)
+                logging.info(
+                    f"Dropped the embeddings of {config.model_name}, it is "
+                    "not the configured model anymore"
+                )
+            if live.fingerprint != self.fingerprint:
+                if migration is None:
+                    session.add(EmbeddingConfig.model_validate(self.config))
+                    logging.info(
+                        f"Migrating the embeddings from {live.model_name} to "
+                        f"{self.config.model_name}, searches use the former "
+                        "until the chunks are all embedded"
+                    )
+                connection.execute(
+                    text(
+                        f"ALTER TABLE chunk ADD COLUMN IF NOT EXISTS "
+                        f"{SHADOW_EMBEDDING} vector({self.config.dim}), "
+                        f"ADD COLUMN IF NOT EXISTS {SHADOW_FINGERPRINT} "
+                        "varchar"
+                    )
+                )
+                # keeps the lookup of chunks left to embed proportional to
+                # them, like chunk_missing_embedding_index
+                connection.execute(
+                    text(
+                        "CREATE INDEX IF NOT EXISTS "
+                        "chunk_missing_next_embedding_index ON chunk (id) "
+                        f"WHERE {SHADOW_EMBEDDING} IS NULL"
+                    )
+                )
+            session.commit()
+            session.refresh(live)
+        self.live = live
+
+    def stamp_chunks(self) -> None:
+        # embeddings from before fingerprints are taken as computed with the
+        # live model, otherwise upgrading would re-embed the whole corpus
+        assert self.live is not None
+        with Session(self.engine) as session:
+            session.execute(
+                update(Chunk)
+                .where(
+                    col(Chunk.embedding).is_not(None),
+                    col(Chunk.embedding_fingerprint).is_(None),
+                )
+                .values(embedding_fingerprint=self.live.fingerprint)
+                .execution_options(synchronize_session=False)
+            )
+            session.commit()
+
+    def get_missing_criteria(self) -> list:
+        """Criteria of the chunks to embed with the model."""
+        if self.is_migrating():
+            criteria = [column(SHADOW_EMBEDDING).is_(None)]
+        else:
+            criteria = [col(Chunk.embedding).is_(None)]
+        if self.chunk_fingerprint:
+            # stale chunks are not worth embedding, they are to be retired
+            criteria.append(
+                col(Chunk.chunk_fingerprint) == self.chunk_fingerprint
+            )
+        return criteria
+
+    def iter_missing_chunks(self) -> Iterator[list[Chunk]]:
+        """
+        Chunks without embedding, read through a server-side cursor
+        stream_batch_size chunks at a time. Chunks are grouped by video so
+        their stale chunks are retired soon after. While migrating, the
+        chunks without embedding of the model in the shadow column.
+        """
+        with Session(self.engine) as session:
+            statement = (
+                select(Chunk)
+                .where(*self.get_missing_criteria())
+                .order_by(col(Chunk.video_id), col(Chunk.id))
+                .execution_options(yield_per=self.stream_batch_size)
+            )
+            for chunks in session.exec(statement).partitions():
+                # detach them so they can be released once processed
+                session.expunge_all()
+                yield list(chunks)
 
-    def get_missing_chunks(self) -> list[Chunk] | None:
+    def is_migrated(self) -> bool:
+        """Whether the shadow embeddings are complete, ready to swap in."""
+        if not self.is_migrating():
+            return False
         with Session(self.engine) as session:
-            statement = select(Chunk).where(col(Chunk.embedding).is_(None))
-            chunks = session.exec(statement).all()
-        if not chunks:
-            return None
-        return list(chunks)
+            statement = select(Chunk.id).where(*self.get_missing_criteria())
+            return session.exec(statement.limit(1)).first() is None
+
+    def get_known_embeddings(self, content_hashes: list[str]) -> dict:
+        """Embeddings already computed by the model for these texts."""
+        embedding = col(Chunk.embedding)
+        embedding_fingerprint = col(Chunk.embedding_fingerprint)
+        if self.is_migrating():
+            embedding = column(SHADOW_EMBEDDING, Vector(self.config.dim))
+            embedding_fingerprint = column(SHADOW_FINGERPRINT)
+        with Session(self.engine) as session:
+            statement = (
+                select(Chunk.content_hash, embedding)
+                .where(
+                    col(Chunk.content_hash).in_(content_hashes),
+                    embedding.is_not(None),
+                    embedding_fingerprint == self.fingerprint,
+                )
+                .distinct(col(Chunk.content_hash))
+            )
+            return dict(session.exec(statement).all())  # type: ignore
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        """Embeds a batch of texts, retrying with exponential backoff."""
+        for attempt in range(self.max_retries):
+            try:
+                return self.model.embed_documents(texts)
+            except Exception as e:
+                delay = 2**attempt
+                logging.warning(
+                    f"Embedding a batch of {len(texts)} texts failed: {e}, "
+                    f"retrying in {delay} seconds"
+                )
+                time.sleep(delay)
+        return self.model.embed_documents(texts)
 
     def add_embeddings(self, chunks: list[Chunk]) -> None:
-        for chunk in tqdm(chunks, desc="Embeddings"):
-            chunk.embedding = self.model.embed_query(chunk.content)
+        # embed each text once and fan it out to the chunks sharing it
+        chunks_by_hash: dict[str, list[Chunk]] = defaultdict(list)
+        for chunk in chunks:
+            chunk.content_hash = chunk.content_hash or get_content_hash(
+                chunk.content
+            )
+            chunks_by_hash[chunk.content_hash].append(chunk)
+        embeddings = self.get_known_embeddings(list(chunks_by_hash))
+        missing_hashes = [
+            content_hash
+            for content_hash in chunks_by_hash
+            if content_hash not in embeddings
+        ]
+        # batches are embedded in one call each, at most concurrency at once
+        batches = list(batched(missing_hashes, self.batch_size))
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            batches_embeddings = executor.map(
+                self.embed_documents,
+                [
+                    [
+                        chunks_by_hash[content_hash][0].content
+                        for content_hash in batch
+                    ]
+                    for batch in batches
+                ],
+            )
+            for batch, batch_embeddings in tqdm(
+                zip(batches, batches_embeddings),
+                total=len(batches),
+                desc="Embeddings",
+                unit="batch",
+            ):
+                embeddings.update(zip(batch, batch_embeddings))
+        self.computed_embeddings += len(missing_hashes)
+        for content_hash, same_chunks in chunks_by_hash.items():
+            for chunk in same_chunks:
+                chunk.embedding = embeddings[content_hash]
+        self.embedded_chunks += len(chunks)
 
-    def launch(self):
-        chunks = self.get_missing_chunks()
-        if not chunks:
-            return None
+    def get_dedup_ratio(self) -> float:
+        """Share of the embedded chunks that did not need a model call."""
+        if not self.embedded_chunks:
+            return 0.0
+        return 1 - self.computed_embeddings / self.embedded_chunks
+
+    def get_rate(self) -> float:
+        """Embedded chunks per second."""
+        if not self.elapsed_time:
+            return 0.0
+        return self.embedded_chunks / self.elapsed_time
+
+    def __str__(self) -> str:
+        return (
+            f"Embedded {self.embedded_chunks} chunks "
+            f"({self.computed_embeddings} computed, "
+            f"dedup ratio {self.get_dedup_ratio():.1%}) "
+            f"at {self.get_rate():.1f} chunks/s"
+        )
+
+    def retire_stale_chunks(
+        self, session: Session, video_ids: list[str] | None = None
+    ) -> int:
+        """
+        Deletes the chunks cut with another config of the videos whose
+        current chunks are all embedded, until then they keep the videos
+        searchable. Of every video when video_ids is not set.
+        """
+        if not self.chunk_fingerprint:
+            return 0
+        current = aliased(Chunk)
+        criteria = [
+            col(Chunk.chunk_fingerprint).is_distinct_from(
+                self.chunk_fingerprint
+            ),
+            exists().where(
+                current.video_id == Chunk.video_id,
+                current.chunk_fingerprint == self.chunk_fingerprint,
+            ),
+            anti_join(
+                current.video_id,
+                Chunk.video_id,
+                current.chunk_fingerprint == self.chunk_fingerprint,
+                col(current.embedding).is_(None),
+            ),
+        ]
+        if video_ids is not None:
+            criteria.append(col(Chunk.video_id).in_(video_ids))
+        result = session.execute(
+            delete(Chunk)
+            .where(*criteria)
+            .execution_options(synchronize_session=False)
+        )
+        return result.rowcount  # type: ignore
+
+    def write_embeddings(self, session: Session, chunks: list[Chunk]):
+        """
+        Checkpoint: the embeddings of a batch are committed together, a
+        restart resumes from the chunks still missing theirs.
+        """
+        if self.is_migrating():
+            update_rows(
+                session,
+                get_shadow_table(dim=self.config.dim),
+                ["content_hash", SHADOW_EMBEDDING, SHADOW_FINGERPRINT],
+                [
+                    (
+                        chunk.id,
+                        chunk.content_hash,
+                        chunk.embedding,
+                        self.fingerprint,
+                    )
+                    for chunk in chunks
+                ],
+            )
+            # the live embeddings of the stale chunks are still searched
+            session.commit()
+            return
+        update_rows(
+            session,
+            Chunk.__table__,  # type: ignore
+            [
+                "embedding",
+                "reduced_embedding",
+                "content_hash",
+                "embedding_fingerprint",
+            ],
+            [
+                (
+                    chunk.id,
+                    chunk.embedding,
+                    # projected again from the new embedding
+                    None,
+                    chunk.content_hash,
+                    self.fingerprint,
+                )
+                for chunk in chunks
+            ],
+        )
+        # in the same transaction, so a video always has embedded chunks
+        retired = self.retire_stale_chunks(
+            session, list({chunk.video_id for chunk in chunks})
+        )
+        session.commit()
+        if retired:
+            logging.info(f"Retired {retired} stale chunks")
+
+    def swap_embeddings(self) -> None:
+        """
+        Swaps the shadow embeddings in for the live ones in one transaction,
+        along their HNSW indexes, which are to be built already. Searches
+        go from the old embeddings and indexes to the new ones at once. The
+        old embeddings are deleted after, with the stale chunks.
+        """
+        if not self.is_migrated():
+            raise ValueError("the shadow embeddings are not complete")
+        with Session(self.engine) as session:
+            connection = session.connection()
+            connection.execute(
+                text("LOCK TABLE chunk IN ACCESS EXCLUSIVE MODE")
+            )
+            index_names = get_hnsw_index_names(connection)
+            for index_name in index_names:
+                if not index_name.endswith(SHADOW_INDEX_SUFFIX):
+                    connection.execute(text(f'DROP INDEX "{index_name}"'))
+            connection.execute(
+                text("DROP INDEX IF EXISTS chunk_missing_embedding_index")
+            )
+            for column_name, new_column_name in [
+                ("embedding", "previous_embedding"),
+                ("embedding_fingerprint", "previous_embedding_fingerprint"),
+                ("reduced_embedding", "previous_reduced_embedding"),
+                (SHADOW_EMBEDDING, "embedding"),
+                (SHADOW_FINGERPRINT, "embedding_fingerprint"),
+            ]:
+                connection.execute(
+                    text(
+                        f"ALTER TABLE chunk RENAME COLUMN {column_name} "
+                        f"TO {new_column_name}"
+                    )
+                )
+            # the projection was fitted to the old embeddings
+            connection.execute(
+                text("ALTER TABLE chunk ADD COLUMN reduced_embedding vector")
+            )
+            connection.execute(delete(EmbeddingProjection))
+            for index_name in index_names:
+                if index_name.endswith(SHADOW_INDEX_SUFFIX):
+                    connection.execute(
+                        text(
+                            f'ALTER INDEX "{index_name}" RENAME TO '
+                            f'"{index_name.removesuffix(SHADOW_INDEX_SUFFIX)}"'
+                        )
+                    )
+            connection.execute(
+                text(
+                    "ALTER INDEX chunk_missing_next_embedding_index "
+                    "RENAME TO chunk_missing_embedding_index"
+                )
+            )
+            connection.execute(
+                update(EmbeddingConfig).values(
+                    live=col(EmbeddingConfig.fingerprint) == self.fingerprint
+                )
+            )
+            session.commit()
+        assert self.live is not None
+        logging.info(
+            f"Swapped the embeddings of {self.config.model_name} in for the "
+            f"ones of {self.live.model_name}"
+        )
         with Session(self.engine) as session:
-            self.add_embeddings(chunks)
-            session.add_all(chunks)
+            connection = session.connection()
+            connection.execute(
+                delete(EmbeddingConfig).where(
+                    col(EmbeddingConfig.live).is_(False)
+                )
+            )
+            retired = self.retire_stale_chunks(session)
+            connection.execute(
+                text(
+                    "ALTER TABLE chunk DROP COLUMN previous_embedding, "
+                    "DROP COLUMN previous_embedding_fingerprint, "
+                    "DROP COLUMN previous_reduced_embedding"
+                )
+            )
             session.commit()
+        if retired:
+            logging.info(f"Retired {retired} stale chunks")
+        self.live = get_live_embedding_config(self.engine)
+
+    def launch(self):
+        self.prepare()
+        self.stamp_chunks()
+        start_time = time.perf_counter()
+        with Session(self.engine) as session:
+            for chunks in self.iter_missing_chunks():
+                self.add_embeddings(chunks)
+                self.write_embeddings(session, chunks)
+                self.elapsed_time = time.perf_counter() - start_time
+                logging.info(
+                    f"Embedded {self.embedded_chunks} chunks, "
+                    f"{self.get_rate():.1f} chunks/s"
+                )
@@ -0,0 +1,294 @@
+import logging
+
+import numpy as np
+from sqlalchemy import delete, func, tablesample, update
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, col, select, text
+from tqdm import tqdm
+
+from ragtube.core.bulk import update_rows
+from ragtube.core.models import Chunk, EmbeddingProjection
+
+PROJECTION_METHODS = ["pca", "truncate"]
+# dimensions the recall report covers, besides the configured one
+REPORT_DIMS = [64, 128, 256, 512]
+# chunks whose id is a multiple of it are held out from the fit, the recall
+# is measured on them
+HOLDOUT_MODULUS = 10
+# chunks sampled per embedding needed, as some have none and the number of
+# chunks is an estimate
+SAMPLE_OVERSAMPLING = 2
+
+
+def fit_projection(
+    embeddings: np.ndarray, dim: int, method: str = "pca"
+) -> EmbeddingProjection:
+    """
+    PCA keeps the dim directions of most variance of the embeddings,
+    truncate keeps their first dim dimensions, for Matryoshka models.
+    """
+    if method not in PROJECTION_METHODS:
+        raise ValueError(f"Invalid projection method: {method}")
+    if method == "pca":
+        mean = embeddings.mean(axis=0)
+        _, _, components = np.linalg.svd(
+            embeddings - mean, full_matrices=False
+        )
+        components = components[:dim]
+    else:
+        mean = np.zeros(embeddings.shape[1])
+        components = np.eye(embeddings.shape[1])[:dim]
+    return EmbeddingProjection(
+        method=method,
+        dim=dim,
+        mean=mean.tolist(),
+        components=components.tolist(),
+    )
+
+
+def project_embeddings(
+    projection: EmbeddingProjection, embeddings: np.ndarray
+) -> np.ndarray:
+    projected = (embeddings - np.asarray(projection.mean)) @ np.asarray(
+        projection.components
+    ).T
+    if projection.method == "truncate":
+        # Matryoshka embeddings are renormalized once truncated
+        norms = np.linalg.norm(projected, axis=-1, keepdims=True)
+        projected = projected / np.where(norms == 0, 1, norms)
+    return projected
+
+
+def get_recall(
+    embeddings: np.ndarray, projected: np.ndarray, k: int = 10
+) -> float:
+    """
+    Mean recall@k of the l2 neighbors of every embedding among the others,
+    found in the projected space instead of the full one.
+    """
+    k = min(k, len(embeddings) - 1)
+    if k < 1:
+        return 1.0
+
+    def get_neighbors(vectors: np.ndarray) -> np.ndarray:
+        squared_norms = (vectors**2).sum(axis=1)
+        distances = (
+            squared_norms[:, None]
+            + squared_norms[None, :]
+            - 2 * vectors @ vectors.T
+        )
+        np.fill_diagonal(distances, np.inf)
+        return np.argsort(distances, axis=1)[:, :k]
+
+    exact = get_neighbors(embeddings)
+    approximate = get_neighbors(projected)
+    hits = [
+        len(set(exact_row) & set(approximate_row))
+        for exact_row, approximate_row in zip(exact, approximate)
+    ]
+    return sum(hits) / (len(hits) * k)
+
+
+def get_projection(
+    engine: Engine, projection_id: int | None = None
+) -> EmbeddingProjection | None:
+    with Session(engine) as session:
+        if projection_id is not None:
+            return session.get(EmbeddingProjection, projection_id)
+        return session.exec(select(EmbeddingProjection)).first()
+
+
+def get_projection_id(engine: Engine) -> int | None:
+    """Id of the projection, without loading its components."""
+    with Session(engine) as session:
+        return session.exec(select(EmbeddingProjection.id)).first()
+
+
+def estimate_chunks(session: Session) -> float:
+    """Number of chunks by the planner statistics, 0 before any ANALYZE."""
+    # of the partitions too, the parent of partitioned chunks has none
+    statement = text(
+        "SELECT sum(greatest(reltuples, 0)) FROM pg_class "
+        "WHERE oid IN (SELECT relid FROM pg_partition_tree('chunk'))"
+    )
+    return session.connection().execute(statement).scalar_one() or 0
+
+
+class ProjectionTask:
+    def __init__(
+        self,
+        engine: Engine,
+        dim: int = 256,
+        method: str = "pca",
+        sample_size: int = 10_000,
+        stream_batch_size: int = 1000,
+        recall_sample_size: int = 2000,
+        embedding_fingerprint: str | None = None,
+    ):
+        if method not in PROJECTION_METHODS:
+            raise ValueError(f"Invalid projection method: {method}")
+        self.engine = engine
+        self.dim = dim
+        self.method = method
+        self.sample_size = sample_size
+        self.stream_batch_size = stream_batch_size
+        self.recall_sample_size = recall_sample_size
+        # a projection is fitted to the embeddings of one model
+        self.embedding_fingerprint = embedding_fingerprint
+        self.recalls: dict[int, float] = {}
+
+    def get_sample(self, n: int, held_out: bool = False) -> np.ndarray:
+        """
+        Random embeddings of the chunks held out from the fit or not. Rows
+        are sampled with TABLESAMPLE BERNOULLI, sized from the estimated
+        number of chunks, instead of sorting every chunk at random.
+        """
+        with Session(self.engine) as session:
+            chunks = estimate_chunks(session)
+            # held out chunks are one in HOLDOUT_MODULUS
+            share = (
+                1 / HOLDOUT_MODULUS if held_out else 1 - 1 / HOLDOUT_MODULUS
+            )
+            percent = 100.0
+            if chunks:
+                percent = min(
+                    100.0, 100 * SAMPLE_OVERSAMPLING * n / (share * chunks)
+                )
+            sample = tablesample(
+                Chunk.__table__,  # type: ignore
+                func.bernoulli(percent),
+            )
+            is_held_out = sample.c.id % HOLDOUT_MODULUS == 0
+            statement = (
+                select(sample.c.embedding)
+                .where(
+                    sample.c.embedding.is_not(None),
+                    is_held_out if held_out else ~is_held_out,
+                )
+                .limit(n)
+            )
+            return np.array(
+                [list(embedding) for embedding in session.exec(statement)]
+            )
+
+    def fit(self) -> EmbeddingProjection | None:
+        """
+        Fits the projection on a sample of the embeddings, unless one with
+        the same method and dim exists for the same embedding model. A new
+        projection replaces the old one and clears the projected embeddings
+        in the same transaction.
+        """
+        projection = get_projection(self.engine)
+        if (
+            projection is not None
+            and projection.method == self.method
+            and projection.dim == self.dim
+            and projection.embedding_fingerprint == self.embedding_fingerprint
+        ):
+            return projection
+        embeddings = self.get_sample(self.sample_size)
+        if len(embeddings) < self.dim and self.method == "pca":
+            logging.info(
+                f"Not enough embeddings to fit a projection to {self.dim} "
+                f"dimensions: {len(embeddings)}"
+            )
+            return None
+        projection = fit_projection(embeddings, self.dim, self.method)
+        projection.embedding_fingerprint = self.embedding_fingerprint
+        with Session(self.engine) as session:
+            session.execute(delete(EmbeddingProjection))
+            session.execute(
+                update(Chunk)
+                .where(col(Chunk.reduced_embedding).is_not(None))
+                .values(reduced_embedding=None)
+                .execution_options(synchronize_session=False)
+            )
+            session.add(projection)
+            session.commit()
+            session.refresh(projection)
+        logging.info(f"Fitted a {self.method} projection to {self.dim} dims")
+        return projection
+
+    def evaluate(self, projection: EmbeddingProjection) -> dict[int, float]:
+        """
+        Recall@10 kept by the stored projection, and by projections to the
+        other REPORT_DIMS fitted for the report, over a sample of the chunks
+        held out from the fit.
+        """
+        embeddings = self.get_sample(self.recall_sample_size, held_out=True)
+        if not len(embeddings):
+            return {}
+        projections = {projection.dim: projection}
+        dims = [
+            dim
+            for dim in REPORT_DIMS
+            if dim < embeddings.shape[1] and dim != projection.dim
+        ]
+        fit_embeddings = self.get_sample(self.sample_size) if dims else []
+        if len(fit_embeddings) < max(dims, default=0) and self.method == "pca":
+            dims = []
+        if dims:
+            max_projection = fit_projection(
+                np.asarray(fit_embeddings), max(dims), self.method
+            )
+            for dim in dims:
+                projections[dim] = EmbeddingProjection(
+                    method=self.method,
+                    dim=dim,
+                    mean=max_projection.mean,
+                    components=max_projection.components[:dim],
+                )
+        for dim in sorted(projections):
+            self.recalls[dim] = get_recall(
+                embeddings, project_embeddings(projections[dim], embeddings)
+            )
+        return self.recalls
+
+    def project_chunks(self, projection: EmbeddingProjection) -> int:
+        """Projects the embeddings that are not projected yet."""
+        projected = 0
+        with Session(self.engine) as read_session:
+            statement = (
+                select(Chunk.id, Chunk.embedding)
+                .where(
+                    col(Chunk.embedding).is_not(None),
+                    col(Chunk.reduced_embedding).is_(None),
+                )
+                .execution_options(yield_per=self.stream_batch_size)
+            )
+            with Session(self.engine) as session:
+                for rows in tqdm(
+                    read_session.exec(statement).partitions(),
+                    desc="Projection",
+                    unit="batch",
+                ):
+                    ids = [id for id, _ in rows]
+                    embeddings = np.array(
+                        [list(embedding) for _, embedding in rows]
+                    )
+                    reduced_embeddings = project_embeddings(
+                        projection, embeddings
+                    )
+                    update_rows(
+                        session,
+                        Chunk.__table__,  # type: ignore
+                        ["reduced_embedding"],
+                        zip(ids, reduced_embeddings),
+                    )
+                    session.commit()
+                    projected += len(ids)
+        return projected
+
+    def launch(self):
+        projection = self.fit()
+        if projection is None:
+            return None
+        projected = self.project_chunks(projection)
+        logging.info(f"Projected {projected} embeddings")
+        self.evaluate(projection)
+
+    def __str__(self) -> str:
+        lines = [f"Recall@10 of the {self.method} projection:"]
+        for dim, recall in self.recalls.items():
+            lines.append(f"  {dim:>5} dims: {recall:.3f}")
+        return "\n".join(lines)
@@ -6,10 +6,18 @@ from langchain_core.language_models import LanguageModelLike
 from langchain_core.prompts import BasePromptTemplate
 from langchain_core.retrievers import BaseRetriever
 
-from ragtube.core.database import setting_engine
+from ragtube.core.database import setting_async_engine, setting_engine
+from ragtube.core.models import EmbeddingConfig
 from ragtube.core.params import get_params
+from ragtube.services.cache import CachedEmbeddings, EmbeddingCache
 from ragtube.services.chat import get_ollama_model
-from ragtube.services.embedding import get_embedding_model
+from ragtube.services.embedding import (
+    get_embedding_config,
+    get_embedding_fingerprint,
+    get_embedding_model,
+    get_live_embedding_config,
+)
+from ragtube.services.projection import get_projection, get_projection_id
 from ragtube.services.prompt import get_prompt
 from ragtube.services.rerank import get_rerank_retriever
 from ragtube.services.retriever import Retriever
@@ -25,21 +33,96 @@ def create_rag_chain(
     return chain
 
 
-@lru_cache
 def get_rag_chain(channel_id: str | None = None):
+    # read on every request, so that the chain embeds queries with the model
+    # of the searched embeddings once a new one is swapped in, and projects
+    # them with the projection fitted last
+    engine = setting_engine()
+    config = get_live_embedding_config(engine)
+    projection_id = (
+        get_projection_id(engine)
+        if get_params().index_storage == "reduced"
+        else None
+    )
+    return build_rag_chain(
+        channel_id, config.fingerprint if config else None, projection_id
+    )
+
+
+@lru_cache
+def build_rag_chain(
+    channel_id: str | None = None,
+    embedding_fingerprint: str | None = None,
+    projection_id: int | None = None,
+):
     params = get_params()
     chat_model = get_ollama_model(
         params.chat_model_name, params.chat_temperature, params.chat_max_tokens
     )
+    engine = setting_engine()
+    config = (
+        get_embedding_config(engine, embedding_fingerprint)
+        if embedding_fingerprint
+        else None
+    )
+    if config is None:
+        # nothing embedded yet, queries are embedded like the chunks will be
+        config = EmbeddingConfig(
+            fingerprint=get_embedding_fingerprint(
+                params.embedding_model_name,
+                params.embedding_num_ctx,
+                params.embedding_backend,
+                params.embedding_quantize,
+            ),
+            model_name=params.embedding_model_name,
+            num_ctx=params.embedding_num_ctx,
+            backend=params.embedding_backend,
+            quantize=params.embedding_quantize,
+            dim=params.embedding_size,
+        )
     embedding_model = get_embedding_model(
-        params.embedding_model_name,
-        params.embedding_num_ctx,
+        config.model_name,
+        config.num_ctx,
+        config.backend,
+        params.embedding_threads,
+        config.quantize,
     )
+    if params.embedding_cache:
+        embedding_model = CachedEmbeddings(
+            embedding_model, EmbeddingCache(engine, config.fingerprint)
+        )
+    index_storage = params.index_storage
+    projection = None
+    if index_storage == "reduced" and projection_id is not None:
+        projection = get_projection(engine, projection_id)
+    if index_storage == "reduced" and (
+        projection is None
+        or projection.embedding_fingerprint not in (None, config.fingerprint)
+    ):
+        # until one is fitted to the embeddings of a new model, they are
+        # searched in full
+        index_storage = "vector"
+        projection = None
     retriever = Retriever(
-        engine=setting_engine(),
+        engine=engine,
+        async_engine=setting_async_engine(),
         embedding_model=embedding_model,
         results_to_retrieve=params.results_to_retrieve,
         channel_id=channel_id,
+        collapse_duplicates=params.collapse_duplicates,
+        vector_ops=params.index_vector_ops,
+        index_storage=index_storage,
+        rescore_factor=params.index_rescore_factor,
+        rescore=params.index_rescore,
+        ef_search=params.index_hnsm_ef_searh,
+        max_ef_search=params.index_max_ef_search,
+        iterative_scan=params.index_iterative_scan,
+        partitioned=params.chunk_partitioning,
+        mode=params.retriever_mode,
+        rrf_k=params.rrf_k,
+        text_search_config=params.text_search_config,
+        projection=projection,
+        embedding_dim=config.dim,
     )
     rerank_retriever = get_rerank_retriever(
         retriever,
@@ -1,36 +1,195 @@
-from langchain_core.callbacks import CallbackManagerForRetrieverRun
+import asyncio
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import NamedTuple, TypeVar
+
+import numpy as np
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
 from langchain_core.documents import Document
 from langchain_core.embeddings import Embeddings
 from langchain_core.retrievers import BaseRetriever
-from sqlalchemy import Index
+from pgvector.sqlalchemy import BIT, HALFVEC, Vector
+from sqlalchemy import (
+    ColumnElement,
+    Index,
+    Select,
+    Table,
+    Text,
+    cast,
+    func,
+)
+from sqlalchemy.dialects.postgresql import REGCONFIG
 from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine
 from sqlmodel import (
     Session,
+    col,
     select,
     text,
 )
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from ragtube.core.models import Chunk, Video
+from ragtube.core.models import Chunk, EmbeddingProjection, Video
+from ragtube.core.utils import get_content_hash
+from ragtube.services.projection import project_embeddings
+
+T = TypeVar("T")
 
 VECTOR_OPS = ["l1", "l2", "cosine"]
+INDEX_STORAGES = ["vector", "halfvec", "binary", "reduced"]
+ITERATIVE_SCANS = ["off", "relaxed_order", "strict_order"]
+RETRIEVER_MODES = ["vector", "hybrid"]
+# hits fetched per result when identical ones are collapsed
+COLLAPSE_FETCH_FACTOR = 3
+# hits of each ranking fused per result in hybrid mode
+HYBRID_FETCH_FACTOR = 4
+SET_CONFIG = text("SELECT set_config(:name, :value, true)")
+# what documents are made of, selected instead of whole chunks
+HIT_COLUMNS = [
+    col(Chunk.id),
+    col(Chunk.content),
+    col(Chunk.start),
+    col(Chunk.content_hash),
+    col(Chunk.video_id),
+    col(Video.title),
+    col(Video.publish_time),
+]
+
+
+class Hit(NamedTuple):
+    """
+    A retrieved chunk. The score is its distance in vector search, its
+    rank in lexical search, and its fused score in hybrid search.
+    """
+
+    id: int
+    content: str
+    start: float | None
+    content_hash: str | None
+    video_id: str
+    title: str
+    publish_time: datetime
+    score: float
+
+
+def get_index_name(
+    storage: str = "vector",
+    reduced_dim: int | None = None,
+    table_name: str = "chunk",
+    column: str = "embedding",
+) -> str:
+    if storage == "vector":
+        name = f"{table_name}_index"
+    elif storage == "reduced":
+        name = f"{table_name}_reduced_{reduced_dim}_index"
+    else:
+        name = f"{table_name}_{storage}_index"
+    if column != "embedding":
+        # of the shadow embeddings, renamed when they are swapped in
+        name = f"{name}_{column}"
+    return name
+
+
+def get_index_expression(
+    storage: str = "vector",
+    reduced_dim: int | None = None,
+    table: Table | None = None,
+    column: str = "embedding",
+    dim: int | None = None,
+) -> ColumnElement:
+    """
+    Indexed form of the embeddings in column of table, the chunks if not
+    set: full vectors, half precision ones, one bit per dimension, or
+    projected to reduced_dim dimensions. dim is the one of the column type
+    if not set.
+    """
+    if table is None:
+        table = Chunk.__table__  # type: ignore
+    embedding = table.c[column]
+    dim = dim or embedding.type.dim
+    if storage == "halfvec":
+        return cast(embedding, HALFVEC(dim))
+    if storage == "binary":
+        return cast(func.binary_quantize(embedding), BIT(dim))
+    if storage == "reduced":
+        if reduced_dim is None:
+            raise ValueError("reduced index storage requires a projection")
+        return cast(table.c.reduced_embedding, Vector(reduced_dim))
+    return embedding
+
+
+def get_index_distance(
+    embedding: list[float],
+    vector_ops: str = "l2",
+    storage: str = "vector",
+    reduced_dim: int | None = None,
+    dim: int | None = None,
+) -> ColumnElement:
+    """
+    Distance to embedding in the indexed form, binary uses hamming. With
+    reduced storage, embedding must be projected already. dim is the one of
+    the embeddings, the one of the model if not set.
+    """
+    dim = dim or Chunk.embedding.type.dim  # type: ignore
+    expression = get_index_expression(storage, reduced_dim, dim=dim)
+    if storage == "halfvec":
+        return getattr(expression, f"{vector_ops}_distance")(
+            cast(embedding, HALFVEC(dim))
+        )
+    if storage == "binary":
+        return expression.hamming_distance(
+            func.binary_quantize(cast(embedding, Vector(dim)))
+        )
+    if storage == "reduced":
+        return getattr(expression, f"{vector_ops}_distance")(
+            cast(embedding, Vector(reduced_dim))
+        )
+    return getattr(expression, f"{vector_ops}_distance")(embedding)
 
 
-# TODO: ef_search
 def create_index(
     engine: Engine,
     m: int = 16,
     ef_construction: int = 64,
-    ef_search: int = 40,
     vector_ops: str = "l2",
+    storage: str = "vector",
+    reduced_dim: int | None = None,
+    table: Table | None = None,
+    column: str = "embedding",
+    dim: int | None = None,
 ):
+    """
+    HNSW index of the embeddings in column of table, the chunks if not set.
+    With partitioned chunks, table is a partition, each one has its own
+    index. dim is the one of the column type if not set.
+    """
     if vector_ops not in VECTOR_OPS:
         raise ValueError(f"Invalid vector_ops: {vector_ops}")
+    if storage not in INDEX_STORAGES:
+        raise ValueError(f"Invalid index storage: {storage}")
+    ops = {
+        "vector": f"vector_{vector_ops}_ops",
+        "halfvec": f"halfvec_{vector_ops}_ops",
+        "binary": "bit_hamming_ops",
+        "reduced": f"vector_{vector_ops}_ops",
+    }[storage]
     index = Index(
-        "chunk_index",
-        Chunk.embedding,
+        get_index_name(
+            storage,
+            reduced_dim,
+            table.name if table is not None else "chunk",
+            column,
+        ),
+        get_index_expression(storage, reduced_dim, table, column, dim).label(
+            "embedding"
+        ),
         postgresql_using="hnsw",
         postgresql_with={"m": m, "ef_construction": ef_construction},
-        postgresql_ops={"embedding": f"vector_{vector_ops}_ops"},
+        postgresql_ops={"embedding": ops},
     )
     index.create(engine, checkfirst=True)
 
@@ -43,16 +202,396 @@ def drop_index(engine: Engine, index_name: str):
         session.commit()
 
 
+def collapse_duplicate_chunks(chunks: Sequence[T], k: int) -> list[T]:
+    """
+    Closest k chunks keeping one chunk per normalized text, chunks or rows
+    with their content and content_hash.
+    """
+    seen = set()
+    collapsed = []
+    for chunk in chunks:
+        content_hash = chunk.content_hash or get_content_hash(chunk.content)
+        if content_hash in seen:
+            continue
+        seen.add(content_hash)
+        collapsed.append(chunk)
+        if len(collapsed) == k:
+            break
+    return collapsed
+
+
+def fuse_rankings(rankings: Sequence[Sequence[Hit]], k: int = 60) -> list[Hit]:
+    """
+    Reciprocal rank fusion: each hit scores the sum of 1 / (k + rank) over
+    the rankings it is in, rank starting at 1. Higher is better.
+    """
+    scores: dict[int, float] = {}
+    hits: dict[int, Hit] = {}
+    for ranking in rankings:
+        for rank, hit in enumerate(ranking, start=1):
+            scores[hit.id] = scores.get(hit.id, 0.0) + 1 / (k + rank)
+            hits.setdefault(hit.id, hit)
+    return sorted(
+        (
+            hits[chunk_id]._replace(score=score)
+            for chunk_id, score in scores.items()
+        ),
+        key=lambda hit: hit.score,
+        reverse=True,
+    )
+
+
 class Retriever(BaseRetriever):
     engine: Engine
+    # queries run on it from the event loop, when set
+    async_engine: AsyncEngine | None = None
     embedding_model: Embeddings
     vector_ops: str = "l2"
     results_to_retrieve: int = 5
     channel_id: str | None = None
+    collapse_duplicates: bool = False
+    index_storage: str = "vector"
+    # candidates fetched per result from a compact index, to rescore
+    rescore_factor: int = 4
+    # reduced storage only, the others are always rescored
+    rescore: bool = True
+    projection: EmbeddingProjection | None = None
+    # candidates the HNSW scan keeps, widened up to max_ef_search while
+    # channel filtered results come back short
+    ef_search: int = 40
+    max_ef_search: int = 1000
+    # pgvector >= 0.8.0 can keep scanning the index until filters are met
+    iterative_scan: str = "off"
+    # chunks partitioned by channel, a channel is scanned on its own index
+    partitioned: bool = False
+    # hybrid also runs a full-text search and fuses both rankings
+    mode: str = "vector"
+    rrf_k: int = 60
+    # the one the content_tsv column of the chunks is computed with
+    text_search_config: str = "english"
+    # of the live embeddings, the one of the model if not set
+    embedding_dim: int | None = None
 
     def model_post_init(self, __context):
         if self.vector_ops not in VECTOR_OPS:
             raise ValueError(f"Invalid vector_ops: {self.vector_ops}")
+        if self.index_storage not in INDEX_STORAGES:
+            raise ValueError(f"Invalid index storage: {self.index_storage}")
+        if self.index_storage == "reduced" and self.projection is None:
+            raise ValueError("reduced index storage requires a projection")
+        if self.iterative_scan not in ITERATIVE_SCANS:
+            raise ValueError(f"Invalid iterative scan: {self.iterative_scan}")
+        if self.mode not in RETRIEVER_MODES:
+            raise ValueError(f"Invalid retriever mode: {self.mode}")
+
+    def get_limit(self) -> int:
+        limit = self.results_to_retrieve
+        if self.collapse_duplicates:
+            limit *= COLLAPSE_FETCH_FACTOR
+        return limit
+
+    def is_rescored(self) -> bool:
+        return self.index_storage != "vector" and (
+            self.index_storage != "reduced" or self.rescore
+        )
+
+    def get_scan_limit(self, limit: int | None = None) -> int:
+        """Rows read from the HNSW index for limit results."""
+        limit = limit or self.get_limit()
+        if self.is_rescored():
+            return limit * self.rescore_factor
+        return limit
+
+    def cast_embedding(self, embedding: list[float]):
+        # the model of the live embeddings may not be the configured one
+        if self.embedding_dim is None:
+            return embedding
+        return cast(embedding, Vector(self.embedding_dim))
+
+    def get_statement(
+        self, embedding: list[float], limit: int | None = None
+    ) -> Select:
+        """
+        One query for the columns of the results and their distance, the
+        embeddings are compared in the database and never sent back.
+        """
+        limit = limit or self.get_limit()
+        distance = getattr(Chunk.embedding, f"{self.vector_ops}_distance")(
+            self.cast_embedding(embedding)
+        )
+
+        def select_hits(distance: ColumnElement) -> Select:
+            statement = (
+                select(*HIT_COLUMNS, distance.label("score"))
+                .join(Video)
+                # chunks waiting for their embedding are not searchable yet
+                .where(col(Chunk.embedding).is_not(None))
+            )
+            if self.channel_id:
+                # on the chunks, so that only the partition of the channel
+                # is scanned when they are partitioned
+                statement = statement.where(
+                    Chunk.channel_id == self.channel_id
+                )
+            return statement.order_by(distance).limit(limit)
+
+        if self.index_storage == "vector":
+            return select_hits(distance)
+
+        reduced_dim = None
+        index_embedding = embedding
+        if self.projection is not None and self.index_storage == "reduced":
+            # the query is projected like the chunks were
+            reduced_dim = self.projection.dim
+            index_embedding = project_embeddings(
+                self.projection, np.asarray(embedding)
+            ).tolist()
+        index_distance = get_index_distance(
+            index_embedding,
+            self.vector_ops,
+            self.index_storage,
+            reduced_dim,
+            self.embedding_dim,
+        )
+        if not self.is_rescored():
+            return select_hits(index_distance)
+
+        # candidates come from the compact index, then are rescored with
+        # the full vectors
+        candidates = (
+            select(col(Chunk.id))
+            .where(col(Chunk.embedding).is_not(None))
+            .order_by(index_distance)
+            .limit(self.get_scan_limit(limit))
+        )
+        if self.channel_id:
+            candidates = candidates.where(Chunk.channel_id == self.channel_id)
+        return select_hits(distance).where(
+            col(Chunk.id).in_(candidates.correlate(None))
+        )
+
+    def get_scan_settings(self, ef_search: int) -> list[dict[str, str]]:
+        """Settings of the HNSW scan, set for the current transaction only."""
+        settings = [{"name": "hnsw.ef_search", "value": str(ef_search)}]
+        if self.iterative_scan != "off":
+            settings.append(
+                {"name": "hnsw.iterative_scan", "value": self.iterative_scan}
+            )
+        return settings
+
+    def set_scan(self, session: Session, ef_search: int) -> None:
+        connection = session.connection()
+        for setting in self.get_scan_settings(ef_search):
+            connection.execute(SET_CONFIG, setting)
+
+    async def aset_scan(self, session: AsyncSession, ef_search: int) -> None:
+        connection = await session.connection()
+        for setting in self.get_scan_settings(ef_search):
+            await connection.execute(SET_CONFIG, setting)
+
+    def get_ef_search(self, limit: int) -> int:
+        # the scan can not return more rows than ef_search
+        return min(
+            max(self.ef_search, self.get_scan_limit(limit)), self.max_ef_search
+        )
+
+    def widen_scan(
+        self,
+        ef_search: int,
+        hits: list[Hit],
+        limit: int,
+        previous_hits: int | None = None,
+    ) -> int | None:
+        """
+        ef_search to scan again with when hits are short, or None. The scan
+        is not widened again when the last widening found no more hits, the
+        channel has fewer chunks than limit then.
+        """
+        # the channel filter runs after the scan, a small channel may have
+        # few of its chunks among the candidates
+        if (
+            not self.channel_id
+            or self.partitioned
+            or self.iterative_scan != "off"
+            or len(hits) >= limit
+            or ef_search >= self.max_ef_search
+            or (previous_hits is not None and len(hits) <= previous_hits)
+        ):
+            return None
+        return min(ef_search * 2, self.max_ef_search)
+
+    def sort_hits(self, hits: list[Hit]) -> list[Hit]:
+        if self.iterative_scan == "relaxed_order":
+            # the scan may return them slightly out of order
+            hits.sort(key=lambda hit: hit.score)
+        return hits
+
+    def get_lexical_statement(self, query: str, limit: int) -> Select:
+        """
+        Chunks matching any term of query, ranked by cover density so that
+        the ones with more of the terms, closer together, come first.
+        """
+        config = cast(self.text_search_config, REGCONFIG)
+        tsquery = func.to_tsquery(
+            config,
+            func.replace(
+                cast(func.plainto_tsquery(config, query), Text), "&", "|"
+            ),
+        )
+        content_tsv = Chunk.__table__.c.content_tsv  # type: ignore
+        rank = func.ts_rank_cd(content_tsv, tsquery)
+        statement = (
+            select(*HIT_COLUMNS, rank.label("score"))
+            .join(Video)
+            .where(
+                col(Chunk.embedding).is_not(None),
+                content_tsv.bool_op("@@")(tsquery),
+            )
+        )
+        if self.channel_id:
+            statement = statement.where(Chunk.channel_id == self.channel_id)
+        return statement.order_by(rank.desc()).limit(limit)
+
+    def search_vector(
+        self,
+        session: Session,
+        embedding: list[float],
+        limit: int | None = None,
+    ) -> list[Hit]:
+        limit = limit or self.get_limit()
+        statement = self.get_statement(embedding, limit)
+        ef_search: int | None = self.get_ef_search(limit)
+        hits: list[Hit] = []
+        previous_hits = None
+        while ef_search is not None:
+            self.set_scan(session, ef_search)
+            hits = [Hit(*row) for row in session.exec(statement)]
+            ef_search = self.widen_scan(ef_search, hits, limit, previous_hits)
+            previous_hits = len(hits)
+        return self.sort_hits(hits)
+
+    async def asearch_vector(
+        self,
+        session: AsyncSession,
+        embedding: list[float],
+        limit: int | None = None,
+    ) -> list[Hit]:
+        limit = limit or self.get_limit()
+        statement = self.get_statement(embedding, limit)
+        ef_search: int | None = self.get_ef_search(limit)
+        hits: list[Hit] = []
+        previous_hits = None
+        while ef_search is not None:
+            await self.aset_scan(session, ef_search)
+            hits = [Hit(*row) for row in await session.exec(statement)]
+            ef_search = self.widen_scan(ef_search, hits, limit, previous_hits)
+            previous_hits = len(hits)
+        return self.sort_hits(hits)
+
+    def search_lexical(
+        self, session: Session, query: str, limit: int | None = None
+    ) -> list[Hit]:
+        statement = self.get_lexical_statement(
+            query, limit or self.get_limit()
+        )
+        return [Hit(*row) for row in session.exec(statement)]
+
+    async def asearch_lexical(
+        self, session: AsyncSession, query: str, limit: int | None = None
+    ) -> list[Hit]:
+        statement = self.get_lexical_statement(
+            query, limit or self.get_limit()
+        )
+        return [Hit(*row) for row in await session.exec(statement)]
+
+    def collapse(self, hits: list[Hit]) -> list[Hit]:
+        if self.collapse_duplicates:
+            return collapse_duplicate_chunks(hits, self.results_to_retrieve)
+        return hits[: self.results_to_retrieve]
+
+    def search(self, session: Session, embedding: list[float]) -> list[Hit]:
+        return self.collapse(self.search_vector(session, embedding))
+
+    async def asearch(
+        self, session: AsyncSession, embedding: list[float]
+    ) -> list[Hit]:
+        return self.collapse(await self.asearch_vector(session, embedding))
+
+    def search_hybrid(
+        self,
+        session: Session,
+        query: str,
+        embedding: list[float] | None = None,
+    ) -> list[Hit]:
+        """
+        Fuse the vector and lexical rankings of query. The lexical search
+        runs on its own connection while the query is embedded and the
+        vector search runs on session.
+        """
+        limit = self.get_limit() * HYBRID_FETCH_FACTOR
+
+        def search_lexical() -> list[Hit]:
+            with Session(self.engine) as lexical_session:
+                return self.search_lexical(lexical_session, query, limit)
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            lexical_hits = executor.submit(search_lexical)
+            if embedding is None:
+                embedding = self.embedding_model.embed_query(query)
+            vector_hits = self.search_vector(session, embedding, limit)
+            hits = fuse_rankings(
+                [vector_hits, lexical_hits.result()], self.rrf_k
+            )
+        return self.collapse(hits)
+
+    async def asearch_hybrid(
+        self,
+        session: AsyncSession,
+        query: str,
+        embedding: list[float] | None = None,
+    ) -> list[Hit]:
+        """search_hybrid on the event loop, with the async engine."""
+        if self.async_engine is None:
+            raise ValueError("async search requires an async engine")
+        async_engine = self.async_engine
+        limit = self.get_limit() * HYBRID_FETCH_FACTOR
+
+        async def search_lexical() -> list[Hit]:
+            async with AsyncSession(async_engine) as lexical_session:
+                return await self.asearch_lexical(
+                    lexical_session, query, limit
+                )
+
+        async def search_vector() -> list[Hit]:
+            query_embedding = embedding
+            if query_embedding is None:
+                query_embedding = await self.embedding_model.aembed_query(
+                    query
+                )
+            return await self.asearch_vector(session, query_embedding, limit)
+
+        vector_hits, lexical_hits = await asyncio.gather(
+            search_vector(), search_lexical()
+        )
+        return self.collapse(
+            fuse_rankings([vector_hits, lexical_hits], self.rrf_k)
+        )
+
+    def get_documents(self, hits: list[Hit]) -> list[Document]:
+        return [
+            Document(
+                page_content=hit.content,
+                metadata={
+                    "id": hit.id,
+                    "video_id": hit.video_id,
+                    "title": hit.title,
+                    "publish_time": hit.publish_time,
+                    "start": hit.start,
+                    "score": hit.score,
+                },
+            )
+            for hit in hits
+        ]
 
     def _get_relevant_documents(
         self,
@@ -61,30 +600,28 @@ class Retriever(BaseRetriever):
         run_manager: CallbackManagerForRetrieverRun,
     ) -> list[Document]:
         with Session(self.engine) as session:
-            embedding = self.embedding_model.embed_query(query)
-            statement = select(Chunk)
-            if self.channel_id:
-                statement = statement.join(Video).where(
-                    Video.channel_id == self.channel_id
-                )
+            if self.mode == "hybrid":
+                hits = self.search_hybrid(session, query)
+            else:
+                embedding = self.embedding_model.embed_query(query)
+                hits = self.search(session, embedding)
+        return self.get_documents(hits)
 
-            vector_ops = f"{self.vector_ops}_distance"
-            distance_fn = getattr(Chunk.embedding, vector_ops)
-            statement = statement.order_by(distance_fn(embedding)).limit(
-                self.results_to_retrieve
+    async def _aget_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: AsyncCallbackManagerForRetrieverRun,
+    ) -> list[Document]:
+        # without an async engine, the sync path runs in a thread
+        if self.async_engine is None:
+            return await super()._aget_relevant_documents(
+                query, run_manager=run_manager
             )
-
-            docs_retrieved = session.exec(statement).all()
-            docs_retrieved = [
-                Document(
-                    page_content=doc.content,
-                    metadata={
-                        "id": doc.id,
-                        "video_id": doc.video.id,
-                        "title": doc.video.title,
-                        "publish_time": doc.video.publish_time,
-                    },
-                )
-                for doc in docs_retrieved
-            ]
-        return docs_retrieved
+        async with AsyncSession(self.async_engine) as session:
+            if self.mode == "hybrid":
+                hits = await self.asearch_hybrid(session, query)
+            else:
+                embedding = await self.embedding_model.aembed_query(query)
+                hits = await self.asearch(session, embedding)
+        return self.get_documents(hits)
@@ -5,7 +5,7 @@ import streamlit as st
 from ragtube.api.app import Document, RAGError, get_rag_response
 from ragtube.core.models import Channel
 from ragtube.core.settings import get_settings
-from ragtube.data.transcript import WATCH_URL
+from ragtube.core.utils import WATCH_URL
 
 settings = get_settings()
 
@@ -72,12 +72,14 @@ if prompt := st.chat_input():
                                 column_config={
                                     "video_id": st.column_config.LinkColumn(
                                         "video_id"
-                                    )
+                                    ),
+                                    "url": st.column_config.LinkColumn("url"),
                                 },
                                 hide_index=True,
                             )
                         st.video(
-                            WATCH_URL.format(video_id=response[0].video_id)
+                            WATCH_URL.format(video_id=response[0].video_id),
+                            start_time=int(response[0].start or 0),
                         )
                     case str():
                         yield response
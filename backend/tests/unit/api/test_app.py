@@ -168,6 +168,8 @@ def test_rag(client: TestClient):
                 "video_id": "Guy5D3PJlZk",
                 "title": "Agile Manifesto",
                 "publish_time": "2024-08-09T16:03:23",
+                "start": None,
+                "url": "https://www.youtube.com/watch?v=Guy5D3PJlZk",
                 "content": "I often make this joke which is agile's a lot like communism you know people just keep not trying it correctly um what is",
                 "relevance_score": 0.0,
             },
@@ -176,6 +178,8 @@ def test_rag(client: TestClient):
                 "video_id": "Guy5D3PJlZk",
                 "title": "Agile Manifesto",
                 "publish_time": "2024-08-09T16:03:23",
+                "start": None,
+                "url": "https://www.youtube.com/watch?v=Guy5D3PJlZk",
                 "content": "measurement to project an end date and tell everybody that's kind of it",
                 "relevance_score": 0.0,
             },
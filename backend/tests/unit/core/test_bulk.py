@@ -0,0 +1,92 @@
+from datetime import datetime
+
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
+
+from ragtube.core.bulk import batched, copy_rows, update_rows
+from ragtube.core.models import Channel, Chunk, Video
+
+
+def video():
+    return Video(
+        id="Guy5D3PJlZk",
+        title="Agile Manifesto",
+        publish_time=datetime(2024, 8, 9, 16, 3, 23),
+        channel_id="UC34rhn8Um7R18-BHjPklYlw",
+        channel=Channel(id="UC34rhn8Um7R18-BHjPklYlw", title="diego garrido"),
+    )
+
+
+def test_batched():
+    assert list(batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(batched([], 2)) == []
+
+
+def test_copy_rows(engine: Engine):
+    with Session(engine) as session:
+        session.add(video())
+        session.flush()
+        written = copy_rows(
+            session,
+            Chunk.__table__,  # type: ignore
+            ["content", "video_id"],
+            [
+                ("first chunk", "Guy5D3PJlZk"),
+                ("second chunk", "Guy5D3PJlZk"),
+                ("third chunk", "Guy5D3PJlZk"),
+            ],
+            batch_size=2,
+        )
+        session.commit()
+
+    assert written == 3
+    with Session(engine) as session:
+        chunks_from_db = session.exec(select(Chunk).order_by(Chunk.id)).all()
+        assert chunks_from_db == [
+            Chunk(id=1, content="first chunk", video_id="Guy5D3PJlZk"),
+            Chunk(id=2, content="second chunk", video_id="Guy5D3PJlZk"),
+            Chunk(id=3, content="third chunk", video_id="Guy5D3PJlZk"),
+        ]
+
+
+def test_update_rows(engine: Engine):
+    with Session(engine) as session:
+        session.add(video())
+        session.flush()
+        copy_rows(
+            session,
+            Chunk.__table__,  # type: ignore
+            ["content", "video_id"],
+            [
+                ("first chunk", "Guy5D3PJlZk"),
+                ("second chunk", "Guy5D3PJlZk"),
+                ("third chunk", "Guy5D3PJlZk"),
+            ],
+        )
+        session.commit()
+
+    with Session(engine) as session:
+        updated = update_rows(
+            session,
+            Chunk.__table__,  # type: ignore
+            ["embedding", "embedding_fingerprint"],
+            [(1, [0.5, -0.5], "bge-large"), (3, [1.0, 0.0], "bge-large")],
+            batch_size=1,
+        )
+        session.commit()
+
+    assert updated == 2
+    with Session(engine) as session:
+        chunks_from_db = session.exec(select(Chunk).order_by(Chunk.id)).all()
+        assert [
+            (
+                chunk.id,
+                None if chunk.embedding is None else list(chunk.embedding),
+                chunk.embedding_fingerprint,
+            )
+            for chunk in chunks_from_db
+        ] == [
+            (1, [0.5, -0.5], "bge-large"),
+            (2, None, None),
+            (3, [1.0, 0.0], "bge-large"),
+        ]
@@ -0,0 +1,39 @@
+from datetime import datetime
+
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, col, select
+
+from ragtube.core.database import anti_join, stage_ids
+from ragtube.core.models import Channel, Video
+
+
+def get_unseen_video_ids(engine: Engine, video_ids: list[str]) -> list[str]:
+    staged_ids = stage_ids(video_ids)
+    with Session(engine) as session:
+        statement = select(staged_ids.c.id).where(
+            anti_join(col(Video.id), staged_ids.c.id)
+        )
+        return sorted(session.exec(statement).all())
+
+
+def test_anti_join(engine: Engine):
+    with Session(engine) as session:
+        channel = Channel(id="UC34rhn8Um7R18-BHjPklYlw", title="diego")
+        session.add_all(
+            [
+                Video(
+                    id=video_id,
+                    title=video_id,
+                    publish_time=datetime(2024, 8, 9, 16, 3, 23),
+                    channel=channel,
+                )
+                for video_id in ["seen-1", "seen-2"]
+            ]
+        )
+        session.commit()
+
+    assert get_unseen_video_ids(
+        engine, ["seen-1", "unseen-1", "seen-2", "unseen-2"]
+    ) == ["unseen-1", "unseen-2"]
+    assert get_unseen_video_ids(engine, ["seen-1", "seen-2"]) == []
+    assert get_unseen_video_ids(engine, []) == []
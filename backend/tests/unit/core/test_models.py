@@ -0,0 +1,12 @@
+import pytest
+
+from ragtube.core.models import check_text_search_config
+
+
+def test_check_text_search_config():
+    assert check_text_search_config("english") == "english"
+    assert check_text_search_config("public.my_config") == "public.my_config"
+    with pytest.raises(ValueError):
+        check_text_search_config("english', content) || ('")
+    with pytest.raises(ValueError):
+        check_text_search_config("English")
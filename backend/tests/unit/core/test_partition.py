@@ -0,0 +1,102 @@
+from datetime import datetime
+
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, col, select, text
+
+from ragtube.core.database import create_indexes
+from ragtube.core.models import Channel, Chunk, Video
+from ragtube.core.partition import (
+    create_partitions,
+    get_partition_name,
+    get_partition_table,
+    is_partitioned,
+    partition_chunks,
+)
+from ragtube.services.retriever import Retriever, create_index, get_index_name
+
+
+def create_chunk_table(engine: Engine):
+    embedding_model = DeterministicFakeEmbedding(size=2)
+    with Session(engine) as session:
+        for channel_id, video_id in [("a", "video-a"), ("b", "video-b")]:
+            video = Video(
+                id=video_id,
+                title=video_id,
+                publish_time=datetime(2024, 8, 9, 16, 3, 23),
+                channel=Channel(id=channel_id, title=channel_id),
+            )
+            session.add_all(
+                [
+                    Chunk(
+                        content=f"chunk {i} of {video_id}",
+                        embedding=embedding_model.embed_query(
+                            f"chunk {i} of {video_id}"
+                        ),
+                        # chunks from before the channel was kept
+                        channel_id=None,
+                        video=video,
+                    )
+                    for i in range(3)
+                ]
+            )
+        session.commit()
+
+
+def test_partition_chunks(engine: Engine):
+    create_chunk_table(engine)
+    assert not is_partitioned(engine)
+
+    assert partition_chunks(engine) == ["a", "b"]
+    create_indexes(engine)
+    assert is_partitioned(engine)
+    assert partition_chunks(engine) == []
+
+    with Session(engine) as session:
+        chunks = session.exec(select(Chunk).order_by(col(Chunk.id))).all()
+        assert [chunk.id for chunk in chunks] == [1, 2, 3, 4, 5, 6]
+        assert [chunk.channel_id for chunk in chunks] == ["a"] * 3 + ["b"] * 3
+        # the id sequence carries on
+        session.add(Chunk(content="new", video_id="video-a", channel_id="a"))
+        session.commit()
+        count = session.connection().execute(
+            text(
+                "SELECT count(*) FROM chunk "
+                "WHERE tableoid = to_regclass(:name)"
+            ),
+            {"name": get_partition_name("a")},
+        )
+        assert count.scalar_one() == 4
+
+    assert create_partitions(engine, ["a", "c"]) == [get_partition_name("c")]
+
+
+def test_partitioned_retriever(engine: Engine):
+    create_chunk_table(engine)
+    partition_chunks(engine)
+    for channel_id in ["a", "b"]:
+        create_index(engine, table=get_partition_table(channel_id))
+
+    embedding_model = DeterministicFakeEmbedding(size=2)
+    query = "chunk 0 of video-b"
+    retriever = Retriever(
+        engine=engine, embedding_model=embedding_model, results_to_retrieve=2
+    )
+    docs = retriever.invoke(query)
+    assert docs[0].metadata["id"] == 4
+
+    retriever = Retriever(
+        engine=engine,
+        embedding_model=embedding_model,
+        results_to_retrieve=2,
+        channel_id="a",
+    )
+    docs = retriever.invoke(query)
+    assert [doc.metadata["video_id"] for doc in docs] == ["video-a"] * 2
+
+    with Session(engine) as session:
+        index = session.connection().execute(
+            text("SELECT to_regclass(:name) IS NOT NULL"),
+            {"name": get_index_name(table_name=get_partition_name("b"))},
+        )
+        assert index.scalar_one()
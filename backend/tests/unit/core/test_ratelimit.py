@@ -0,0 +1,53 @@
+import time
+
+from ragtube.core.ratelimit import AdaptiveRateLimiter, QuotaLedger
+
+
+def test_adaptive_rate_limiter_rate():
+    limiter = AdaptiveRateLimiter(rate=10.0, max_concurrency=1)
+
+    start_time = time.monotonic()
+    for _ in range(6):
+        limiter.acquire()
+        limiter.release()
+    # the first request spends the single token of the bucket
+    assert time.monotonic() - start_time >= 0.45
+
+
+def test_adaptive_rate_limiter_aimd():
+    limiter = AdaptiveRateLimiter(rate=100.0, max_concurrency=8, cooldown=0.2)
+
+    limiter.acquire()
+    limiter.release("throttled")
+    assert limiter.concurrency == 4.0
+    assert limiter.paused_until > time.monotonic()
+
+    start_time = time.monotonic()
+    limiter.acquire()
+    assert time.monotonic() - start_time >= 0.15
+    limiter.release()
+    assert limiter.concurrency == 4.25
+
+    limiter.acquire()
+    limiter.release("failed")
+    assert limiter.concurrency == 4.25
+
+    for _ in range(100):
+        limiter.acquire()
+        limiter.release()
+    assert limiter.concurrency == 8.0
+
+
+def test_quota_ledger():
+    ledger = QuotaLedger()
+    ledger.record("youtube.playlistItems", 1)
+    ledger.record("youtube.playlistItems", 1, throttled=True)
+    ledger.record("transcripts")
+
+    assert str(ledger) == "\n".join(
+        [
+            "Quota ledger:",
+            "  transcripts: 1 requests, 0 quota units, 0 throttled",
+            "  youtube.playlistItems: 2 requests, 2 quota units, 1 throttled",
+        ]
+    )
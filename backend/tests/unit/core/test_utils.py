@@ -1,8 +1,9 @@
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 
-from ragtube.core.utils import timeout_handler
+from ragtube.core.utils import get_watch_url, timeout_handler
 
 
 def test_timeout():
@@ -17,3 +18,29 @@ def test_timeout():
     with pytest.raises(TimeoutError):
         throw_timeout_error()
     not_throw_timeout_error()
+
+
+def test_timeout_off_main_thread():
+    @timeout_handler(1)
+    def throw_timeout_error():
+        time.sleep(2)
+
+    @timeout_handler(2)
+    def return_value():
+        return "value"
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        with pytest.raises(TimeoutError):
+            executor.submit(throw_timeout_error).result()
+        assert executor.submit(return_value).result() == "value"
+
+
+def test_get_watch_url():
+    assert (
+        get_watch_url("Guy5D3PJlZk")
+        == "https://www.youtube.com/watch?v=Guy5D3PJlZk"
+    )
+    assert (
+        get_watch_url("Guy5D3PJlZk", 125.32)
+        == "https://www.youtube.com/watch?v=Guy5D3PJlZk&t=125s"
+    )
@@ -0,0 +1,53 @@
+import pathlib
+import tarfile
+
+from ragtube.core.models import Caption
+from ragtube.data.cache import TranscriptCache
+
+
+def video_captions():
+    return [
+        Caption(
+            text="I often make this joke which is agile's",
+            start=0.199,
+            duration=3.961,
+            video_id="Guy5D3PJlZk",
+        ),
+        Caption(
+            text="a lot like communism you know people",
+            start=2.32,
+            duration=4.8,
+            video_id="Guy5D3PJlZk",
+        ),
+    ]
+
+
+def test_transcript_cache(tmp_path: pathlib.Path):
+    cache = TranscriptCache(str(tmp_path / "cache"))
+
+    assert cache.get("Guy5D3PJlZk", "en") is None
+    cache.put("Guy5D3PJlZk", "en", video_captions())
+    assert cache.get("Guy5D3PJlZk", "en") == video_captions()
+    assert cache.get("Guy5D3PJlZk", "es") is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    assert TranscriptCache(str(tmp_path / "cache")).size == cache.size
+
+    assert cache.export(str(tmp_path / "cache.tar")) == 1
+    with tarfile.open(tmp_path / "cache.tar") as archive:
+        assert archive.getnames() == [
+            str(
+                cache.get_path("Guy5D3PJlZk", "en").relative_to(
+                    cache.directory
+                )
+            )
+        ]
+
+
+def test_transcript_cache_eviction(tmp_path: pathlib.Path):
+    cache = TranscriptCache(str(tmp_path), max_size=1)
+
+    cache.put("Guy5D3PJlZk", "en", video_captions())
+    assert cache.evictions == 1
+    assert cache.size == 0
+    assert cache.get("Guy5D3PJlZk", "en") is None
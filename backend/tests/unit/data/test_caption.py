@@ -0,0 +1,88 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
+
+from ragtube.core.models import Caption, CaptionTrack, Channel, Video
+from ragtube.data.caption import (
+    migrate_captions,
+    read_captions,
+    write_captions,
+)
+
+
+def video():
+    return Video(
+        id="Guy5D3PJlZk",
+        title="Agile Manifesto",
+        publish_time=datetime(2024, 8, 9, 16, 3, 23),
+        channel_id="UC34rhn8Um7R18-BHjPklYlw",
+        channel=Channel(id="UC34rhn8Um7R18-BHjPklYlw", title="diego garrido"),
+    )
+
+
+def video_captions():
+    return [
+        Caption(
+            text="I often make this joke which is agile's",
+            start=0.199,
+            duration=3.961,
+            video_id="Guy5D3PJlZk",
+        ),
+        Caption(
+            text="a lot like communism you know people",
+            start=2.32,
+            duration=4.8,
+            video_id="Guy5D3PJlZk",
+        ),
+        Caption(
+            text="just keep not trying it correctly um",
+            start=4.16,
+            duration=6.12,
+            video_id="Guy5D3PJlZk",
+        ),
+    ]
+
+
+def caption_track():
+    return CaptionTrack(
+        video_id="Guy5D3PJlZk",
+        starts=[0.199, 2.32, 4.16],
+        durations=[3.961, 4.8, 6.12],
+        texts=[
+            "I often make this joke which is agile's",
+            "a lot like communism you know people",
+            "just keep not trying it correctly um",
+        ],
+    )
+
+
+@pytest.mark.parametrize("storage", ["rows", "columnar"])
+def test_write_and_read_captions(engine: Engine, storage: str):
+    with Session(engine) as session:
+        session.add(video())
+        session.flush()
+        write_captions(session, video_captions(), storage)
+        session.commit()
+
+    with Session(engine) as session:
+        actual_captions = read_captions(session, "Guy5D3PJlZk")
+    assert [
+        caption.model_dump(exclude={"id"}) for caption in actual_captions
+    ] == [caption.model_dump(exclude={"id"}) for caption in video_captions()]
+
+
+def test_migrate_captions(engine: Engine):
+    with Session(engine) as session:
+        session.add(video())
+        session.flush()
+        write_captions(session, video_captions(), "rows")
+        session.commit()
+
+    assert migrate_captions(engine) == 1
+    assert migrate_captions(engine) == 0
+
+    with Session(engine) as session:
+        assert session.exec(select(Caption)).all() == []
+        assert session.exec(select(CaptionTrack)).all() == [caption_track()]
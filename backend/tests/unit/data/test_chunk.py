@@ -1,12 +1,14 @@
 from datetime import datetime
 
+import pytest
 from llama_index.core.node_parser import (
     TokenTextSplitter,
 )
 from sqlalchemy.engine import Engine
 from sqlmodel import Session, select
 
-from ragtube.core.models import Channel, Chunk, Video
+from ragtube.core.models import Caption, Channel, Chunk, Video
+from ragtube.core.utils import get_content_hash
 from ragtube.data.chunk import (
     ChunkTask,
     get_video_content_chunks,
@@ -62,6 +64,26 @@ def chunks():
     ]
 
 
+def video_captions():
+    return [
+        Caption(
+            text=text, start=start, duration=duration, video_id="Guy5D3PJlZk"
+        )
+        for text, start, duration in [
+            ("I often make this joke which is agile's", 0.199, 3.961),
+            ("a lot like communism you know people", 2.32, 4.8),
+            ("just keep not trying it correctly um", 4.16, 6.12),
+            ("what is what is the correct way to", 7.12, 8.08),
+            ("Agile oh gee um it's a real simple idea", 10.28, 7.52),
+            ("right uh do things in really short", 15.2, 4.72),
+            ("sequences measure how much you get done", 17.8, 4.16),
+            ("in every sequence use that measurement", 19.92, 4.0),
+            ("to project an end date and tell", 21.96, 6.04),
+            ("everybody that's kind of it", 23.92, 4.08),
+        ]
+    ]
+
+
 def chunks_with_id() -> list[Chunk]:
     rows = []
     for i, chunk in enumerate(chunks()):
@@ -83,20 +105,85 @@ def test_get_video_content_chunks():
     assert actual_chunks == chunks()
 
 
-def test_chunk_task(engine: Engine):
+def test_get_video_content_chunks_with_captions():
+    splitter = TokenTextSplitter(chunk_size=25, chunk_overlap=5)
+    actual_chunks = get_video_content_chunks(
+        splitter, video(), video_captions()
+    )
+    expected_chunks = chunks()
+    for chunk, (start, duration) in zip(
+        expected_chunks,
+        [(0.199, 15.001), (4.16, 15.76), (10.28, 17.72), (19.92, 8.08)],
+    ):
+        chunk.start = start
+        chunk.duration = duration
+    assert actual_chunks == expected_chunks
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_chunk_task(engine: Engine, workers: int):
     create_video_table(engine)
 
-    task = ChunkTask(engine, chunk_size=25, chunk_overlap=5)
+    task = ChunkTask(
+        engine, chunk_size=25, chunk_overlap=5, workers=workers, batch_size=2
+    )
 
-    actual_videos = task.get_missing_videos_content()
-    assert actual_videos == videos()
+    actual_videos = list(task.iter_missing_videos_content())
+    assert actual_videos == [videos()]
 
-    actual_chunks = task.get_videos_content_chunks(videos())
-    assert actual_chunks == chunks()
+    expected_chunks = chunks_with_id()
+    for chunk in expected_chunks:
+        chunk.content_hash = get_content_hash(chunk.content)
+        chunk.chunk_fingerprint = task.fingerprint
+        chunk.channel_id = "UC34rhn8Um7R18-BHjPklYlw"
+
+    actual_rows = [
+        row
+        for rows in task.iter_videos_content_chunks(videos())
+        for row in rows
+    ]
+    assert actual_rows == [
+        (
+            chunk.content,
+            chunk.start,
+            chunk.duration,
+            chunk.video_id,
+            chunk.channel_id,
+        )
+        for chunk in expected_chunks
+    ]
+
+    task.launch()
+    with Session(engine) as session:
+        chunks_from_db = session.exec(select(Chunk)).all()
+        assert chunks_from_db == expected_chunks
+
+    assert list(task.iter_missing_videos_content()) == []
+
+
+def test_chunk_task_config_change(engine: Engine):
+    create_video_table(engine)
+    ChunkTask(engine, chunk_size=25, chunk_overlap=5).launch()
+    with Session(engine) as session:
+        # chunks from before fingerprints
+        for chunk in session.exec(select(Chunk)).all():
+            chunk.chunk_fingerprint = None
+            session.add(chunk)
+        session.commit()
+
+    task = ChunkTask(engine, chunk_size=25, chunk_overlap=5)
+    task.stamp_chunks()
+    assert list(task.iter_missing_videos_content()) == []
+
+    task = ChunkTask(engine, chunk_size=50, chunk_overlap=10)
+    assert list(task.iter_missing_videos_content()) == [videos()]
 
     task.launch()
     with Session(engine) as session:
         chunks_from_db = session.exec(select(Chunk)).all()
-        assert chunks_from_db == chunks_with_id()
+        # stale chunks stay until the new ones are embedded
+        assert [chunk.chunk_fingerprint for chunk in chunks_from_db] == [
+            ChunkTask(engine, chunk_size=25, chunk_overlap=5).fingerprint
+        ] * 4 + [task.fingerprint] * 2
 
-    assert task.get_missing_videos_content() is None
+    assert list(task.iter_missing_videos_content()) == []
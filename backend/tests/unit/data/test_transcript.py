@@ -1,14 +1,27 @@
 from datetime import datetime
+from unittest.mock import MagicMock, patch
 
+import pytest
+import requests
 from sqlalchemy.engine import Engine
 from sqlmodel import Session, select
 
-from ragtube.core.models import Caption, Channel, Video
+from ragtube.core.models import (
+    Caption,
+    Channel,
+    ChannelSync,
+    IngestionJournal,
+    IngestionState,
+    Video,
+)
+from ragtube.core.ratelimit import AdaptiveRateLimiter
 from ragtube.core.settings import Settings
 from ragtube.data.transcript import (
+    TimeoutSession,
     VideoTranscriptTask,
+    fetch_video_captions,
     get_channel_videos,
-    get_video_captions,
+    get_youtube_client,
 )
 
 
@@ -148,8 +161,22 @@ def test_get_channel_videos(settings: Settings):
     assert actual_videos == videos()
 
 
-def test_get_video_captions(settings: Settings):
-    actual_video_captions = get_video_captions(
+def test_get_channel_videos_with_watermark(settings: Settings):
+    actual_videos = get_channel_videos(
+        "UC34rhn8Um7R18-BHjPklYlw",
+        settings.youtube_api_key.get_secret_value(),
+        timeout=60,
+        watermark=ChannelSync(
+            channel_id="UC34rhn8Um7R18-BHjPklYlw",
+            video_id="Guy5D3PJlZk",
+            publish_time=datetime(2024, 8, 9, 16, 3, 23),
+        ),
+    )
+    assert actual_videos == []
+
+
+def test_fetch_video_captions(settings: Settings):
+    actual_video_captions = fetch_video_captions(
         "Guy5D3PJlZk",
         language="en",
         timeout=60,
@@ -160,6 +187,186 @@ def test_get_video_captions(settings: Settings):
     assert actual_video_captions == video_captions()
 
 
+def test_fetch_video_captions_limiter():
+    limiter = AdaptiveRateLimiter(rate=100.0, max_concurrency=4)
+    limiter.concurrency = 2.0
+    with patch(
+        "ragtube.data.transcript.download_video_captions",
+        side_effect=TimeoutError("timed out"),
+    ):
+        with pytest.raises(TimeoutError):
+            fetch_video_captions("Guy5D3PJlZk", limiter=limiter)
+    # a timeout does not grow the concurrency
+    assert (limiter.in_flight, limiter.concurrency) == (0, 2.0)
+
+    with patch(
+        "ragtube.data.transcript.download_video_captions",
+        return_value=video_captions(),
+    ):
+        assert (
+            fetch_video_captions("Guy5D3PJlZk", limiter=limiter)
+            == video_captions()
+        )
+    assert limiter.concurrency == 2.5
+
+
+def mock_youtube_api_get(url: str, params: dict, timeout: int):
+    response = MagicMock(status_code=200)
+    channel_id = "UC" + params.get("id", params.get("playlistId", "")[4:])
+    if url.endswith("/channels"):
+        response.json.return_value = {
+            "items": [{"snippet": {"title": channel_id}}]
+        }
+    else:
+        response.json.return_value = {
+            "items": [
+                {
+                    "snippet": {
+                        "resourceId": {"videoId": f"{channel_id}-{i}"},
+                        "title": f"video {i}",
+                        "publishedAt": f"2024-08-0{i + 1}T16:03:23Z",
+                    }
+                }
+                for i in range(2)
+            ]
+        }
+    return response
+
+
+def test_youtube_client_is_shared():
+    assert get_youtube_client("key") is get_youtube_client("key")
+
+
+def test_list_channels_concurrently():
+    channel_ids = [f"UCchannel{i}" for i in range(4)]
+    task = VideoTranscriptTask(
+        MagicMock(),
+        channel_id=channel_ids,
+        api_key="key",
+        channel_workers=2,
+        full_sync=True,
+    )
+    with (
+        patch.object(
+            task.client.session, "get", side_effect=mock_youtube_api_get
+        ) as get,
+        patch.object(task, "add_channel_videos_and_captions") as add,
+    ):
+        task.launch()
+
+    # one channels and one playlistItems request per channel, all on the
+    # session of the shared client
+    assert get.call_count == 2 * len(channel_ids)
+    listed = {
+        channel.id: [video.id for video in videos]
+        for (channel, videos), _ in add.call_args_list
+    }
+    assert listed == {
+        channel_id: [f"{channel_id}-0", f"{channel_id}-1"]
+        for channel_id in channel_ids
+    }
+
+
+def test_timeout_session():
+    session = TimeoutSession(timeout=5)
+    with patch.object(requests.Session, "request") as request:
+        session.get("https://www.youtube.com")
+        session.get("https://www.youtube.com", timeout=1)
+    assert [call.kwargs["timeout"] for call in request.call_args_list] == [
+        5,
+        1,
+    ]
+
+
+def test_add_pending_videos_in_batches(engine: Engine):
+    task = VideoTranscriptTask(
+        engine, channel_id="UC34rhn8Um7R18-BHjPklYlw", api_key="key"
+    )
+    with Session(engine) as session:
+        session.add(channel())
+        session.commit()
+    pending_videos = [
+        Video(
+            id=f"video-{i}",
+            title=f"video {i}",
+            publish_time=datetime(2024, 8, 9, 16, 3, 23),
+            channel_id=channel().id,
+        )
+        for i in range(5)
+    ]
+    with patch("ragtube.data.transcript.JOURNAL_BATCH_SIZE", 2):
+        task.add_pending_videos(pending_videos)
+        # journaled videos are left as they are
+        task.add_pending_videos(pending_videos)
+    due_videos = task.get_due_videos("UC34rhn8Um7R18-BHjPklYlw")
+    assert sorted(video.id for video in due_videos) == [
+        video.id for video in pending_videos
+    ]
+
+
+def test_get_settled_videos(engine: Engine):
+    task = VideoTranscriptTask(
+        engine, channel_id="UC34rhn8Um7R18-BHjPklYlw", api_key="key"
+    )
+    with Session(engine) as session:
+        session.add(channel())
+        session.commit()
+    listed_videos = [
+        Video(
+            id=f"video-{day}",
+            title=f"video {day}",
+            publish_time=datetime(2024, 8, day),
+            channel_id=channel().id,
+        )
+        for day in [3, 2, 1]
+    ]
+    task.add_pending_videos(listed_videos)
+    with Session(engine) as session:
+        task.record_attempt(session, listed_videos[0])
+        task.record_attempt(
+            session, listed_videos[1], TimeoutError("timed out")
+        )
+        task.record_attempt(session, listed_videos[2])
+        session.commit()
+
+    # the watermark can not pass the video that failed
+    settled_videos = task.get_settled_videos(listed_videos)
+    assert [video.id for video in settled_videos] == ["video-1"]
+
+
+def test_record_attempt(engine: Engine, settings: Settings):
+    task = VideoTranscriptTask(
+        engine,
+        channel_id="UC34rhn8Um7R18-BHjPklYlw",
+        api_key=settings.youtube_api_key.get_secret_value(),
+        retry_backoff=60,
+        max_attempts=2,
+    )
+    with Session(engine) as session:
+        session.add(channel())
+        session.commit()
+    task.add_pending_videos(videos())
+    assert task.get_due_videos("UC34rhn8Um7R18-BHjPklYlw") == [
+        Video(**video().model_dump())
+    ]
+
+    with Session(engine) as session:
+        task.record_attempt(session, video(), TimeoutError("timed out"))
+        session.commit()
+        entry = session.get(IngestionJournal, "Guy5D3PJlZk")
+        assert entry is not None
+        assert entry.state == IngestionState.failed
+        assert entry.reason == "TimeoutError: timed out"
+        assert entry.next_attempt_time is not None
+        assert task.get_due_videos("UC34rhn8Um7R18-BHjPklYlw") == []
+
+        task.record_attempt(session, video(), TimeoutError("timed out"))
+        session.commit()
+        session.refresh(entry)
+        assert entry.state == IngestionState.unavailable
+        assert entry.attempts == 2
+
+
 def test_video_transcript_task(engine: Engine, settings: Settings):
     task = VideoTranscriptTask(
         engine,
@@ -192,6 +399,22 @@ def test_video_transcript_task(engine: Engine, settings: Settings):
 
         assert videos_captions_from_db == videos_captions_with_id()
 
+        journal_from_db = session.get(IngestionJournal, "Guy5D3PJlZk")
+        assert journal_from_db is not None
+        assert journal_from_db.state == IngestionState.fetched
+        assert journal_from_db.attempts == 0
+        assert task.get_due_videos("UC34rhn8Um7R18-BHjPklYlw") == []
+
+        watermark_from_db = session.get(
+            ChannelSync, "UC34rhn8Um7R18-BHjPklYlw"
+        )
+        assert watermark_from_db == ChannelSync(
+            channel_id="UC34rhn8Um7R18-BHjPklYlw",
+            video_id="Guy5D3PJlZk",
+            publish_time=datetime(2024, 8, 9, 16, 3, 23),
+        )
+        assert task.get_videos("UC34rhn8Um7R18-BHjPklYlw") == []
+
         videos_from_db = list(session.exec(select(Video)).all())
         assert (
             task.get_missing_videos("UC34rhn8Um7R18-BHjPklYlw", videos_from_db)
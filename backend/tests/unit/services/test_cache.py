@@ -0,0 +1,121 @@
+from datetime import timedelta
+
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, col, select
+
+from ragtube.core.models import CachedEmbedding
+from ragtube.core.utils import get_text_hash, utc_now
+from ragtube.services.cache import (
+    CachedEmbeddings,
+    EmbeddingCache,
+    collect_embedding_cache,
+)
+
+
+def texts():
+    return ["This video is sponsored by", "I often make this joke"]
+
+
+def test_embedding_cache(engine: Engine):
+    cache = EmbeddingCache(engine, "bge-large")
+    text_hashes = [get_text_hash(text) for text in texts()]
+
+    assert cache.get(text_hashes) == {}
+    cache.put({text_hashes[0]: [0.5, -0.5]})
+    actual_embeddings = cache.get(text_hashes)
+    assert {
+        text_hash: list(embedding)
+        for text_hash, embedding in actual_embeddings.items()
+    } == {text_hashes[0]: [0.5, -0.5]}
+    # embeddings of other models are not shared
+    assert EmbeddingCache(engine, "nomic-embed-text").get(text_hashes) == {}
+
+    assert cache.hits == 1
+    assert cache.misses == 3
+    assert str(cache) == (
+        "Embedding cache: 1 hits, 3 misses (25.0% hit rate)."
+    )
+
+
+def test_cached_embeddings(engine: Engine):
+    model = DeterministicFakeEmbedding(size=2)
+    cache = EmbeddingCache(engine, "bge-large")
+    cached_model = CachedEmbeddings(model, cache)
+
+    assert cached_model.embed_documents(texts()) == model.embed_documents(
+        texts()
+    )
+    assert cache.misses == 2
+
+    actual_embeddings = cached_model.embed_documents(texts())
+    assert [list(embedding) for embedding in actual_embeddings] == [
+        list(embedding) for embedding in model.embed_documents(texts())
+    ]
+    assert list(cached_model.embed_query(texts()[0])) == model.embed_query(
+        texts()[0]
+    )
+    assert cache.hits == 3
+    # the text is embedded as it is, not as its normalized form
+    assert cached_model.embed_query(texts()[0].upper()) == model.embed_query(
+        texts()[0].upper()
+    )
+    assert cache.misses == 3
+
+
+def test_embedding_cache_last_used(engine: Engine):
+    cache = EmbeddingCache(engine, "bge-large")
+    with Session(engine) as session:
+        session.add_all(
+            [
+                CachedEmbedding(
+                    model_key="bge-large",
+                    text_hash=text_hash,
+                    embedding=[0.5, -0.5],
+                    last_used_time=utc_now() - age,
+                )
+                for text_hash, age in [
+                    ("a", timedelta(hours=1)),
+                    ("b", timedelta(days=2)),
+                ]
+            ]
+        )
+        session.commit()
+
+    assert set(cache.get(["a", "b"])) == {"a", "b"}
+    with Session(engine) as session:
+        last_used_times = dict(
+            session.exec(
+                select(
+                    CachedEmbedding.text_hash, CachedEmbedding.last_used_time
+                )
+            ).all()
+        )
+    # only the use older than LAST_USED_RESOLUTION is written back
+    assert utc_now() - last_used_times["a"] >= timedelta(hours=1)
+    assert utc_now() - last_used_times["b"] < timedelta(hours=1)
+
+
+def test_collect_embedding_cache(engine: Engine):
+    EmbeddingCache(engine, "bge-large").put({"a": [0.5, -0.5]})
+    EmbeddingCache(engine, "nomic-embed-text").put({"a": [0.5, -0.5]})
+    with Session(engine) as session:
+        session.add(
+            CachedEmbedding(
+                model_key="bge-large",
+                text_hash="b",
+                embedding=[0.5, -0.5],
+                last_used_time=utc_now() - timedelta(days=60),
+            )
+        )
+        session.commit()
+
+    assert collect_embedding_cache(engine, ["bge-large"]) == 1
+    assert collect_embedding_cache(engine, ["bge-large"], timedelta(30)) == 1
+    with Session(engine) as session:
+        actual_entries = session.exec(
+            select(
+                CachedEmbedding.model_key, CachedEmbedding.text_hash
+            ).order_by(col(CachedEmbedding.text_hash))
+        ).all()
+        assert actual_entries == [("bge-large", "a")]
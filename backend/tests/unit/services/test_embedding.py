@@ -1,11 +1,30 @@
 from datetime import datetime
 
+import pytest
 from langchain_core.embeddings import DeterministicFakeEmbedding
+from sqlalchemy import inspect
 from sqlalchemy.engine import Engine
-from sqlmodel import Session, select
+from sqlmodel import Session, col, select
 
 from ragtube.core.models import Channel, Chunk, Video
-from ragtube.services.embedding import EmbeddingTask
+from ragtube.core.utils import fingerprint, get_content_hash
+from ragtube.services.embedding import (
+    SHADOW_EMBEDDING,
+    EmbeddingTask,
+    get_embedding_fingerprint,
+    get_live_embedding_config,
+    get_sentence_transformers_model_name,
+)
+
+
+class FlakyEmbedding(DeterministicFakeEmbedding):
+    failures: int = 1
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("Ollama is not reachable")
+        return super().embed_documents(texts)
 
 
 def create_chunk_table(engine: Engine):
@@ -67,7 +86,9 @@ def test_embedding_task(engine: Engine):
 
     assert isinstance(task.model, DeterministicFakeEmbedding)
 
-    actual_chunks = task.get_missing_chunks()
+    actual_chunks = [
+        chunk for chunks in task.iter_missing_chunks() for chunk in chunks
+    ]
     assert actual_chunks == [
         Chunk(
             id=1,
@@ -96,7 +117,7 @@ def test_embedding_task(engine: Engine):
         actual_chunks_from_db = session.exec(select(Chunk)).all()
         for chunk in actual_chunks_from_db:
             chunk.embedding = list(chunk.embedding)
-        assert actual_chunks_from_db == [
+        expected_chunks = [
             Chunk(
                 id=1,
                 content="I often make this joke which is agile's a lot like communism you know people just keep not trying it correctly um what is",
@@ -104,6 +125,7 @@ def test_embedding_task(engine: Engine):
                     0.20749013125896453857421875,
                     0.91412651538848876953125,
                 ],
+                embedding_fingerprint=task.fingerprint,
                 video_id="Guy5D3PJlZk",
             ),
             Chunk(
@@ -113,6 +135,7 @@ def test_embedding_task(engine: Engine):
                     -0.885921180248260498046875,
                     0.85550343990325927734375,
                 ],
+                embedding_fingerprint=task.fingerprint,
                 video_id="Guy5D3PJlZk",
             ),
             Chunk(
@@ -122,6 +145,7 @@ def test_embedding_task(engine: Engine):
                     -0.227100789546966552734375,
                     -1.99812042713165283203125,
                 ],
+                embedding_fingerprint=task.fingerprint,
                 video_id="Guy5D3PJlZk",
             ),
             Chunk(
@@ -131,8 +155,195 @@ def test_embedding_task(engine: Engine):
                     0.26584398746490478515625,
                     0.608121931552886962890625,
                 ],
+                embedding_fingerprint=task.fingerprint,
                 video_id="Guy5D3PJlZk",
             ),
         ]
+        for chunk in expected_chunks:
+            chunk.content_hash = get_content_hash(chunk.content)
+        assert actual_chunks_from_db == expected_chunks
+
+    assert list(task.iter_missing_chunks()) == []
+    assert task.computed_embeddings == 4
+    assert task.get_dedup_ratio() == 0.0
+
+
+def test_embedding_task_retire_stale_chunks(engine: Engine):
+    create_chunk_table(engine)
+    with Session(engine) as session:
+        # the first two chunks were cut with an older config
+        for chunk in session.exec(select(Chunk)).all():
+            chunk.chunk_fingerprint = "old" if chunk.id <= 2 else "new"
+            session.add(chunk)
+        session.commit()
+
+    task = EmbeddingTask(engine, chunk_fingerprint="new")
+
+    actual_chunks = [
+        chunk for chunks in task.iter_missing_chunks() for chunk in chunks
+    ]
+    assert [chunk.id for chunk in actual_chunks] == [3, 4]
+
+    task.launch()
+    with Session(engine) as session:
+        actual_chunks_from_db = session.exec(select(Chunk)).all()
+        assert [chunk.id for chunk in actual_chunks_from_db] == [3, 4]
+        assert all(
+            chunk.embedding_fingerprint == task.fingerprint
+            for chunk in actual_chunks_from_db
+        )
+
+    assert list(task.iter_missing_chunks()) == []
+
+
+def test_embedding_task_model_changed(engine: Engine):
+    create_chunk_table(engine)
+    live_task = EmbeddingTask(engine)
+    live_task.launch()
+
+    task = EmbeddingTask(engine, model_name="nomic-embed-text")
+    task.prepare()
+    assert task.is_migrating()
+    assert not task.is_migrated()
+    # interrupted after the first chunks, the rest are embedded on resume
+    chunks = [
+        chunk for chunks in task.iter_missing_chunks() for chunk in chunks
+    ][:2]
+    task.add_embeddings(chunks)
+    with Session(engine) as session:
+        task.write_embeddings(session, chunks)
+    task = EmbeddingTask(engine, model_name="nomic-embed-text")
+    task.launch()
+    assert task.embedded_chunks == 2
+    assert task.is_migrated()
+
+    # searches stay on the embeddings of the live model until the swap
+    assert get_live_embedding_config(engine).fingerprint == (  # type: ignore
+        live_task.fingerprint
+    )
+    with Session(engine) as session:
+        assert all(
+            chunk.embedding_fingerprint == live_task.fingerprint
+            for chunk in session.exec(select(Chunk)).all()
+        )
+
+    task.swap_embeddings()
+    assert get_live_embedding_config(engine).fingerprint == (  # type: ignore
+        task.fingerprint
+    )
+    with Session(engine) as session:
+        assert all(
+            chunk.embedding_fingerprint == task.fingerprint
+            for chunk in session.exec(select(Chunk)).all()
+        )
+    columns = {
+        column["name"] for column in inspect(engine).get_columns("chunk")
+    }
+    assert SHADOW_EMBEDDING not in columns
+    assert "previous_embedding" not in columns
+
+    task = EmbeddingTask(engine, model_name="nomic-embed-text")
+    task.launch()
+    assert not task.is_migrating()
+    assert task.embedded_chunks == 0
+
+
+def test_embedding_task_dedup(engine: Engine):
+    create_chunk_table(engine)
+    with Session(engine) as session:
+        # a repeated sponsor read, the embedding of the last is known already
+        session.add_all(
+            [
+                Chunk(
+                    content="This video is sponsored by",
+                    video_id="Guy5D3PJlZk",
+                ),
+                Chunk(
+                    content="this video is  sponsored by",
+                    video_id="Guy5D3PJlZk",
+                ),
+                Chunk(
+                    content="measurement to project an end date and tell everybody that's kind of it",
+                    video_id="Guy5D3PJlZk",
+                ),
+            ]
+        )
+        session.commit()
+
+    task = EmbeddingTask(engine, stream_batch_size=5)
+    task.launch()
+
+    assert task.embedded_chunks == 7
+    assert task.computed_embeddings == 5
+    assert task.get_dedup_ratio() == 2 / 7
+    with Session(engine) as session:
+        actual_chunks_from_db = session.exec(
+            select(Chunk).order_by(col(Chunk.id))
+        ).all()
+        assert list(actual_chunks_from_db[4].embedding) == list(
+            actual_chunks_from_db[5].embedding
+        )
+        assert list(actual_chunks_from_db[3].embedding) == list(
+            actual_chunks_from_db[6].embedding
+        )
+
+
+def test_embed_documents_retries(
+    engine: Engine, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(
+        "ragtube.services.embedding.time.sleep", lambda _: None
+    )
+    texts = ["This video is sponsored by", "I often make this joke"]
+
+    task = EmbeddingTask(engine, max_retries=1)
+    task.model = FlakyEmbedding(size=2, failures=1)
+    assert task.embed_documents(texts) == DeterministicFakeEmbedding(
+        size=2
+    ).embed_documents(texts)
+
+    task.model = FlakyEmbedding(size=2, failures=2)
+    with pytest.raises(ConnectionError):
+        task.embed_documents(texts)
+
+
+def test_embedding_task_in_process_concurrency(engine: Engine):
+    assert EmbeddingTask(engine, concurrency=4).concurrency == 4
+    task = EmbeddingTask(
+        engine, concurrency=4, backend="sentence-transformers"
+    )
+    assert task.concurrency == 1
+
+
+def test_get_embedding_fingerprint():
+    assert get_embedding_fingerprint("bge-large", 512) == fingerprint(
+        model_name="bge-large", num_ctx=512
+    )
+    fingerprints = {
+        get_embedding_fingerprint("bge-large", 512),
+        get_embedding_fingerprint("bge-large", 256),
+        get_embedding_fingerprint(
+            "BAAI/bge-large-en-v1.5", 512, "sentence-transformers"
+        ),
+        get_embedding_fingerprint(
+            "BAAI/bge-large-en-v1.5", 512, "sentence-transformers", True
+        ),
+    }
+    assert len(fingerprints) == 4
+
 
-    assert task.get_missing_chunks() is None
+def test_get_sentence_transformers_model_name():
+    assert (
+        get_sentence_transformers_model_name("bge-large")
+        == "BAAI/bge-large-en-v1.5"
+    )
+    assert (
+        get_sentence_transformers_model_name("nomic-embed-text:latest")
+        == "nomic-ai/nomic-embed-text-v1.5"
+    )
+    assert (
+        get_sentence_transformers_model_name("BAAI/bge-small-en-v1.5")
+        == "BAAI/bge-small-en-v1.5"
+    )
+    with pytest.raises(ValueError):
+        get_sentence_transformers_model_name("llama3.1:8b")
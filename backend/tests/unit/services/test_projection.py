@@ -0,0 +1,117 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, col, select
+
+from ragtube.core.models import Channel, Chunk, Video
+from ragtube.services.projection import (
+    ProjectionTask,
+    fit_projection,
+    get_projection,
+    get_recall,
+    project_embeddings,
+)
+
+
+def embeddings():
+    # most of the variance is along the first axis
+    return np.array(
+        [
+            [4.0, 0.1, 0.0],
+            [-4.0, -0.1, 0.0],
+            [2.0, 0.0, 0.1],
+            [-2.0, 0.0, -0.1],
+        ]
+    )
+
+
+def create_chunk_table(engine: Engine):
+    video = Video(
+        id="Guy5D3PJlZk",
+        title="Agile Manifesto",
+        publish_time=datetime(2024, 8, 9, 16, 3, 23),
+        channel_id="UC34rhn8Um7R18-BHjPklYlw",
+        channel=Channel(id="UC34rhn8Um7R18-BHjPklYlw", title="diego garrido"),
+    )
+    with Session(engine) as session:
+        # chunks 10 and 20 are held out from the fit
+        session.add_all(
+            [
+                Chunk(
+                    content=f"chunk {i}",
+                    embedding=(
+                        embeddings()[i % 4, :2] * (1 + i // 4)
+                    ).tolist(),
+                    video_id="Guy5D3PJlZk",
+                    video=video,
+                )
+                for i in range(20)
+            ]
+        )
+        session.commit()
+
+
+def test_fit_projection_pca():
+    projection = fit_projection(embeddings(), 1, "pca")
+    assert projection.dim == 1
+    assert np.allclose(
+        np.abs(projection.components), [[1.0, 0.025, 0.0]], atol=0.01
+    )
+
+    projected = project_embeddings(projection, embeddings())
+    assert projected.shape == (4, 1)
+    assert np.allclose(
+        np.abs(projected[:, 0]), [4.0, 4.0, 2.0, 2.0], atol=0.01
+    )
+
+
+def test_fit_projection_truncate():
+    projection = fit_projection(embeddings(), 2, "truncate")
+    projected = project_embeddings(projection, embeddings())
+    assert np.allclose(np.linalg.norm(projected, axis=1), 1.0)
+    assert np.allclose(projected[0], np.array([4.0, 0.1]) / np.hypot(4.0, 0.1))
+
+
+def test_fit_projection_invalid_method():
+    with pytest.raises(ValueError):
+        fit_projection(embeddings(), 1, "umap")
+
+
+def test_get_recall():
+    assert get_recall(embeddings(), embeddings(), k=2) == 1.0
+    projection = fit_projection(embeddings(), 1, "pca")
+    recall = get_recall(
+        embeddings(), project_embeddings(projection, embeddings()), k=1
+    )
+    assert recall == 1.0
+
+
+def test_projection_task(engine: Engine):
+    assert Chunk.embedding.type.dim == 2
+
+    create_chunk_table(engine)
+
+    task = ProjectionTask(
+        engine, dim=1, method="pca", embedding_fingerprint="a"
+    )
+    task.launch()
+
+    projection = get_projection(engine)
+    assert projection is not None
+    assert (projection.method, projection.dim) == ("pca", 1)
+    with Session(engine) as session:
+        chunks = session.exec(select(Chunk).order_by(col(Chunk.id))).all()
+        assert all(len(chunk.reduced_embedding) == 1 for chunk in chunks)
+    assert list(task.recalls) == [1]
+
+    # fitted once per method, dim and embedding model
+    assert task.fit() == projection
+    task = ProjectionTask(
+        engine, dim=1, method="pca", embedding_fingerprint="b"
+    )
+    assert task.fit().id != projection.id
+    with Session(engine) as session:
+        chunks = session.exec(select(Chunk)).all()
+        assert all(chunk.reduced_embedding is None for chunk in chunks)
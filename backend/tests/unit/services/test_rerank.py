@@ -109,6 +109,8 @@ def test_rerank_retriever(engine: Engine):
                 "video_id": "Guy5D3PJlZk",
                 "title": "Agile Manifesto",
                 "publish_time": datetime(2024, 8, 9, 16, 3, 23),
+                "start": None,
+                "score": 0.0,
             },
             page_content="I often make this joke which is agile's a lot like communism you know people just keep not trying it correctly um what is",
         ),
@@ -1,12 +1,26 @@
+import asyncio
 from datetime import datetime
 
+import pytest
 from langchain_core.documents import Document
 from langchain_core.embeddings import DeterministicFakeEmbedding
 from sqlalchemy.engine import Engine
-from sqlmodel import Session
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import Session, text
 
 from ragtube.core.models import Channel, Chunk, Video
-from ragtube.services.retriever import Retriever, create_index, drop_index
+from ragtube.services.retriever import (
+    INDEX_STORAGES,
+    ITERATIVE_SCANS,
+    RETRIEVER_MODES,
+    Hit,
+    Retriever,
+    collapse_duplicate_chunks,
+    create_index,
+    drop_index,
+    fuse_rankings,
+    get_index_name,
+)
 
 
 def create_chunk_table(engine: Engine):
@@ -41,6 +55,7 @@ def create_chunk_table(engine: Engine):
                 0.91412651538848876953125,
             ],
             video_id="Guy5D3PJlZk",
+            channel_id="UC34rhn8Um7R18-BHjPklYlw",
             video=video,
         ),
         Chunk(
@@ -51,6 +66,7 @@ def create_chunk_table(engine: Engine):
                 0.85550343990325927734375,
             ],
             video_id="Guy5D3PJlZk",
+            channel_id="UC34rhn8Um7R18-BHjPklYlw",
             video=video,
         ),
         Chunk(
@@ -61,6 +77,7 @@ def create_chunk_table(engine: Engine):
                 -1.99812042713165283203125,
             ],
             video_id="Guy5D3PJlZk",
+            channel_id="UC34rhn8Um7R18-BHjPklYlw",
             video=video,
         ),
         Chunk(
@@ -71,6 +88,7 @@ def create_chunk_table(engine: Engine):
                 0.608121931552886962890625,
             ],
             video_id="Guy5D3PJlZk",
+            channel_id="UC34rhn8Um7R18-BHjPklYlw",
             video=video,
         ),
     ]
@@ -79,17 +97,21 @@ def create_chunk_table(engine: Engine):
         session.commit()
 
 
-def test_retriever(engine: Engine):
+@pytest.mark.parametrize(
+    "storage", [storage for storage in INDEX_STORAGES if storage != "reduced"]
+)
+def test_retriever(engine: Engine, storage: str):
     assert Chunk.embedding.type.dim == 2
 
     create_chunk_table(engine)
-    create_index(engine)
+    create_index(engine, storage=storage)
 
     embedding_model = DeterministicFakeEmbedding(size=2)
     retriever = Retriever(
         engine=engine,
         embedding_model=embedding_model,
         results_to_retrieve=2,
+        index_storage=storage,
     )
 
     docs = retriever.invoke(
@@ -102,6 +124,8 @@ def test_retriever(engine: Engine):
                 "video_id": "Guy5D3PJlZk",
                 "title": "Agile Manifesto",
                 "publish_time": datetime(2024, 8, 9, 16, 3, 23),
+                "start": None,
+                "score": 0.0,
             },
             page_content="I often make this joke which is agile's a lot like communism you know people just keep not trying it correctly um what is",
         ),
@@ -111,9 +135,164 @@ def test_retriever(engine: Engine):
                 "video_id": "Guy5D3PJlZk",
                 "title": "Agile Manifesto",
                 "publish_time": datetime(2024, 8, 9, 16, 3, 23),
+                "start": None,
+                "score": pytest.approx(0.3115188, abs=1e-6),
             },
             page_content="measurement to project an end date and tell everybody that's kind of it",
         ),
     ]
     assert docs == expected_docs
-    drop_index(engine, "chunk_index")
+    drop_index(engine, get_index_name(storage))
+
+
+@pytest.mark.parametrize("iterative_scan", ITERATIVE_SCANS)
+def test_retriever_channel_filter(engine: Engine, iterative_scan: str):
+    query = "I often make this joke which is agile's a lot like communism you know people just keep not trying it correctly um what is"
+    embedding_model = DeterministicFakeEmbedding(size=2)
+    create_chunk_table(engine)
+    with Session(engine) as session:
+        # the closest chunk is from another channel
+        session.add(
+            Chunk(
+                id=5,
+                content=query,
+                embedding=embedding_model.embed_query(query),
+                channel_id="other",
+                video=Video(
+                    id="other",
+                    title="other",
+                    publish_time=datetime(2024, 8, 9, 16, 3, 23),
+                    channel=Channel(id="other", title="other"),
+                ),
+            )
+        )
+        session.commit()
+    create_index(engine)
+
+    retriever = Retriever(
+        engine=engine,
+        embedding_model=embedding_model,
+        results_to_retrieve=2,
+        channel_id="UC34rhn8Um7R18-BHjPklYlw",
+        ef_search=10,
+        iterative_scan=iterative_scan,
+    )
+    with Session(engine) as session:
+        hits = retriever.search(session, embedding_model.embed_query(query))
+        ef_search = session.connection().execute(
+            text("SELECT current_setting('hnsw.ef_search')")
+        )
+        assert ef_search.one()[0] == "10"
+    assert [hit.id for hit in hits] == [1, 4]
+    drop_index(engine, get_index_name())
+
+
+def test_retriever_widen_scan(engine: Engine):
+    retriever = Retriever(
+        engine=engine,
+        embedding_model=DeterministicFakeEmbedding(size=2),
+        channel_id="UC34rhn8Um7R18-BHjPklYlw",
+        max_ef_search=100,
+    )
+    hits = [Hit(*([None] * 7), score=0.0)] * 2
+    assert retriever.widen_scan(40, hits, limit=5) == 80
+    assert retriever.widen_scan(80, hits, limit=5, previous_hits=1) == 100
+    # the channel has no more chunks than the last scan found
+    assert retriever.widen_scan(80, hits, limit=5, previous_hits=2) is None
+    assert retriever.widen_scan(40, hits * 3, limit=5) is None
+    partitioned = retriever.model_copy(update={"partitioned": True})
+    assert partitioned.widen_scan(40, hits, limit=5) is None
+
+
+def test_retriever_scan_settings(engine: Engine):
+    retriever = Retriever(
+        engine=engine,
+        embedding_model=DeterministicFakeEmbedding(size=2),
+        ef_search=40,
+    )
+    # older pgvector versions reject hnsw.iterative_scan, it is left unset
+    assert retriever.get_scan_settings(40) == [
+        {"name": "hnsw.ef_search", "value": "40"}
+    ]
+    relaxed = retriever.model_copy(update={"iterative_scan": "relaxed_order"})
+    assert relaxed.get_scan_settings(40) == [
+        {"name": "hnsw.ef_search", "value": "40"},
+        {"name": "hnsw.iterative_scan", "value": "relaxed_order"},
+    ]
+
+
+def test_collapse_duplicate_chunks():
+    chunks = [
+        Chunk(id=1, content="This video is sponsored by", video_id="a"),
+        Chunk(id=2, content="this video is  sponsored by", video_id="b"),
+        Chunk(id=3, content="I often make this joke", video_id="a"),
+        Chunk(id=4, content="what is the correct way", video_id="a"),
+    ]
+    actual_chunks = collapse_duplicate_chunks(chunks, 2)
+    assert [chunk.id for chunk in actual_chunks] == [1, 3]
+
+
+def test_retriever_hybrid(engine: Engine):
+    create_chunk_table(engine)
+
+    retriever = Retriever(
+        engine=engine,
+        embedding_model=DeterministicFakeEmbedding(size=2),
+        results_to_retrieve=2,
+        mode="hybrid",
+    )
+    # only the first chunk has the term, whatever its distance
+    docs = retriever.invoke(input="What is communism?")
+    assert docs[0].metadata["id"] == 1
+    assert len(docs) == 2
+
+    with Session(engine) as session:
+        hits = retriever.search_lexical(session, "communism agile")
+    assert [hit.id for hit in hits] == [1, 2]
+
+
+@pytest.mark.parametrize("mode", RETRIEVER_MODES)
+def test_retriever_async(engine: Engine, mode: str):
+    create_chunk_table(engine)
+    query = "I often make this joke which is agile's a lot like communism you know people just keep not trying it correctly um what is"
+
+    async def ainvoke():
+        async_engine = create_async_engine(
+            engine.url.render_as_string(hide_password=False)
+        )
+        retriever = Retriever(
+            engine=engine,
+            async_engine=async_engine,
+            embedding_model=DeterministicFakeEmbedding(size=2),
+            results_to_retrieve=2,
+            mode=mode,
+        )
+        try:
+            return await retriever.ainvoke(query), retriever.invoke(query)
+        finally:
+            await async_engine.dispose()
+
+    async_docs, docs = asyncio.run(ainvoke())
+    assert async_docs == docs
+    assert async_docs[0].metadata["id"] == 1
+
+
+def test_fuse_rankings():
+    def hit(chunk_id: int) -> Hit:
+        return Hit(
+            id=chunk_id,
+            content="",
+            start=None,
+            content_hash=None,
+            video_id="a",
+            title="a",
+            publish_time=datetime(2024, 8, 9, 16, 3, 23),
+            score=0.0,
+        )
+
+    actual_hits = fuse_rankings(
+        [[hit(1), hit(2), hit(3)], [hit(3), hit(4)]], k=60
+    )
+    assert [hit.id for hit in actual_hits] == [3, 1, 2, 4]
+    assert actual_hits[0].score == pytest.approx(1 / 63 + 1 / 61)
+    assert actual_hits[1].score == pytest.approx(1 / 61)
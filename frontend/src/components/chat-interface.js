@@ -530,7 +530,11 @@ function createContextDisplay(context) {
 
       if (!isShowingVideo) {
         // Create and show embedded video in place
-        const videoEmbed = createYouTubeEmbed(doc.video_id, doc.title)
+        const videoEmbed = createYouTubeEmbed(
+          doc.video_id,
+          doc.title,
+          doc.start
+        )
         embedContainer.innerHTML = ''
         embedContainer.appendChild(videoEmbed)
 
@@ -632,13 +636,15 @@ function createStopIcon() {
   return icon
 }
 
-function createYouTubeEmbed(videoId, title) {
+function createYouTubeEmbed(videoId, title, start) {
   const container = document.createElement('div')
   container.className = 'relative w-full h-full bg-black'
 
+  // Start playback where the retrieved chunk begins, when it is known
+  const startParam = start ? `&start=${Math.floor(start)}` : ''
   const iframe = document.createElement('iframe')
   iframe.className = 'w-full h-full'
-  iframe.src = `https://www.youtube.com/embed/${videoId}?rel=0&modestbranding=1&showinfo=0&autoplay=1`
+  iframe.src = `https://www.youtube.com/embed/${videoId}?rel=0&modestbranding=1&showinfo=0&autoplay=1${startParam}`
   iframe.title = title || 'YouTube video player'
   iframe.frameBorder = '0'
   iframe.allow =